@@ -1,15 +1,29 @@
 import os
 import time
-import threading
-from flask import Flask, jsonify, g
+from flask import Flask, jsonify, g, request, send_from_directory
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
 from config import Config
-from models.models import db
-from services.gemini_service import GeminiService
+from models.models import db, ensure_schema
+from services.search_service import SearchService
+from services.pregeneration_service import PregenerationService
+from services.rollup_service import RollupService
+from services.snapshot_service import PublicSnapshotService
+from services.health_service import HealthSupervisor, health
+from services.prompt_index import prompt_index
+from services.image_hash import image_hash_index
+from services.refine_service import RefineService
+from services.media_storage import verify_media
 from controllers.auth_controller import AuthController
-from controllers.image_controller import ImageController
-from utils.decorators import jwt_required_custom
+from controllers.image_controller import ImageController, gemini_service as generation_service
+from controllers.collection_controller import CollectionController
+from controllers.admin_controller import AdminController
+from controllers.public_controller import PublicController
+from utils.decorators import jwt_required_custom, admin_required
+from utils.query_budget import init_query_budget
+from utils.tracing import init_tracing
+from utils.profiler import init_profiler
+from cli import register_commands
 
 
 def create_app():
@@ -19,42 +33,64 @@ def create_app():
     # Initialize extensions
     db.init_app(app)
     jwt = JWTManager(app)
+    init_query_budget(app)
+    init_tracing(app)
+    init_profiler(app)
+    register_commands(app)
     
        # Enhanced CORS configuration for production
-    CORS_ORIGINS = [
-        'http://localhost:3000',  # Local development
-        'https://ai-image-generator-kappa-three.vercel.app',  # Your Vercel frontend
-    ]
-    if os.getenv('RAILWAY_STATIC_URL'):  # Railway provides this
-        CORS_ORIGINS.append(os.getenv('RAILWAY_STATIC_URL'))
-    
-    CORS(app, resources={r"/api/*": {"origins": CORS_ORIGINS}})
-    
-    # Initialize services
-    gemini_service = GeminiService()
+    CORS(app, resources={r"/api/*": {"origins": Config.CORS_ORIGINS}})
     
     # Create tables
     with app.app_context():
         db.create_all()
+        ensure_schema()
+        SearchService.init_index()
+        PublicSnapshotService.init_snapshots()
+        RefineService.expire_stale()
+    
+    # Similar-prompt suggestions start once the index has loaded, off the request path
+    prompt_index.warm(app)
+    image_hash_index.warm(app)
     
     # Health check endpoint
     @app.route('/')
     def home():
         return jsonify({"message": "AI Image Generator Backend is running!"})
     
+    # Health: read from the supervisor's shared provider state, never probed per request
     @app.route('/api/health')
-    def health():
-        cooldown_remaining = max(0, gemini_service.request_cooldown - (time.time() - gemini_service.last_request_time))
-        rate_limit_remaining = max(0, gemini_service.rate_limit_reset - time.time())
-        
-        return jsonify({
-            "status": "healthy", 
-            "gemini_available": gemini_service.available,
-            "cooldown_remaining_seconds": round(cooldown_remaining, 1),
-            "rate_limit_remaining_seconds": round(rate_limit_remaining, 1),
-            "requests_per_minute_limit": f"~{60//gemini_service.request_cooldown}",
-            "message": "Optimized for free tier usage"
-        })
+    def health_check():
+        report = health.report()
+        report["gemini_available"] = generation_service.available
+        report["stability_available"] = generation_service.image_service.available
+        # Always 200: placeholders still serve generation; probes use /live and /ready
+        return jsonify(report)
+    
+    @app.route('/api/health/live')
+    def liveness():
+        live = health.report()["live"]
+        return jsonify({"live": live}), 200 if live else 503
+    
+    @app.route('/api/health/ready')
+    def readiness():
+        report = health.report()
+        return jsonify({"ready": report["ready"], "status": report["status"]}), 200 if report["ready"] else 503
+    
+    # Content-addressed image files, served only under a signature from media_url
+    @app.route('/media/<path:name>')
+    def media(name):
+        expires = request.args.get('expires')
+        scope = 'public' if request.args.get('scope') == 'public' else 'private'
+        if not verify_media(name, expires, request.args.get('sig'), scope):
+            return jsonify({"error": "Invalid or expired media link"}), 403
+        # File contents never change, but the link may: cache no longer than it stays valid
+        max_age = max(int(expires) - int(time.time()), 0)
+        response = send_from_directory(
+            Config.MEDIA_ROOT, os.path.join(name[:2], name[2:4], name), max_age=max_age
+        )
+        response.headers['Cache-Control'] = f'{scope}, max-age={max_age}, immutable'
+        return response
     
     # Authentication routes
     @app.route('/api/register', methods=['POST'])
@@ -81,6 +117,26 @@ def create_app():
     def get_images():
         return ImageController.get_user_images(g.user_id)
     
+    @app.route('/api/images/search', methods=['GET'])
+    @jwt_required_custom
+    def search_images():
+        return ImageController.search_images(g.user_id)
+    
+    @app.route('/api/images/export', methods=['GET'])
+    @jwt_required_custom
+    def export_images():
+        return ImageController.export_images(g.user_id)
+    
+    @app.route('/api/images/<int:image_id>', methods=['GET'])
+    @jwt_required_custom
+    def get_image(image_id):
+        return ImageController.get_image(g.user_id, image_id)
+    
+    @app.route('/api/images/<int:image_id>/similar', methods=['GET'])
+    @jwt_required_custom
+    def get_similar_images(image_id):
+        return ImageController.get_similar_images(g.user_id, image_id)
+    
     # Favorite routes
     @app.route('/api/favorites', methods=['POST'])
     @jwt_required_custom
@@ -97,22 +153,107 @@ def create_app():
     def get_favorites():
         return ImageController.get_favorites(g.user_id)
     
+    # Collection routes
+    @app.route('/api/collections', methods=['GET'])
+    @jwt_required_custom
+    def list_collections():
+        return CollectionController.list_collections(g.user_id)
+    
+    @app.route('/api/collections', methods=['POST'])
+    @jwt_required_custom
+    def create_collection():
+        return CollectionController.create_collection(g.user_id)
+    
+    @app.route('/api/collections/<int:collection_id>', methods=['GET'])
+    @jwt_required_custom
+    def get_collection(collection_id):
+        return CollectionController.get_collection(g.user_id, collection_id)
+    
+    @app.route('/api/collections/<int:collection_id>', methods=['PATCH'])
+    @jwt_required_custom
+    def update_collection(collection_id):
+        return CollectionController.update_collection(g.user_id, collection_id)
+    
+    @app.route('/api/collections/<int:collection_id>', methods=['DELETE'])
+    @jwt_required_custom
+    def delete_collection(collection_id):
+        return CollectionController.delete_collection(g.user_id, collection_id)
+    
+    @app.route('/api/collections/<int:collection_id>/images', methods=['POST'])
+    @jwt_required_custom
+    def add_collection_images(collection_id):
+        return CollectionController.add_images(g.user_id, collection_id)
+    
+    @app.route('/api/collections/<int:collection_id>/images', methods=['DELETE'])
+    @jwt_required_custom
+    def remove_collection_images(collection_id):
+        return CollectionController.remove_images(g.user_id, collection_id)
+    
+    # Public collection routes: anonymous, served from precomputed snapshots
+    @app.route('/api/public/collections', methods=['GET'])
+    def public_feed():
+        return PublicController.get_feed()
+    
+    @app.route('/api/public/collections/<int:collection_id>', methods=['GET'])
+    def public_collection(collection_id):
+        return PublicController.get_collection(collection_id)
+    
+    @app.route('/api/public/snapshots/<digest>.json', methods=['GET'])
+    def public_snapshot(digest):
+        return PublicController.get_snapshot(digest)
+    
     # Stats route
     @app.route('/api/stats', methods=['GET'])
     @jwt_required_custom
     def get_stats():
         return ImageController.get_stats(g.user_id)
     
-    # Background task for Gemini availability check
-    def periodic_availability_check():
-        while True:
-            time.sleep(60)
-            if not gemini_service.available and gemini_service.rate_limit_reset <= time.time():
-                gemini_service._initialize_gemini()
+    # Admin routes
+    @app.route('/api/admin/analytics', methods=['GET'])
+    @jwt_required_custom
+    @admin_required
+    def get_analytics():
+        return AdminController.get_analytics()
+    
+    @app.route('/api/admin/profiles', methods=['GET'])
+    @jwt_required_custom
+    @admin_required
+    def list_profiles():
+        return AdminController.list_profiles()
+    
+    @app.route('/api/admin/profiles', methods=['POST'])
+    @jwt_required_custom
+    @admin_required
+    def create_profile():
+        return AdminController.create_profile()
     
+    @app.route('/api/admin/profiles/<job_id>', methods=['GET'])
+    @jwt_required_custom
+    @admin_required
+    def get_profile(job_id):
+        return AdminController.get_profile(job_id)
+    
+    # One set of provider probes for all workers, shared through provider_health
+    providers = {}
     if Config.GEMINI_API_KEY:
-        availability_thread = threading.Thread(target=periodic_availability_check, daemon=True)
-        availability_thread.start()
+        providers['gemini'] = generation_service
+    if generation_service.image_service.api_key:
+        providers['stability'] = generation_service.image_service
+    health.configure(providers)  # readiness needs to know what can render, supervised or not
+    if Config.HEALTH_TICK_SECONDS > 0:
+        HealthSupervisor.start(app, providers)
+    
+    # Speculative renders of trending prompts with spare upstream capacity
+    if Config.PREGEN_DAILY_CAP > 0:
+        PregenerationService.start_scheduler(app, generation_service.image_service)
+    
+    # Public collection pages, rebuilt off the request path from the queue writes fill;
+    # runs even when writes rebuild inline, since it also renews public media links
+    PublicSnapshotService.start_scheduler(app)
+    
+    # Hourly/daily usage rollups behind /api/admin/analytics
+    if Config.ROLLUP_INTERVAL_SECONDS > 0:
+        RollupService.start_scheduler(app)
     
     return app
 
@@ -121,5 +262,5 @@ app = create_app()
 
 if __name__ == '__main__':
     print("STARTING: AI Image Generator Backend with MVC Architecture...")
-    print(f"GEMINI AVAILABLE: {GeminiService().available}")
+    print(f"GEMINI AVAILABLE: {generation_service.available}")
     app.run(debug=False, host="0.0.0.0", port=5002)
\ No newline at end of file
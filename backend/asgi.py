@@ -0,0 +1,186 @@
+"""ASGI entry point: serves /api/generate with asyncio, everything else via Flask.
+
+Generation is almost entirely waiting on Gemini and Stability, so here it
+runs on the event loop with non-blocking clients while database work goes
+through a small thread pool. One worker can then hold hundreds of
+in-flight generations, bounded by ASYNC_MAX_CONCURRENT_GENERATIONS, while
+UPSTREAM_CONCURRENCY provider slots are shared between users by weighted
+fair queuing.
+
+    gunicorn -k uvicorn.workers.UvicornWorker -c gunicorn_config.py asgi:app
+    uvicorn asgi:app --port 5002
+"""
+import json
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.wsgi import WsgiToAsgi
+from flask_jwt_extended import decode_token
+from app import app as flask_app
+from config import Config
+from controllers.image_controller import gemini_service
+from services.admission_service import AdmissionService, FairShareQueue
+from services.generation_service import GenerationService, GenerationRejected
+from services.pregeneration_service import live_traffic
+from utils import tracing, query_budget
+from utils.log import get_logger
+from utils.profiler import profiler
+from services.media_storage import MEDIA_REF_PREFIX, media_url
+
+log = get_logger('images')
+
+MAX_BODY_BYTES = 64 * 1024
+
+wsgi_app = WsgiToAsgi(flask_app)
+db_executor = ThreadPoolExecutor(max_workers=Config.ASYNC_DB_THREADS, thread_name_prefix='db')
+generation_slots = None
+upstream_queue = FairShareQueue(Config.UPSTREAM_CONCURRENCY)
+# cProfile hooks one thread, and a generation here hops between the event loop and the DB pool
+profiler.native_routes.update(('/api/generate', 'generate'))
+
+
+async def run_db(fn, *args, **kwargs):
+    """Run a blocking ORM call on the DB thread pool inside an app context"""
+    def call():
+        with flask_app.app_context():
+            return fn(*args, **kwargs)
+    # Copy the context so SQL spans land in the caller's trace
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(db_executor, context.run, call)
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_BYTES:
+            raise ValueError('Request body too large')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_json(send, scope, payload, status=200, extra_headers=None, chunks=None):
+    """Send payload as JSON, or the already-encoded chunks of it (sent without a content-length)"""
+    headers = [(b'content-type', b'application/json')]
+    if chunks is None:
+        body = json.dumps(payload).encode('utf-8')
+        headers.append((b'content-length', str(len(body)).encode()))
+        chunks = [body]
+    for name, value in (extra_headers or {}).items():
+        headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+    origin = dict(scope['headers']).get(b'origin', b'').decode('latin-1')
+    if origin in Config.CORS_ORIGINS:
+        headers += [(b'access-control-allow-origin', origin.encode('latin-1')), (b'vary', b'Origin')]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    for chunk in chunks:
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def public_image_url(scope, image_url):
+    """media:// refs need an absolute URL, built from the request's host"""
+    if not image_url.startswith(MEDIA_REF_PREFIX):
+        return image_url
+    host = dict(scope['headers']).get(b'host', b'').decode('latin-1')
+    base = f"{scope.get('scheme', 'http')}://{host}/" if host else None
+    return media_url(image_url[len(MEDIA_REF_PREFIX):], base)
+
+
+def authenticate(scope):
+    """Return the user id from the Bearer token, or None"""
+    authorization = dict(scope['headers']).get(b'authorization', b'').decode('latin-1')
+    if not authorization.startswith('Bearer '):
+        return None
+    try:
+        with flask_app.app_context():
+            return int(decode_token(authorization[len('Bearer '):])['sub'])
+    except Exception:
+        return None
+
+
+async def generate(scope, receive, send):
+    global generation_slots
+    if generation_slots is None:
+        generation_slots = asyncio.Semaphore(Config.ASYNC_MAX_CONCURRENT_GENERATIONS)
+
+    user_id = authenticate(scope)
+    if user_id is None:
+        return await send_json(send, scope, {'error': 'Invalid or expired token'}, 401)
+
+    try:
+        data = json.loads(await read_body(receive) or b'{}')
+        if not isinstance(data, dict):
+            raise ValueError('Request must be JSON')
+    except ValueError:
+        return await send_json(send, scope, {'error': 'Request must be JSON'}, 400)
+
+    try:
+        params = GenerationService.parse(data)
+        plan = await run_db(GenerationService.check, user_id, params)
+        result = await run_db(GenerationService.claim, params)
+        if result is None:
+            weight = AdmissionService.quota_for(plan)['weight']
+            with live_traffic.track():
+                async with generation_slots, upstream_queue.slot(user_id, weight):
+                    result = await GenerationService.render_async(gemini_service, params)
+        image_id = await run_db(GenerationService.save, flask_app, gemini_service, user_id, params, result)
+        payload = GenerationService.response(params, result, image_id, public_image_url(scope, result['image_url']))
+        await send_json(send, scope, payload, chunks=GenerationService.encode(payload))
+    except GenerationRejected as e:
+        await send_json(send, scope, e.payload, e.status, e.headers)
+    except Exception as e:
+        log.error('generation_failed', error=str(e))
+        await send_json(send, scope, {'error': str(e)}, 500)
+
+
+async def traced_generate(scope, receive, send):
+    """generate() under a root span, with the same retention rules as Flask requests"""
+    headers = dict(scope['headers'])
+    root, token = tracing.start_trace(
+        'POST /api/generate',
+        traceparent=headers.get(b'traceparent', b'').decode('latin-1'),
+        request_id=headers.get(b'x-request-id', b'').decode('latin-1') or None,
+        **{'http.method': 'POST', 'http.target': '/api/generate'}
+    )
+    if root is None:
+        return await generate(scope, receive, send)
+    
+    status = 500
+    
+    async def send_traced(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+            message = dict(message, headers=list(message['headers']) + [
+                (b'x-request-id', root.trace.request_id.encode('latin-1')),
+                (b'traceparent', f"00-{root.trace.trace_id}-{root.span_id}-01".encode('latin-1'))
+            ])
+        await send(message)
+    
+    try:
+        await generate(scope, receive, send_traced)
+    finally:
+        tracing.finish_trace(root, token, status)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/api/generate':
+        profiler.poll()  # Flask's before_request never runs for this route
+        stats = query_budget.QueryStats()
+        token = query_budget.collect(stats)
+        try:
+            return await traced_generate(scope, receive, send)
+        finally:
+            query_budget.stop_collecting(token)
+            query_budget.report('generate', stats)
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                db_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    return await wsgi_app(scope, receive, send)
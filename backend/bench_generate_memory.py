@@ -0,0 +1,141 @@
+import io
+import os
+import gc
+import shutil
+import json
+import base64
+import tempfile
+import tracemalloc
+from unittest import mock
+from PIL import Image
+from config import Config
+
+# A 1024x1024 SDXL PNG is typically 1.5-2 MB; a noise image doesn't compress either
+IMAGE_SIDE = 830
+NETWORK_CHUNK = 16 * 1024
+
+# Peak allocation allowed per POST /api/generate, end to end (stream, store,
+# hash, respond), as a multiple of the PNG size. Inline storage holds the
+# base64 text twice at most (the buffer and the final str) and the hashes
+# decode one more copy piecewise beside the stored str; media storage holds
+# the decoded bytes once and PIL reads the file from disk. The buffered path
+# peaked at about 5x for the upstream call alone.
+MAX_PEAK_RATIO = {'inline': 3.0, 'media': 1.25}
+
+
+class FakeStabilityResponse:
+    """Serves a prebuilt body in socket-sized chunks, like requests with stream=True"""
+
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_content(self, chunk_size):
+        view = memoryview(self.body)
+        for start in range(0, len(view), NETWORK_CHUNK):
+            yield bytes(view[start:start + NETWORK_CHUNK])
+
+    def json(self):
+        return json.loads(b''.join(self.iter_content(NETWORK_CHUNK)))
+
+
+def legacy_generate(response):
+    """The buffered path streaming replaced: whole-body JSON, decode, re-encode"""
+    data = response.json()
+    for image in data["artifacts"]:
+        image_binary = base64.b64decode(image["base64"])
+        image_base64 = base64.b64encode(image_binary).decode('utf-8')
+        return f"data:image/png;base64,{image_base64}"
+
+
+def measure(fn):
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak
+
+
+def noise_png():
+    buffer = io.BytesIO()
+    pixels = os.urandom(IMAGE_SIDE * IMAGE_SIDE * 3)
+    Image.frombytes('RGB', (IMAGE_SIDE, IMAGE_SIDE), pixels).save(buffer, 'PNG', compress_level=1)
+    return buffer.getvalue()
+
+
+def bench_client(workdir):
+    """A test client on a scratch database, with background jobs off so only the request allocates"""
+    Config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    Config.MEDIA_ROOT = os.path.join(workdir, 'media')
+    Config.PREGEN_DAILY_CAP = Config.ROLLUP_INTERVAL_SECONDS = Config.HEALTH_TICK_SECONDS = 0
+    from app import app
+    from controllers.image_controller import gemini_service
+
+    stability = gemini_service.image_service
+    stability.api_key, stability.available, stability.request_cooldown = 'bench', True, 0
+    client = app.test_client()
+    token = client.post('/api/register', json={
+        'username': 'bench', 'email': 'bench@example.com', 'password': 'bench-password'
+    }).get_json()['access_token']
+    return client, {'Authorization': f'Bearer {token}'}
+
+
+def generate(client, headers):
+    """POST /api/generate, reading the response body in chunks the way a WSGI server would"""
+    response = client.post('/api/generate', json={'prompt': 'bench prompt'}, headers=headers, buffered=False)
+    size = sum(len(chunk) for chunk in response.response)
+    response.close()
+    return response.status_code, size
+
+
+def run_benchmarks():
+    image = noise_png()
+    encoded = base64.b64encode(image).decode('ascii')
+    body = json.dumps({"artifacts": [{
+        "base64": encoded,
+        "seed": 1234,
+        "finishReason": "SUCCESS"
+    }]}).encode('utf-8')
+    expected = "data:image/png;base64," + encoded
+    print(f"image {len(image) / 1e6:.1f} MB, response body {len(body) / 1e6:.1f} MB")
+
+    result, peak = measure(lambda: legacy_generate(FakeStabilityResponse(body)))
+    assert result == expected
+    print(f"{'legacy (buffered)':<22} peak {peak / 1e6:6.1f} MB  ({peak / len(image):.2f}x image)  upstream call only")
+    del result
+
+    original = {name: getattr(Config, name) for name in (
+        'IMAGE_STORAGE', 'MEDIA_ROOT', 'SQLALCHEMY_DATABASE_URI',
+        'PREGEN_DAILY_CAP', 'ROLLUP_INTERVAL_SECONDS', 'HEALTH_TICK_SECONDS'
+    )}
+    workdir = tempfile.mkdtemp(prefix='bench-generate-')
+    try:
+        client, headers = bench_client(workdir)
+        for storage in ('inline', 'media'):
+            Config.IMAGE_STORAGE = storage
+            with mock.patch('requests.post', side_effect=lambda *a, **k: FakeStabilityResponse(body)):
+                generate(client, headers)  # warm imports, caches and the connection pool
+                (status, size), peak = measure(lambda: generate(client, headers))
+            assert status == 200, f"generate answered {status}"
+            if storage == 'inline':
+                assert size > len(expected)
+            print(f"{'/api/generate (' + storage + ')':<22} peak {peak / 1e6:6.1f} MB  "
+                  f"({peak / len(image):.2f}x image)  response {size / 1e6:.1f} MB")
+            assert peak <= MAX_PEAK_RATIO[storage] * len(image), \
+                f"{storage} generation peaked at {peak} bytes, budget {MAX_PEAK_RATIO[storage]}x"
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        for name, value in original.items():
+            setattr(Config, name, value)
+
+
+if __name__ == "__main__":
+    run_benchmarks()
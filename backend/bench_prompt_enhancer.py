@@ -0,0 +1,61 @@
+import time
+import random
+from services.prompt_enhancer import prompt_enhancer
+
+PROMPTS = [
+    "A cute cat playing with yarn",
+    "Beautiful mountain landscape at sunset",
+    "Colorful abstract art",
+    "portrait photo of an old fisherman",
+    "education poster for a science class",
+    "A baby dog sleeping on a sofa, detailed",
+    "cyberpunk city street in the rain",
+    "oil painting of a lighthouse",
+]
+
+
+def legacy_improve(prompt):
+    """The per-call dictionary rebuild the engine replaced, kept for comparison"""
+    descriptive_words = {
+        "cute": ["adorable", "charming", "sweet"],
+        "baby": ["infant", "newborn", "little one"],
+        "cat": ["feline", "kitten", "cat"],
+        "dog": ["puppy", "canine", "dog"],
+        "photo": ["professional photography", "high-quality image", "crystal clear"],
+        "drawing": ["artistic illustration", "detailed artwork", "digital painting"],
+        "landscape": ["breathtaking landscape", "scenic view", "natural beauty"],
+        "portrait": ["professional portrait", "character study", "expressive face"],
+    }
+    improved = prompt
+    for basic_word, enhanced_options in descriptive_words.items():
+        if basic_word in improved.lower():
+            improved = improved.replace(basic_word, random.choice(enhanced_options))
+            break
+    quality_terms = ["high resolution", "detailed", "sharp focus", "well-lit", "professional"]
+    if not any(term in improved.lower() for term in quality_terms):
+        improved += f", {random.choice(quality_terms)}"
+    return improved
+
+
+def bench(name, fn, iterations=20000):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(PROMPTS[i % len(PROMPTS)])
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {elapsed / iterations * 1e6:8.2f} us/call")
+
+
+def run_benchmarks():
+    """Micro-benchmark the rule-based fallbacks that serve all traffic during Gemini outages"""
+    bench("legacy improve", legacy_improve)
+    bench("engine improve (uncached)", prompt_enhancer.improve.__wrapped__)
+    bench("engine improve (cached)", prompt_enhancer.improve)
+    bench("engine fallback_image", lambda p: prompt_enhancer.fallback_image.__wrapped__(p, 'realistic'))
+
+    for prompt in PROMPTS[:5]:
+        assert prompt_enhancer.improve(prompt) == prompt_enhancer.improve(prompt)
+        print(f"  {prompt!r} -> {prompt_enhancer.improve(prompt)!r}")
+
+
+if __name__ == "__main__":
+    run_benchmarks()
@@ -0,0 +1,95 @@
+import io
+import json
+import base64
+import shutil
+import tempfile
+from unittest import mock
+from PIL import Image
+from config import Config
+from bench_generate_memory import FakeStabilityResponse, bench_client
+from utils.query_budget import assert_query_budget
+
+# Enough rows that a per-row lookup shows up as a repeated statement shape
+SEED_IMAGES = 30
+
+
+def tiny_png_body():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), 'white').save(buffer, 'PNG')
+    return json.dumps({"artifacts": [{
+        "base64": base64.b64encode(buffer.getvalue()).decode('ascii'),
+        "seed": 1234,
+        "finishReason": "SUCCESS"
+    }]}).encode('utf-8')
+
+
+def seed(app):
+    """Images, favorites and a collection for the bench user, who is also made an admin"""
+    from models.models import db, User, GeneratedImage, Favorite, Collection, CollectionItem
+
+    with app.app_context():
+        user = User.query.filter_by(username='bench').one()
+        user.is_admin = True
+        images = [GeneratedImage(
+            user_id=user.id, original_prompt=f'bench prompt {n}', improved_prompt=f'bench prompt {n}, detailed',
+            image_url=f'https://example.com/{n}.png', style='realistic'
+        ) for n in range(SEED_IMAGES)]
+        db.session.add_all(images)
+        db.session.flush()
+        collection = Collection(user_id=user.id, name='bench')
+        db.session.add(collection)
+        db.session.flush()
+        db.session.add_all(Favorite(user_id=user.id, image_id=image.id) for image in images[::2])
+        db.session.add_all(CollectionItem(collection_id=collection.id, image_id=image.id) for image in images[:10])
+        db.session.commit()
+        return [image.id for image in images], collection.id
+
+
+def requests_for(image_ids, collection_id):
+    """One representative request per budgeted endpoint: (endpoint, method, path, json body)"""
+    moved = {'image_ids': image_ids[10:20]}
+    return [
+        ('get_images', 'get', '/api/images?per_page=20', None),
+        ('search_images', 'get', '/api/images/search?q=bench', None),
+        ('generate', 'post', '/api/generate', {'prompt': 'bench prompt'}),
+        ('get_image', 'get', f'/api/images/{image_ids[0]}', None),
+        ('get_analytics', 'get', '/api/admin/analytics', None),
+        ('get_favorites', 'get', '/api/favorites', None),
+        ('get_stats', 'get', '/api/stats', None),
+        ('list_collections', 'get', '/api/collections', None),
+        ('get_collection', 'get', f'/api/collections/{collection_id}', None),
+        ('add_collection_images', 'post', f'/api/collections/{collection_id}/images', moved),
+        ('remove_collection_images', 'delete', f'/api/collections/{collection_id}/images', moved),
+    ]
+
+
+def run_benchmarks():
+    original = {name: getattr(Config, name) for name in (
+        'MEDIA_ROOT', 'SQLALCHEMY_DATABASE_URI',
+        'PREGEN_DAILY_CAP', 'ROLLUP_INTERVAL_SECONDS', 'HEALTH_TICK_SECONDS'
+    )}
+    workdir = tempfile.mkdtemp(prefix='bench-queries-')
+    body = tiny_png_body()
+    try:
+        client, headers = bench_client(workdir)
+        from app import app
+        image_ids, collection_id = seed(app)
+        cases = requests_for(image_ids, collection_id)
+        missing = set(Config.QUERY_BUDGETS) - {endpoint for endpoint, *_ in cases}
+        assert not missing, f"no bench request for budgeted endpoints {sorted(missing)}"
+
+        with mock.patch('requests.post', side_effect=lambda *a, **k: FakeStabilityResponse(body)):
+            for endpoint, method, path, payload in cases:
+                with assert_query_budget(endpoint=endpoint) as stats:
+                    response = getattr(client, method)(path, json=payload, headers=headers)
+                assert response.status_code == 200, f"{endpoint} answered {response.status_code}"
+                print(f"{endpoint:<26} {stats.count:>3} queries  (budget {Config.QUERY_BUDGETS[endpoint]})"
+                      f"  {stats.duration * 1000:6.1f} ms")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        for name, value in original.items():
+            setattr(Config, name, value)
+
+
+if __name__ == "__main__":
+    run_benchmarks()
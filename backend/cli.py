@@ -0,0 +1,169 @@
+import json
+import click
+from config import Config
+from services.image_service import ImageService
+from services.compaction_service import CompactionService
+from services.rollup_service import RollupService
+from services.snapshot_service import PublicSnapshotService
+from services.tiering_service import TieringService
+from services.refine_service import RefineService
+from services.bulk_generation_service import BulkGenerationService, parse_prompts, job_name
+from services.gemini_service import GeminiService
+from models.models import db, User
+from utils.cassette import cassette, summarize
+
+
+def register_commands(app):
+    """Maintenance commands, run with `flask --app app <command>`"""
+
+    @app.cli.command('dedup-images')
+    @click.option('--max-distance', default=Config.DEDUP_MAX_DISTANCE, show_default=True,
+                  help='Hamming distance between dHashes treated as the same image (0 = byte-identical only).')
+    def dedup_images(max_distance):
+        """Collapse duplicate inline image payloads onto one stored copy."""
+        stats = ImageService.deduplicate_images(max_distance=max_distance)
+        click.echo(
+            f"Hashed {stats['hashed']} images, collapsed {stats['collapsed']} duplicates, "
+            f"reclaimed {stats['bytes_reclaimed']} bytes"
+        )
+
+    @app.cli.command('compact-images')
+    @click.option('--chunk-size', default=50, show_default=True, help='Rows decoded and rewritten per transaction.')
+    @click.option('--workers', default=None, type=int, help='Decoder processes (default: CPU count).')
+    @click.option('--restart', is_flag=True, help='Ignore the saved checkpoint and scan from the first row.')
+    def compact_images(chunk_size, workers, restart):
+        """Move inline base64 images out of the database into MEDIA_ROOT."""
+        state = CompactionService.compact(chunk_size=chunk_size, workers=workers, restart=restart, progress=click.echo)
+        click.echo(
+            f"Moved {state['moved']} images ({state['failed']} failed), "
+            f"{state['bytes_reclaimed'] / 1e6:.1f} MB of row data reclaimed, "
+            f"database file shrank by {state['file_bytes_reclaimed'] / 1e6:.1f} MB"
+        )
+
+    @app.cli.command('tier-images')
+    @click.option('--batch-size', default=Config.TIER_BATCH_SIZE, show_default=True, help='Rows per transaction.')
+    @click.option('--dry-run', is_flag=True, help='Report what would be deleted and archived without writing.')
+    @click.option('--skip-retention', is_flag=True, help='Only archive; do not enforce RETENTION_MAX_IMAGES.')
+    def tier_images(batch_size, dry_run, skip_retention):
+        """Enforce per-plan retention, then move cold inline images to the archive."""
+        if not dry_run:
+            RefineService.expire_stale()  # rows stuck pending are otherwise never tiered
+        report = TieringService.run(batch_size=batch_size, dry_run=dry_run, retention=not skip_retention,
+                                    progress=click.echo)
+        verb = 'Would delete' if dry_run else 'Deleted'
+        click.echo(f"{verb} {report['deleted']} images over retention limits")
+        if dry_run:
+            click.echo(f"Would archive {report['archived']} images ({report['archived_bytes_before'] / 1e6:.1f} MB inline)")
+            return
+        click.echo(
+            f"Archived {report['archived']} images: {report['archived_bytes_before'] / 1e6:.1f} MB inline -> "
+            f"{report['archived_bytes_after'] / 1e6:.1f} MB compressed"
+        )
+        click.echo(
+            f"Hot table payload {report['hot_payload_bytes_before'] / 1e6:.1f} MB -> "
+            f"{report['hot_payload_bytes_after'] / 1e6:.1f} MB"
+        )
+        if report['gallery_page_rows']:
+            click.echo(
+                f"Gallery page of {report['gallery_page_rows']} archived images: "
+                f"{report['gallery_page_bytes_before'] / 1e3:.1f} KB -> {report['gallery_page_bytes_after'] / 1e3:.1f} KB, "
+                f"{report['gallery_page_ms_before']} ms -> {report['gallery_page_ms_after']} ms"
+            )
+
+    @app.cli.command('rollup-usage')
+    @click.option('--rebuild', is_flag=True, help='Discard the usage rollups and recount every generation.')
+    def rollup_usage(rebuild):
+        """Fold new generations into the hourly and daily usage rollups."""
+        if rebuild:
+            RollupService.rebuild()
+        folded = RollupService.catch_up()
+        click.echo(f"Folded {folded} generations into the usage rollups")
+
+    @app.cli.command('set-admin')
+    @click.argument('email')
+    @click.option('--revoke', is_flag=True, help='Remove admin access instead of granting it.')
+    def set_admin(email, revoke):
+        """Grant (or revoke) access to the /api/admin endpoints."""
+        user = User.query.filter_by(email=email.strip().lower()).first()
+        if user is None:
+            raise click.ClickException(f"No user with email {email}")
+        user.is_admin = not revoke
+        db.session.commit()
+        click.echo(f"{user.email} is {'no longer' if revoke else 'now'} an admin")
+
+    @app.cli.command('rebuild-snapshots')
+    def rebuild_snapshots():
+        """Republish every public collection page and the public feed."""
+        # Published here, or by the worker holding the snapshots lease on its next tick
+        count = PublicSnapshotService.rebuild_all()
+        click.echo(f"Queued {count} collections for republishing")
+
+    @app.cli.command('bulk-generate')
+    @click.argument('source', type=click.File('r', encoding='utf-8'), default='-')
+    @click.option('--user', 'email', required=True,
+                  help="Owner of the images; every render is admitted against this user's plan quota.")
+    @click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None,
+                  help='Input format (default: from the file extension, else guessed).')
+    @click.option('--style', default='realistic', show_default=True, help='Style for rows that do not set one.')
+    @click.option('--concurrency', default=Config.BULK_CONCURRENCY, show_default=True, help='Renders in flight.')
+    @click.option('--rate', default=Config.BULK_REQUESTS_PER_SECOND, show_default=True,
+                  help='Renders started per second, at most.')
+    @click.option('--batch-size', default=Config.BULK_BATCH_SIZE, show_default=True,
+                  help='Rows inserted and checkpointed per transaction.')
+    @click.option('--job', default=None, help='Checkpoint name (default: derived from the user and the input).')
+    @click.option('--restart', is_flag=True, help='Ignore the saved checkpoint and start from the first prompt.')
+    @click.option('--failed', 'failed_out', type=click.File('a', encoding='utf-8'), default=None,
+                  help='Append prompts that produced no image here, as JSONL ready to feed back in.')
+    def bulk_generate(source, email, fmt, style, concurrency, rate, batch_size, job, restart, failed_out):
+        """Generate images for prompts from a CSV/JSONL file (or stdin) without going through the web workers."""
+        user = User.query.filter_by(email=email.strip().lower()).first()
+        if user is None:
+            raise click.ClickException(f"No user with email {email}")
+        text = source.read()
+        if fmt is None and source.name.endswith(('.jsonl', '.ndjson')):
+            fmt = 'jsonl'
+        elif fmt is None and source.name.endswith('.csv'):
+            fmt = 'csv'
+        try:
+            items = parse_prompts(text, fmt, style)
+        except ValueError as e:
+            raise click.ClickException(f"{source.name}: {e}")
+
+        gemini = GeminiService()
+        if not gemini.image_service.available:
+            raise click.ClickException('Stability is not configured or not reachable; nothing would render')
+
+        def on_failure(index, item, error):
+            click.echo(f"Item {index + 1} failed: {error}", err=True)
+            if failed_out:
+                failed_out.write(json.dumps(item) + '\n')
+                failed_out.flush()
+
+        job = job or job_name(user.id, text)
+        done = 0 if restart else BulkGenerationService.checkpoint(job)
+        click.echo(f"Job {job}: {len(items)} prompts, {done} already done")
+        report = BulkGenerationService.run(
+            items, user.id, job, gemini, concurrency=concurrency, batch_size=batch_size, rate=rate,
+            restart=restart, progress=click.echo, on_failure=on_failure
+        )
+        click.echo(
+            f"Generated {report['generated']} images ({report['failed']} failed) in {report['seconds']}s, "
+            f"{report['images_per_minute']} images/min"
+        )
+        if report.get('interrupted'):
+            click.echo(f"Interrupted after item {report['done']}; rerun the same command to resume")
+
+    @app.cli.command('cassette-stats')
+    @click.argument('path', required=False)
+    def cassette_stats(path):
+        """Summarize recorded provider traffic (default: PROVIDER_CASSETTE_DIR)."""
+        rows = summarize(cassette.load(path))
+        if not rows:
+            raise click.ClickException(f"No recorded exchanges under {path or Config.PROVIDER_CASSETTE_DIR}")
+        click.echo(f"{'provider':<10} {'op':<16} {'key':<32} {'status':<14} {'count':>6} {'p50 ms':>9} "
+                   f"{'p95 ms':>9} {'mean bytes':>11}")
+        for row in rows:
+            click.echo(
+                f"{row['provider']:<10} {row['op']:<16} {str(row['key'] or '-'):<32} {row['status']:<14} "
+                f"{row['count']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {str(row['mean_body_bytes'] or '-'):>11}"
+            )
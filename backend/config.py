@@ -1,4 +1,5 @@
 import os
+import tempfile
 from datetime import timedelta
 from dotenv import load_dotenv
 
@@ -8,10 +9,194 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev-fallback-key')
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///ai_image_generator.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Separate database for the cold image archive (see `flask tier-images`);
+    # unset keeps archived_images in the main database
+    COLD_DATABASE_URL = os.getenv('COLD_DATABASE_URL')
+    SQLALCHEMY_BINDS = {'cold': COLD_DATABASE_URL} if COLD_DATABASE_URL else {}
     JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY', 'jwt-fallback-key')
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(days=7)
     JWT_COOKIE_CSRF_PROTECT = False
     
+    CORS_ORIGINS = [
+        'http://localhost:3000',  # Local development
+        'https://ai-image-generator-kappa-three.vercel.app',  # Your Vercel frontend
+    ]
+    if os.getenv('RAILWAY_STATIC_URL'):  # Railway provides this
+        CORS_ORIGINS.append(os.getenv('RAILWAY_STATIC_URL'))
+    
     # Gemini AI Configuration
     GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-    REQUEST_COOLDOWN = 60  # seconds between Gemini requests
\ No newline at end of file
+    REQUEST_COOLDOWN = 60  # seconds between Gemini requests
+    
+    # SQL query budget instrumentation
+    QUERY_STATS_HEADERS = os.getenv('QUERY_STATS_HEADERS', 'false').lower() == 'true'
+    QUERY_BUDGET_DEFAULT = int(os.getenv('QUERY_BUDGET_DEFAULT', 10))
+    N_PLUS_ONE_THRESHOLD = 5  # identical statement shapes per request
+    QUERY_BUDGETS = {
+        'get_images': 3,
+        'search_images': 1,
+        'generate': 8,
+        'get_image': 2,
+        'get_analytics': 3,
+        'get_favorites': 3,
+        'get_stats': 4,
+        'list_collections': 2,
+        'get_collection': 4,
+        'add_collection_images': 4,
+        'remove_collection_images': 4,
+    }
+    
+    # Request tracing: TRACE_EXPORT is a file path or an OTLP/HTTP collector URL
+    # (unset disables tracing). Traces are kept when slower than TRACE_SLOW_MS,
+    # failed with a 5xx, or picked by TRACE_SAMPLE_RATE.
+    TRACE_EXPORT = os.getenv('TRACE_EXPORT', '')
+    TRACE_SLOW_MS = int(os.getenv('TRACE_SLOW_MS', 5000))
+    TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0.0))
+    TRACE_MAX_SPANS = 2000
+    
+    # Structured logging: JSON lines written by a background thread. LOG_SAMPLING
+    # keys are "category.event" or "category"; rate keeps that fraction of
+    # records, per_minute caps what is left
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # 'json' or 'text'
+    LOG_MAX_FIELD_CHARS = int(os.getenv('LOG_MAX_FIELD_CHARS', 300))
+    LOG_QUEUE_SIZE = 10000
+    LOG_SAMPLING = {
+        'stability.fallback': {'per_minute': 20},
+        'stability.fallback_image': {'rate': 0.1, 'per_minute': 20},
+        'stability.engine_failed': {'per_minute': 30},
+        'stability.generated': {'rate': 0.1},
+        'gemini.api_error': {'per_minute': 10},
+        'query_budget': {'per_minute': 60},
+    }
+    
+    # Similar-prompt reuse suggestions
+    PROMPT_INDEX_DIM = 128
+    PROMPT_INDEX_RETRY_BASE_SECONDS = 5  # first retry of a failed startup load, doubling per failure
+    PROMPT_INDEX_RETRY_MAX_SECONDS = 300
+    SIMILAR_PROMPT_THRESHOLD = float(os.getenv('SIMILAR_PROMPT_THRESHOLD', 0.75))
+    SIMILAR_PROMPT_LIMIT = 4
+    SIMILAR_PROMPT_SCOPE = os.getenv('SIMILAR_PROMPT_SCOPE', 'user')  # 'user' or 'global'
+    
+    # Perceptual-hash deduplication (Hamming distance between 64-bit dHashes)
+    SIMILAR_IMAGE_MAX_DISTANCE = 10
+    DEDUP_MAX_DISTANCE = int(os.getenv('DEDUP_MAX_DISTANCE', 2))
+    
+    # External image storage (payloads moved out of generated_images)
+    MEDIA_ROOT = os.getenv('MEDIA_ROOT', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media'))
+    MEDIA_BASE_URL = os.getenv('MEDIA_BASE_URL')  # defaults to the request's host
+    # Media URLs are signed with SECRET_KEY and expire after one to two of these windows;
+    # a CDN in front of /media must forward the query string
+    MEDIA_URL_TTL_SECONDS = int(os.getenv('MEDIA_URL_TTL_SECONDS', 3600))
+    # Links in public snapshots: renewed by the snapshot job once a window while the
+    # collection stays public, so unpublishing or refining revokes them within two windows
+    MEDIA_PUBLIC_URL_TTL_SECONDS = int(os.getenv('MEDIA_PUBLIC_URL_TTL_SECONDS', 86400))
+    # Where new generations are written: 'inline' (base64 data URL in the row) or 'media'
+    IMAGE_STORAGE = os.getenv('IMAGE_STORAGE', 'inline')
+    
+    # Precomputed public collection pages (see services/snapshot_service.py)
+    SNAPSHOT_ROOT = os.getenv('SNAPSHOT_ROOT', os.path.join(MEDIA_ROOT, 'snapshots'))
+    SNAPSHOT_PAGE_SIZE = 20
+    SNAPSHOT_FEED_MAX_PAGES = 50
+    SNAPSHOT_MAX_AGE = int(os.getenv('SNAPSHOT_MAX_AGE', 60))  # seconds, for the mutable page URLs
+    SNAPSHOT_TTL_HOURS = 24  # superseded pages kept for clients still holding their URLs
+    SNAPSHOT_CACHE_SIZE = 256
+    # Writes only queue a rebuild; one worker, holding a lease, drains the queue this often
+    # (0 = writes rebuild inline, and the job only renews public media links, once a minute)
+    SNAPSHOT_REBUILD_SECONDS = int(os.getenv('SNAPSHOT_REBUILD_SECONDS', 5))
+    SNAPSHOT_LEASE_SECONDS = int(os.getenv('SNAPSHOT_LEASE_SECONDS', 300))  # longer than one drain
+    
+    # Async (ASGI) serving mode, see asgi.py
+    ASYNC_MAX_CONCURRENT_GENERATIONS = int(os.getenv('ASYNC_MAX_CONCURRENT_GENERATIONS', 200))
+    ASYNC_DB_THREADS = int(os.getenv('ASYNC_DB_THREADS', 8))
+    
+    # Per-user admission control at /api/generate: token buckets refilled at
+    # per_hour and capped at burst; weight is the plan's share of upstream
+    # capacity under contention
+    PLAN_QUOTAS = {
+        'free': {'per_hour': 20, 'burst': 5, 'weight': 1},
+        'pro': {'per_hour': 200, 'burst': 20, 'weight': 4},
+    }
+    UPSTREAM_CONCURRENCY = int(os.getenv('UPSTREAM_CONCURRENCY', 4))
+    
+    # Offline `flask bulk-generate` runs: renders in flight, renders started
+    # per second at most, and rows inserted (and checkpointed) per transaction;
+    # every render is also admitted against the owner's plan quota above
+    BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY', UPSTREAM_CONCURRENCY))
+    BULK_REQUESTS_PER_SECOND = float(os.getenv('BULK_REQUESTS_PER_SECOND', 2))
+    BULK_BATCH_SIZE = 50
+    
+    # Speculative pre-generation of trending prompt/style pairs with spare
+    # upstream capacity; PREGEN_DAILY_CAP renders per UTC day, 0 disables it
+    PREGEN_DAILY_CAP = int(os.getenv('PREGEN_DAILY_CAP', 0))
+    PREGEN_INTERVAL_SECONDS = int(os.getenv('PREGEN_INTERVAL_SECONDS', 30))
+    PREGEN_IDLE_SECONDS = int(os.getenv('PREGEN_IDLE_SECONDS', 20))  # quiet time before spending
+    PREGEN_WINDOW_HOURS = 24
+    PREGEN_MIN_COUNT = 3
+    PREGEN_TOP_N = 20
+    PREGEN_DEPTH = 2  # unclaimed renders kept per pair
+    PREGEN_TTL_HOURS = 48
+    PREGEN_LEASE_SECONDS = int(os.getenv('PREGEN_LEASE_SECONDS', 300))  # longer than one render
+    
+    # Progressive generation: a quick low-step draft first, full render in the background
+    DRAFT_STEPS = int(os.getenv('DRAFT_STEPS', 10))
+    REFINE_WORKERS = int(os.getenv('REFINE_WORKERS', 4))
+    # A refine still pending after this long was lost with its process
+    REFINE_STALE_MINUTES = int(os.getenv('REFINE_STALE_MINUTES', 15))
+    
+    # On-demand profiling of live workers through /api/admin/profiles. Job
+    # files live under PROFILE_ROOT, which must be shared by every worker
+    PROFILE_ROOT = os.getenv('PROFILE_ROOT', os.path.join(tempfile.gettempdir(), 'ai-image-generator-profiles'))
+    PROFILE_POLL_SECONDS = 1  # how often a worker looks for queued jobs
+    PROFILE_SAMPLE_INTERVAL_MS = int(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', 10))
+    PROFILE_DEFAULT_SECONDS = 30
+    PROFILE_MAX_SECONDS = 300
+    PROFILE_MAX_REQUESTS = 100
+    PROFILE_TTL_DAYS = 7
+    
+    # Hot/cold tiering: inline images untouched for TIER_AFTER_DAYS that are
+    # not favorited, in a collection or still refining move to the compressed
+    # archive and leave an archive:// stub that is rehydrated on access
+    TIER_AFTER_DAYS = int(os.getenv('TIER_AFTER_DAYS', 30))
+    TIER_BATCH_SIZE = 200
+    # Images kept per user by plan, oldest unprotected deleted first (None = unlimited)
+    RETENTION_MAX_IMAGES = {
+        'free': int(os.getenv('RETENTION_MAX_IMAGES_FREE', 0)) or None,
+        'pro': None,
+    }
+    
+    # Usage rollups for /api/admin/analytics, folded in by a background job
+    # every ROLLUP_INTERVAL_SECONDS (0 disables it; `flask rollup-usage` still works)
+    ROLLUP_INTERVAL_SECONDS = int(os.getenv('ROLLUP_INTERVAL_SECONDS', 60))
+    ROLLUP_BATCH_SIZE = 1000
+    ROLLUP_SETTLE_SECONDS = 5  # rows this fresh wait for the next run
+    ROLLUP_HOURLY_SERIES_DAYS = 2  # longer ranges default to a daily series
+    ROLLUP_MAX_HOURLY_DAYS = 31
+    
+    # Provider health: every worker ticks every HEALTH_TICK_SECONDS to reload the
+    # shared state; the one holding the lease also probes Gemini and each
+    # Stability engine (0 disables the supervisor; providers are then assumed up)
+    HEALTH_TICK_SECONDS = int(os.getenv('HEALTH_TICK_SECONDS', 5))
+    HEALTH_PROBE_INTERVAL_SECONDS = int(os.getenv('HEALTH_PROBE_INTERVAL_SECONDS', 30))
+    HEALTH_BACKOFF_BASE_SECONDS = 5  # first retry of a down provider, doubling per failure
+    HEALTH_BACKOFF_MAX_SECONDS = 600
+    HEALTH_PROBE_TIMEOUT_SECONDS = 5
+    HEALTH_LEASE_SECONDS = 30  # supervisor lease; another worker takes over once it lapses
+    
+    # Provider traffic cassettes for offline performance testing (utils/cassette.py):
+    # 'record' appends sanitized Stability/Gemini exchanges with their timings
+    # to PROVIDER_CASSETTE_DIR, 'replay' answers from them without the network
+    PROVIDER_CASSETTE_MODE = os.getenv('PROVIDER_CASSETTE_MODE', 'off')
+    PROVIDER_CASSETTE_DIR = os.getenv(
+        'PROVIDER_CASSETTE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cassettes')
+    )
+    PROVIDER_CASSETTE_KEEP_PROMPTS = os.getenv('PROVIDER_CASSETTE_KEEP_PROMPTS', 'false').lower() == 'true'
+    # Replay timing: 'recorded', 'zero', or a multiplier of the recorded delays such as 0.5
+    PROVIDER_REPLAY_LATENCY = os.getenv('PROVIDER_REPLAY_LATENCY', 'recorded')
+    
+    # Vocabulary for the rule-based prompt enhancer used when Gemini/Stability are unavailable
+    PROMPT_VOCABULARY_PATH = os.getenv(
+        'PROMPT_VOCABULARY_PATH',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'prompt_vocabulary.json')
+    )
+    PROMPT_ENHANCER_CACHE_SIZE = 4096
\ No newline at end of file
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta, timezone
+from flask import request, jsonify, current_app
+from services.rollup_service import RollupService
+from utils.decorators import validate_json
+from utils.profiler import profiler
+from utils.log import get_logger
+
+log = get_logger('admin')
+
+class AdminController:
+    @staticmethod
+    def _parse_time(value, name):
+        """ISO 8601 date or datetime as naive UTC, or None when absent"""
+        if not value:
+            return None
+        try:
+            moment = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+        except ValueError:
+            raise ValueError(f'{name} must be an ISO 8601 date or datetime')
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+        return moment
+
+    @staticmethod
+    def get_analytics():
+        try:
+            end = AdminController._parse_time(request.args.get('end'), 'end') or datetime.utcnow()
+            start = AdminController._parse_time(request.args.get('start'), 'start') or end - timedelta(days=7)
+            return jsonify(RollupService.analytics(start, end, request.args.get('granularity')))
+
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            log.error('analytics_failed', error=str(e))
+            return jsonify({'error': 'Failed to load analytics'}), 500
+
+    @staticmethod
+    @validate_json
+    def create_profile():
+        try:
+            data = request.get_json()
+            job = profiler.submit(
+                data.get('mode', 'sample'),
+                seconds=data.get('seconds'),
+                requests=data.get('requests'),
+                route=data.get('route'),
+                worker=data.get('worker')
+            )
+            return jsonify({'message': 'Profile queued', 'job': job}), 202
+
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            log.error('create_profile_failed', error=str(e))
+            return jsonify({'error': 'Failed to queue profile'}), 500
+
+    @staticmethod
+    def list_profiles():
+        try:
+            return jsonify({
+                'worker': profiler.pid,
+                'workers': profiler.workers(),
+                'jobs': profiler.jobs()
+            })
+        except Exception as e:
+            log.error('list_profiles_failed', error=str(e))
+            return jsonify({'error': 'Failed to list profiles'}), 500
+
+    @staticmethod
+    def get_profile(job_id):
+        """Job status as JSON, or its output with ?format=folded (flame graph input) or ?format=pstats"""
+        job = profiler.load_job(job_id)
+        if job is None:
+            return jsonify({'error': 'Profile not found'}), 404
+
+        output_format = request.args.get('format')
+        if not output_format:
+            return jsonify({'job': job})
+        if output_format not in ('folded', 'pstats'):
+            return jsonify({'error': 'format must be folded or pstats'}), 400
+        if job['status'] != 'done':
+            return jsonify({'error': f"Profile is {job['status']}", 'job': job}), 409
+        output = profiler.result(job_id, 'folded' if output_format == 'folded' else 'txt')
+        if output is None:
+            return jsonify({'error': 'No pstats output for sampling profiles'}), 404
+        return current_app.response_class(output, mimetype='text/plain')
@@ -2,6 +2,9 @@ from flask import request, jsonify
 from flask_jwt_extended import create_access_token
 from services.auth_service import AuthService
 from utils.decorators import validate_json
+from utils.log import get_logger
+
+log = get_logger('auth')
 
 class AuthController:
     @staticmethod
@@ -36,7 +39,7 @@ class AuthController:
         except ValueError as e:
             return jsonify({'error': str(e)}), 400
         except Exception as e:
-            print(f"Registration error: {e}")
+            log.error('registration_failed', error=str(e))
             return jsonify({'error': 'Registration failed'}), 500
 
     @staticmethod
@@ -70,7 +73,7 @@ class AuthController:
             })
 
         except Exception as e:
-            print(f"Login error: {e}")
+            log.error('login_failed', error=str(e))
             return jsonify({'error': 'Login failed'}), 500
 
     @staticmethod
@@ -90,5 +93,5 @@ class AuthController:
                 }
             })
         except Exception as e:
-            print(f"Profile error: {e}")
+            log.error('profile_failed', error=str(e))
             return jsonify({'error': 'Failed to get profile'}), 500
\ No newline at end of file
@@ -0,0 +1,171 @@
+from flask import request, jsonify
+from services.collection_service import CollectionService
+from services.image_service import ImageService
+from services.snapshot_service import PublicSnapshotService
+from utils.decorators import validate_json
+from utils.log import get_logger
+
+log = get_logger('collections')
+
+class CollectionController:
+    @staticmethod
+    def _serialize(collection, item_count=None, cover_image_id=None):
+        data = {
+            'id': collection.id,
+            'name': collection.name,
+            'description': collection.description,
+            'is_public': collection.is_public,
+            'created_at': collection.created_at.isoformat(),
+            'updated_at': collection.updated_at.isoformat() if collection.updated_at else None
+        }
+        if item_count is not None:
+            data['item_count'] = item_count
+            data['cover_image_id'] = cover_image_id
+        return data
+
+    @staticmethod
+    def list_collections(user_id):
+        try:
+            rows = CollectionService.list_collections(user_id)
+            return jsonify({
+                'collections': [
+                    CollectionController._serialize(collection, item_count, cover_image_id)
+                    for collection, item_count, cover_image_id in rows
+                ]
+            })
+        except Exception as e:
+            log.error('list_collections_failed', error=str(e))
+            return jsonify({'error': 'Failed to get collections'}), 500
+
+    @staticmethod
+    @validate_json
+    def create_collection(user_id):
+        try:
+            data = request.get_json()
+            name = (data.get('name') or '').strip()
+            if not name:
+                return jsonify({'error': 'Collection name is required'}), 400
+
+            collection = CollectionService.create_collection(
+                user_id,
+                name,
+                description=data.get('description', ''),
+                is_public=bool(data.get('is_public', False))
+            )
+            PublicSnapshotService.collection_changed(collection.id, collection.is_public)
+            return jsonify({
+                'message': 'Collection created',
+                'collection': CollectionController._serialize(collection, 0, None)
+            }), 201
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            log.error('create_collection_failed', error=str(e))
+            return jsonify({'error': 'Failed to create collection'}), 500
+
+    @staticmethod
+    def get_collection(user_id, collection_id):
+        try:
+            page = request.args.get('page', 1, type=int)
+            per_page = min(request.args.get('per_page', 10, type=int), 100)
+
+            collection, images = CollectionService.get_collection_images(
+                user_id, collection_id, page, per_page
+            )
+            urls = ImageService.resolve_image_urls([img.image_url for img, _ in images.items])
+
+            return jsonify({
+                'collection': CollectionController._serialize(collection),
+                'images': [{
+                    'id': img.id,
+                    'original_prompt': img.original_prompt,
+                    'improved_prompt': img.improved_prompt,
+                    'image_url': image_url,
+                    'ai_enhanced': img.ai_enhanced,
+                    'style': img.style,
+                    'created_at': img.created_at.isoformat(),
+                    'added_at': added_at.isoformat()
+                } for (img, added_at), image_url in zip(images.items, urls)],
+                'total': images.total,
+                'pages': images.pages,
+                'current_page': page
+            })
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 404
+        except Exception as e:
+            log.error('get_collection_failed', error=str(e))
+            return jsonify({'error': 'Failed to get collection'}), 500
+
+    @staticmethod
+    @validate_json
+    def update_collection(user_id, collection_id):
+        try:
+            data = request.get_json()
+            name = data.get('name')
+            if name is not None:
+                name = name.strip()
+                if not name:
+                    return jsonify({'error': 'Collection name cannot be empty'}), 400
+
+            collection = CollectionService.update_collection(
+                user_id,
+                collection_id,
+                name=name,
+                description=data.get('description'),
+                is_public=data.get('is_public')
+            )
+            PublicSnapshotService.collection_changed(collection.id, collection.is_public)
+            return jsonify({
+                'message': 'Collection updated',
+                'collection': CollectionController._serialize(collection)
+            })
+        except ValueError as e:
+            status = 404 if str(e) == 'Collection not found' else 400
+            return jsonify({'error': str(e)}), status
+        except Exception as e:
+            log.error('update_collection_failed', error=str(e))
+            return jsonify({'error': 'Failed to update collection'}), 500
+
+    @staticmethod
+    def delete_collection(user_id, collection_id):
+        try:
+            CollectionService.delete_collection(user_id, collection_id)
+            PublicSnapshotService.collection_changed(collection_id)
+            return jsonify({'message': 'Collection deleted'})
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 404
+        except Exception as e:
+            log.error('delete_collection_failed', error=str(e))
+            return jsonify({'error': 'Failed to delete collection'}), 500
+
+    @staticmethod
+    @validate_json
+    def add_images(user_id, collection_id):
+        try:
+            data = request.get_json()
+            added = CollectionService.add_images(user_id, collection_id, data.get('image_ids'))
+            if added:
+                PublicSnapshotService.collection_changed(collection_id)
+            return jsonify({'message': 'Images added to collection', 'added': added})
+        except ValueError as e:
+            status = 404 if str(e) == 'Collection not found' else 400
+            return jsonify({'error': str(e)}), status
+        except Exception as e:
+            log.error('add_to_collection_failed', error=str(e))
+            return jsonify({'error': 'Failed to add images to collection'}), 500
+
+    @staticmethod
+    @validate_json
+    def remove_images(user_id, collection_id):
+        try:
+            data = request.get_json()
+            removed = CollectionService.remove_images(user_id, collection_id, data.get('image_ids'))
+            if removed:
+                PublicSnapshotService.collection_changed(collection_id)
+            return jsonify({'message': 'Images removed from collection', 'removed': removed})
+        except ValueError as e:
+            status = 404 if str(e) == 'Collection not found' else 400
+            return jsonify({'error': str(e)}), status
+        except Exception as e:
+            log.error('remove_from_collection_failed', error=str(e))
+            return jsonify({'error': 'Failed to remove images from collection'}), 500
@@ -1,7 +1,16 @@
-from flask import request, jsonify
+from datetime import datetime
+from flask import request, jsonify, current_app, Response, stream_with_context
+from config import Config
 from services.image_service import ImageService
+from services.search_service import SearchService
+from services.export_service import ExportService
+from services.generation_service import GenerationService, GenerationRejected
 from services.gemini_service import GeminiService
 from utils.decorators import validate_json, jwt_required_custom
+from utils import tracing
+from utils.log import get_logger
+
+log = get_logger('images')
 
 gemini_service = GeminiService()
 
@@ -9,49 +18,17 @@ class ImageController:
     @staticmethod
     @jwt_required_custom
     @validate_json
+    @tracing.traced()
     def generate_image(user_id):
         try:
-            data = request.get_json()
-            prompt = data.get('prompt', '').strip()
-            style = data.get('style', 'realistic')
-
-            if not prompt:
-                return jsonify({'error': 'Missing prompt'}), 400
-
-            # Improve prompt
-            improved_prompt = gemini_service.improve_prompt(prompt)
-            ai_enhanced = gemini_service.available and gemini_service.can_make_request()
-            
-            # Add style to prompt
-            if style and style != 'realistic':
-                improved_prompt = f"{improved_prompt}, {style} style"
-
-            # Generate image URL
-            image_url = gemini_service.get_image_url(improved_prompt)
-
-            # Save to database
-            image = ImageService.create_image(
-                user_id=user_id,
-                original_prompt=prompt,
-                improved_prompt=improved_prompt,
-                image_url=image_url,
-                ai_enhanced=ai_enhanced,
-                style=style
+            payload = GenerationService.generate(
+                current_app._get_current_object(), gemini_service, user_id, request.get_json()
             )
-
-            return jsonify({
-                'success': True,
-                'original_prompt': prompt,
-                'improved_prompt': improved_prompt,
-                'image_url': image_url,
-                'ai_enhanced': ai_enhanced,
-                'style': style,
-                'gemini_used': ai_enhanced,
-                'image_id': image.id
-            })
-
+            return Response(GenerationService.encode(payload), mimetype='application/json')
+        except GenerationRejected as e:
+            return jsonify(e.payload), e.status, e.headers
         except Exception as e:
-            print(f"Generation error: {e}")
+            log.error('generation_failed', error=str(e))
             return jsonify({'error': str(e)}), 500
 
     @staticmethod
@@ -62,25 +39,142 @@ class ImageController:
             per_page = request.args.get('per_page', 10, type=int)
             
             images = ImageService.get_user_images(user_id, page, per_page)
+            urls = ImageService.resolve_image_urls([img.image_url for img in images.items])
             
             return jsonify({
                 'images': [{
                     'id': img.id,
                     'original_prompt': img.original_prompt,
                     'improved_prompt': img.improved_prompt,
-                    'image_url': img.image_url,
+                    'image_url': image_url,
                     'ai_enhanced': img.ai_enhanced,
                     'style': img.style,
                     'created_at': img.created_at.isoformat()
-                } for img in images.items],
+                } for img, image_url in zip(images.items, urls)],
                 'total': images.total,
                 'pages': images.pages,
                 'current_page': page
             })
         except Exception as e:
-            print(f"Get images error: {e}")
+            log.error('get_images_failed', error=str(e))
             return jsonify({'error': 'Failed to get images'}), 500
 
+    @staticmethod
+    @jwt_required_custom
+    def search_images(user_id):
+        try:
+            query = request.args.get('q', '').strip()
+            cursor = request.args.get('cursor')
+            limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+            
+            rows, next_cursor = SearchService.search_images(user_id, query, cursor, limit)
+            urls = ImageService.resolve_image_urls([row['image_url'] for row in rows])
+            
+            return jsonify({
+                'results': [{
+                    'id': row['id'],
+                    'original_prompt': row['original_prompt'],
+                    'improved_prompt': row['improved_prompt'],
+                    'image_url': image_url,
+                    'ai_enhanced': bool(row['ai_enhanced']),
+                    'style': row['style'],
+                    'created_at': ImageController._isoformat(row['created_at']),
+                    'snippet': row['snippet']
+                } for row, image_url in zip(rows, urls)],
+                'next_cursor': next_cursor
+            })
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            log.error('search_images_failed', error=str(e))
+            return jsonify({'error': 'Failed to search images'}), 500
+
+    @staticmethod
+    @jwt_required_custom
+    def get_image(user_id, image_id):
+        try:
+            image = ImageService.get_image(user_id, image_id)
+            
+            return jsonify({
+                'id': image.id,
+                'original_prompt': image.original_prompt,
+                'improved_prompt': image.improved_prompt,
+                'image_url': ImageService.resolve_image_urls([image.image_url])[0],
+                'ai_enhanced': image.ai_enhanced,
+                'style': image.style,
+                'refine_status': image.refine_status,
+                'created_at': image.created_at.isoformat()
+            })
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 404
+        except Exception as e:
+            log.error('get_image_failed', error=str(e))
+            return jsonify({'error': 'Failed to get image'}), 500
+
+    @staticmethod
+    @jwt_required_custom
+    def get_similar_images(user_id, image_id):
+        try:
+            max_distance = max(0, min(
+                request.args.get('max_distance', Config.SIMILAR_IMAGE_MAX_DISTANCE, type=int), 32
+            ))
+            limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+            
+            image, similar = ImageService.find_similar_images(user_id, image_id, max_distance, limit)
+            urls = ImageService.resolve_image_urls([img.image_url for img, _ in similar])
+            
+            return jsonify({
+                'image_id': image.id,
+                'hashed': image.phash is not None,
+                'similar': [{
+                    'id': img.id,
+                    'original_prompt': img.original_prompt,
+                    'improved_prompt': img.improved_prompt,
+                    'image_url': image_url,
+                    'ai_enhanced': img.ai_enhanced,
+                    'style': img.style,
+                    'created_at': img.created_at.isoformat(),
+                    'distance': distance
+                } for (img, distance), image_url in zip(similar, urls)]
+            })
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 404
+        except Exception as e:
+            log.error('similar_images_failed', error=str(e))
+            return jsonify({'error': 'Failed to find similar images'}), 500
+
+    @staticmethod
+    @jwt_required_custom
+    def export_images(user_id):
+        try:
+            after_id = max(0, request.args.get('cursor', 0, type=int))
+            limit = max(1, min(request.args.get('limit', 500, type=int), 5000))
+            
+            count, next_cursor = ExportService.export_window(user_id, after_id, limit)
+            headers = {
+                'Content-Disposition': f'attachment; filename="gallery-{user_id}-{after_id}.zip"',
+                'X-Export-Count': str(count),
+                'Cache-Control': 'no-store'
+            }
+            if next_cursor is not None:
+                headers['X-Export-Next-Cursor'] = str(next_cursor)
+            
+            return Response(
+                stream_with_context(ExportService.stream_gallery(user_id, after_id, limit, next_cursor)),
+                mimetype='application/zip',
+                headers=headers
+            )
+        except Exception as e:
+            log.error('export_images_failed', error=str(e))
+            return jsonify({'error': 'Failed to export images'}), 500
+
+    @staticmethod
+    def _isoformat(value):
+        # Raw SQL rows come back as 'YYYY-MM-DD HH:MM:SS' strings on SQLite and datetimes elsewhere
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        return value.isoformat() if value is not None else None
+
     @staticmethod
     @jwt_required_custom
     @validate_json
@@ -102,7 +196,7 @@ class ImageController:
         except ValueError as e:
             return jsonify({'error': str(e)}), 400
         except Exception as e:
-            print(f"Favorite error: {e}")
+            log.error('favorite_failed', error=str(e))
             return jsonify({'error': 'Failed to add favorite'}), 500
 
     @staticmethod
@@ -114,7 +208,7 @@ class ImageController:
         except ValueError as e:
             return jsonify({'error': str(e)}), 404
         except Exception as e:
-            print(f"Remove favorite error: {e}")
+            log.error('remove_favorite_failed', error=str(e))
             return jsonify({'error': 'Failed to remove favorite'}), 500
 
     @staticmethod
@@ -125,6 +219,7 @@ class ImageController:
             per_page = request.args.get('per_page', 10, type=int)
             
             favorites = ImageService.get_favorites(user_id, page, per_page)
+            urls = ImageService.resolve_image_urls([fav.image.image_url for fav in favorites.items])
             
             return jsonify({
                 'favorites': [{
@@ -133,19 +228,19 @@ class ImageController:
                         'id': fav.image.id,
                         'original_prompt': fav.image.original_prompt,
                         'improved_prompt': fav.image.improved_prompt,
-                        'image_url': fav.image.image_url,
+                        'image_url': image_url,
                         'ai_enhanced': fav.image.ai_enhanced,
                         'style': fav.image.style,
                         'created_at': fav.image.created_at.isoformat()
                     },
                     'added_at': fav.created_at.isoformat()
-                } for fav in favorites.items],
+                } for fav, image_url in zip(favorites.items, urls)],
                 'total': favorites.total,
                 'pages': favorites.pages,
                 'current_page': page
             })
         except Exception as e:
-            print(f"Get favorites error: {e}")
+            log.error('get_favorites_failed', error=str(e))
             return jsonify({'error': 'Failed to get favorites'}), 500
 
     @staticmethod
@@ -155,5 +250,5 @@ class ImageController:
             stats = ImageService.get_user_stats(user_id)
             return jsonify({'stats': stats})
         except Exception as e:
-            print(f"Stats error: {e}")
+            log.error('stats_failed', error=str(e))
             return jsonify({'error': 'Failed to get statistics'}), 500
\ No newline at end of file
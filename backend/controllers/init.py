@@ -1,4 +1,7 @@
 from .auth_controller import AuthController
 from .image_controller import ImageController
+from .collection_controller import CollectionController
+from .admin_controller import AdminController
+from .public_controller import PublicController
 
-__all__ = ['AuthController', 'ImageController']
\ No newline at end of file
+__all__ = ['AuthController', 'ImageController', 'CollectionController', 'AdminController', 'PublicController']
\ No newline at end of file
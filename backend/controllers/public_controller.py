@@ -0,0 +1,41 @@
+from flask import request, jsonify, current_app
+from config import Config
+from services.snapshot_service import collection_key, feed_key, load_object, read_ref, snapshot_url
+
+class PublicController:
+    """Anonymous, read-only views served from precomputed snapshots; no JWT, no database"""
+
+    @staticmethod
+    def _snapshot_response(digest, immutable=False):
+        body = load_object(digest) if digest else None
+        if body is None:
+            return None
+        response = current_app.response_class(body, mimetype='application/json')
+        response.set_etag(digest)
+        if immutable:
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response.headers['Cache-Control'] = f'public, max-age={Config.SNAPSHOT_MAX_AGE}'
+            response.headers['Content-Location'] = snapshot_url(digest)
+        return response.make_conditional(request)
+
+    @staticmethod
+    def _page():
+        page = request.args.get('page', 1, type=int)
+        return page if page and page > 0 else 1
+
+    @staticmethod
+    def get_feed():
+        response = PublicController._snapshot_response(read_ref(feed_key(PublicController._page())))
+        return response or (jsonify({'error': 'Page not found'}), 404)
+
+    @staticmethod
+    def get_collection(collection_id):
+        digest = read_ref(collection_key(collection_id, PublicController._page()))
+        response = PublicController._snapshot_response(digest)
+        return response or (jsonify({'error': 'Collection not found'}), 404)
+
+    @staticmethod
+    def get_snapshot(digest):
+        response = PublicController._snapshot_response(digest, immutable=True)
+        return response or (jsonify({'error': 'Snapshot not found'}), 404)
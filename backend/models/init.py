@@ -1,3 +1,3 @@
-from .models import db, User, GeneratedImage, Favorite, Collection, CollectionItem
+from .models import db, User, GeneratedImage, Favorite, Collection, CollectionItem, RateLimitBucket, PregeneratedImage, PregenerationSpend, ArchivedImage, UsageRollup, EngineRollup, RollupWatermark, JobCheckpoint, ProviderHealth, ServiceLease, SnapshotRebuild, ensure_schema
 
-__all__ = ['db', 'User', 'GeneratedImage', 'Favorite', 'Collection', 'CollectionItem']
\ No newline at end of file
+__all__ = ['db', 'User', 'GeneratedImage', 'Favorite', 'Collection', 'CollectionItem', 'RateLimitBucket', 'PregeneratedImage', 'PregenerationSpend', 'ArchivedImage', 'UsageRollup', 'EngineRollup', 'RollupWatermark', 'JobCheckpoint', 'ProviderHealth', 'ServiceLease', 'SnapshotRebuild', 'ensure_schema']
\ No newline at end of file
@@ -1,5 +1,6 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from config import Config
 
 db = SQLAlchemy()
 
@@ -12,6 +13,8 @@ class User(db.Model):
     password = db.Column(db.String(255), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime)
+    plan = db.Column(db.String(20), default='free')
+    is_admin = db.Column(db.Boolean, default=False)
     
     # Relationships
     images = db.relationship('GeneratedImage', backref='user', lazy=True, cascade='all, delete-orphan')
@@ -29,6 +32,15 @@ class GeneratedImage(db.Model):
     ai_enhanced = db.Column(db.Boolean, default=False)
     style = db.Column(db.String(100), default='realistic')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # 64-bit dHash of the decoded image and SHA-256 of its stored payload
+    phash = db.Column(db.BigInteger, index=True)
+    content_hash = db.Column(db.String(64))
+    # 'pending' while a progressive draft waits for its full render, then 'done' or 'failed'
+    refine_status = db.Column(db.String(20))
+    # Set when an archived payload is restored, so tiering waits another full period
+    rehydrated_at = db.Column(db.DateTime)
+    
+    __table_args__ = (db.Index('ix_generated_images_user_content_hash', 'user_id', 'content_hash'),)
     
     # Relationships
     favorites = db.relationship('Favorite', backref='image', lazy=True, cascade='all, delete-orphan')
@@ -62,4 +74,136 @@ class CollectionItem(db.Model):
     image_id = db.Column(db.Integer, db.ForeignKey('generated_images.id'), nullable=False)
     added_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    __table_args__ = (db.UniqueConstraint('collection_id', 'image_id', name='unique_collection_image'),)
\ No newline at end of file
+    __table_args__ = (
+        db.UniqueConstraint('collection_id', 'image_id', name='unique_collection_image'),
+        # Covers the "page through a collection" query without touching the table
+        db.Index('ix_collection_items_collection_added', 'collection_id', 'added_at', 'image_id'),
+    )
+
+
+class RateLimitBucket(db.Model):
+    __tablename__ = 'rate_limit_buckets'
+    
+    # Token bucket per user, shared by every worker through the database
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)  # unix time of last refill
+
+class PregeneratedImage(db.Model):
+    __tablename__ = 'pregenerated_images'
+    
+    # Speculative renders of trending prompts, claimed once by a matching request
+    id = db.Column(db.Integer, primary_key=True)
+    prompt_key = db.Column(db.String(40), nullable=False)  # sha1 of normalized prompt + style
+    original_prompt = db.Column(db.Text, nullable=False)
+    improved_prompt = db.Column(db.Text, nullable=False)
+    image_url = db.Column(db.Text, nullable=False)
+    ai_enhanced = db.Column(db.Boolean, default=False)
+    style = db.Column(db.String(100), default='realistic')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    served_at = db.Column(db.DateTime)
+    
+    __table_args__ = (db.Index('ix_pregenerated_images_key_served', 'prompt_key', 'served_at'),)
+
+class PregenerationSpend(db.Model):
+    __tablename__ = 'pregeneration_spend'
+    
+    # Speculative renders started per UTC day; kept apart from pregenerated_images, whose claimed rows are pruned
+    day = db.Column(db.Date, primary_key=True)
+    renders = db.Column(db.Integer, nullable=False, default=0)
+
+class ArchivedImage(db.Model):
+    __tablename__ = 'archived_images'
+    __bind_key__ = 'cold' if Config.COLD_DATABASE_URL else None
+    
+    # Cold tier: the payload of a generated_images row whose image_url is now archive://<id>
+    image_id = db.Column(db.Integer, primary_key=True)  # no FK, the table may live in another database
+    header = db.Column(db.String(100), nullable=False)  # e.g. 'data:image/png;base64'
+    data = db.Column(db.LargeBinary, nullable=False)  # zlib-compressed decoded bytes
+    original_size = db.Column(db.Integer, nullable=False)  # length of the data URL it replaced
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UsageRollup(db.Model):
+    __tablename__ = 'usage_rollups'
+    
+    # Generations per hour/day bucket and style, folded in from generated_images
+    granularity = db.Column(db.String(5), primary_key=True)  # 'hour' or 'day'
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    style = db.Column(db.String(100), primary_key=True)
+    generations = db.Column(db.Integer, nullable=False, default=0)
+    ai_enhanced = db.Column(db.Integer, nullable=False, default=0)
+    placeholders = db.Column(db.Integer, nullable=False, default=0)  # fallback stock images
+
+class EngineRollup(db.Model):
+    __tablename__ = 'engine_rollups'
+    
+    # Stability engine attempts per hour/day bucket, flushed from in-process counters
+    granularity = db.Column(db.String(5), primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    engine = db.Column(db.String(64), primary_key=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    successes = db.Column(db.Integer, nullable=False, default=0)
+
+class RollupWatermark(db.Model):
+    __tablename__ = 'rollup_watermarks'
+    
+    # Highest source row id already folded into a rollup
+    name = db.Column(db.String(50), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+
+class JobCheckpoint(db.Model):
+    __tablename__ = 'job_checkpoints'
+    
+    # How far a resumable offline job got, e.g. 'bulk:<user>:<input hash>'
+    name = db.Column(db.String(80), primary_key=True)
+    position = db.Column(db.Integer, nullable=False, default=0)  # items done, in input order
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ProviderHealth(db.Model):
+    __tablename__ = 'provider_health'
+    
+    # Upstream provider state written by the health supervisor and read by every worker
+    provider = db.Column(db.String(80), primary_key=True)  # 'gemini', 'stability', 'stability:<engine>'
+    status = db.Column(db.String(10), nullable=False)  # 'up' or 'down'
+    failures = db.Column(db.Integer, nullable=False, default=0)  # consecutive, drives the backoff
+    last_error = db.Column(db.String(500))
+    checked_at = db.Column(db.Float)  # unix times, like rate_limit_buckets
+    next_probe_at = db.Column(db.Float, nullable=False, default=0)
+    changed_at = db.Column(db.Float)
+
+class ServiceLease(db.Model):
+    __tablename__ = 'service_leases'
+    
+    # Time-limited lock electing one process for a job every worker could run
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(120), nullable=False)
+    expires_at = db.Column(db.Float, nullable=False)
+
+class SnapshotRebuild(db.Model):
+    __tablename__ = 'snapshot_rebuilds'
+    
+    # Collections whose public pages are stale, drained by the snapshot job
+    collection_id = db.Column(db.Integer, primary_key=True)  # no FK: deleted collections are unpublished
+    requested_at = db.Column(db.Float, nullable=False)  # latest write, so a rebuild never drops a newer one
+
+def ensure_schema():
+    """Add columns and indexes declared on models that existing tables lack.
+
+    db.create_all() skips tables that already exist, so anything added to a
+    model later would never reach a deployed database without this. New
+    columns must be nullable (or have a server default) to be added here.
+    """
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    conn.execute(db.text(
+                        f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                    ))
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
\ No newline at end of file
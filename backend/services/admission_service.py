@@ -0,0 +1,122 @@
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from sqlalchemy import case
+from sqlalchemy.exc import IntegrityError
+from config import Config
+from models.models import db, User, RateLimitBucket
+from utils import tracing
+
+
+class AdmissionService:
+    @staticmethod
+    def quota_for(plan):
+        return Config.PLAN_QUOTAS.get(plan or 'free', Config.PLAN_QUOTAS['free'])
+
+    @staticmethod
+    @tracing.traced()
+    def admit(user_id, cost=1):
+        """Take `cost` tokens from the user's bucket.
+
+        Returns (allowed, retry_after_seconds, plan). The refill and the
+        take happen in one conditional UPDATE, so concurrent requests from
+        different workers can never overdraw a bucket.
+        """
+        plan = db.session.query(User.plan).filter_by(id=user_id).scalar() or 'free'
+        quota = AdmissionService.quota_for(plan)
+        rate = quota['per_hour'] / 3600.0
+        burst = float(quota['burst'])
+
+        for _ in range(2):
+            now = time.time()
+            bucket = RateLimitBucket.__table__.c
+            accrued = bucket.tokens + (now - bucket.updated_at) * rate
+            refilled = case((accrued > burst, burst), else_=accrued)
+
+            result = db.session.execute(
+                RateLimitBucket.__table__.update()
+                .where(bucket.user_id == user_id, refilled >= cost)
+                .values(tokens=refilled - cost, updated_at=now)
+            )
+            if result.rowcount:
+                db.session.commit()
+                return True, 0, plan
+
+            row = db.session.query(RateLimitBucket.tokens, RateLimitBucket.updated_at)\
+                .filter_by(user_id=user_id)\
+                .first()
+            if row is None:
+                try:
+                    db.session.add(RateLimitBucket(user_id=user_id, tokens=burst - cost, updated_at=now))
+                    db.session.commit()
+                    return True, 0, plan
+                except IntegrityError:
+                    # Another worker created the bucket first; retry the update
+                    db.session.rollback()
+                    continue
+
+            db.session.rollback()
+            tokens = min(burst, row.tokens + (now - row.updated_at) * rate)
+            retry_after = (cost - tokens) / rate if rate > 0 else 3600
+            return False, max(retry_after, 1), plan
+
+        return False, 1, plan
+
+
+class FairShareQueue:
+    """Weighted fair queuing over a fixed number of upstream slots.
+
+    Each waiting request gets a virtual finish tag of
+    max(virtual_time, user's last tag) + 1 / weight, and free slots go to
+    the smallest tag. A user with many queued requests therefore takes
+    turns with everyone else instead of draining capacity first-come
+    first-served, and higher-weight plans get proportionally more turns.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_use = 0
+        self.virtual_time = 0.0
+        self.last_finish = {}
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    def _tag(self, user_id, weight):
+        start = max(self.virtual_time, self.last_finish.get(user_id, 0.0))
+        finish = start + 1.0 / max(weight, 1e-6)
+        self.last_finish[user_id] = finish
+        return start, finish
+
+    def _dispatch(self):
+        while self.in_use < self.capacity and self.waiting:
+            finish, _, start, future = heapq.heappop(self.waiting)
+            if future.done():  # waiter gave up (client disconnected)
+                continue
+            self.in_use += 1
+            self.virtual_time = max(self.virtual_time, start)
+            future.set_result(None)
+        if not self.waiting and self.in_use == 0:
+            # Idle: forget history so returning users aren't penalised
+            self.last_finish.clear()
+            self.virtual_time = 0.0
+
+    @asynccontextmanager
+    async def slot(self, user_id, weight=1.0):
+        start, finish = self._tag(user_id, weight)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (finish, next(self.sequence), start, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.in_use -= 1
+                self._dispatch()
+            raise
+        try:
+            yield
+        finally:
+            self.in_use -= 1
+            self._dispatch()
@@ -0,0 +1,236 @@
+import csv
+import io
+import json
+import time
+import hashlib
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import insert, update
+from config import Config
+from models.models import db, GeneratedImage, JobCheckpoint
+from services.admission_service import AdmissionService
+from services.health_service import HealthSupervisor, health
+from services.image_hash import compute_hashes
+from services.rollup_service import RollupService
+from services.stability_service_clean import StabilityAIService
+from utils.log import get_logger
+
+log = get_logger('bulk')
+
+
+def parse_prompts(text, fmt=None, style='realistic'):
+    """Items ({'prompt', 'style', and optionally steps, cfg_scale, size}) from JSONL or CSV text.
+
+    JSONL lines are objects with a "prompt" key, or bare strings. CSV needs
+    a `prompt` header; text without one is read as one prompt per line.
+    Blank prompts are skipped. fmt is 'jsonl' or 'csv', guessed from the
+    first character when None. Malformed JSONL lines are reported by
+    number before anything is spent.
+    """
+    stripped = text.lstrip()
+    if fmt is None:
+        fmt = 'jsonl' if stripped[:1] in ('{', '"') else 'csv'
+    items = []
+    if fmt == 'jsonl':
+        for line_number, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"line {line_number}: {e}")
+            item = {'prompt': item} if isinstance(item, str) else item
+            if not isinstance(item, dict) or not str(item.get('prompt') or '').strip():
+                raise ValueError(f"line {line_number}: expected an object with a prompt")
+            items.append(item)
+    else:
+        rows = list(csv.reader(io.StringIO(text)))
+        header = [column.strip().lower() for column in rows[0]] if rows else []
+        if 'prompt' in header:
+            rows = [dict(zip(header, row)) for row in rows[1:]]
+        else:
+            rows = [{'prompt': line} for line in text.splitlines()]
+        for row in rows:
+            if not (row.get('prompt') or '').strip():
+                continue
+            items.append({key: value for key, value in row.items() if value not in (None, '')})
+
+    for item in items:
+        item['prompt'] = str(item['prompt']).strip()
+        item['style'] = item.get('style') or style
+    return items
+
+
+def job_name(user_id, text):
+    """Checkpoint name for an input: rerunning the same file for the same user resumes it"""
+    return f"{user_id}:{hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]}"
+
+
+class BulkGenerationService:
+    """Offline generation of many prompts, outside the web workers.
+
+    Prompts go through the same Gemini and Stability services as
+    /api/generate, BULK_CONCURRENCY at a time on a thread pool. Each
+    render is started no faster than BULK_REQUESTS_PER_SECOND and only
+    once the owner's token bucket admits it, the same bucket the live
+    workers draw from, so a run never takes more than the user's plan.
+    Starts also pause while the shared health state has Stability down.
+
+    Results are inserted BULK_BATCH_SIZE at a time, in input order, and
+    the checkpoint (a job_checkpoints row holding the next item) moves
+    in the same transaction, so a rerun picks up exactly where the last
+    committed batch ended. Unlike the live path nothing falls back to a
+    placeholder: a prompt no engine rendered is reported as failed.
+    """
+
+    @staticmethod
+    def _checkpoint_name(job):
+        return f"bulk:{job}"
+
+    @staticmethod
+    def checkpoint(job):
+        """Items already done for a job"""
+        row = db.session.get(JobCheckpoint, BulkGenerationService._checkpoint_name(job))
+        return row.position if row else 0
+
+    @staticmethod
+    def _render(gemini, item):
+        """Pool worker: improve and render one item; returns a generated_images row or an error"""
+        try:
+            options = StabilityAIService.generation_options(item)
+            improved_prompt, ai_enhanced = gemini.improve_prompt(item['prompt'])
+            if item['style'] != 'realistic':
+                improved_prompt = f"{improved_prompt}, {item['style']} style"
+            image_url = gemini.image_service.render_image(improved_prompt, options=options)
+            if not image_url:
+                return {'error': 'No engine rendered the prompt'}
+            phash, content_hash = compute_hashes(image_url)
+            return {'row': {
+                'original_prompt': item['prompt'],
+                'improved_prompt': improved_prompt,
+                'image_url': image_url,
+                'ai_enhanced': ai_enhanced,
+                'style': item['style'],
+                'phash': phash,
+                'content_hash': content_hash
+            }}
+        except Exception as e:
+            return {'error': str(e)}
+
+    @staticmethod
+    def _save(job, user_id, rows, saved_through, done_through):
+        """Insert a batch and advance the checkpoint in one transaction"""
+        if rows:
+            db.session.execute(insert(GeneratedImage), [dict(row, user_id=user_id) for row in rows])
+        advanced = db.session.execute(
+            update(JobCheckpoint)
+            .where(JobCheckpoint.name == BulkGenerationService._checkpoint_name(job),
+                   JobCheckpoint.position == saved_through)
+            .values(position=done_through, updated_at=datetime.utcnow())
+        )
+        if not advanced.rowcount:
+            db.session.rollback()
+            raise RuntimeError(f"Job {job} was advanced by another run; stopping this one")
+        db.session.commit()
+
+    @staticmethod
+    def _admit(user_id, progress):
+        """Block until Stability is up and the user's bucket has a token"""
+        refreshed_at = 0.0
+        while True:
+            if Config.HEALTH_TICK_SECONDS > 0 and time.time() - refreshed_at >= Config.HEALTH_TICK_SECONDS:
+                HealthSupervisor.refresh()
+                refreshed_at = time.time()
+            if not health.is_up('stability'):
+                progress(f"Stability is down ({health.providers['stability']['last_error']}), waiting")
+                time.sleep(max(Config.HEALTH_TICK_SECONDS, 1))
+                continue
+            allowed, retry_after, plan = AdmissionService.admit(user_id)
+            if allowed:
+                return
+            progress(f"Quota for the {plan} plan used up, next token in {retry_after:.0f}s")
+            time.sleep(min(retry_after, 60))
+
+    @staticmethod
+    def run(items, user_id, job, gemini, concurrency=None, batch_size=None, rate=None, restart=False,
+            progress=print, on_failure=None):
+        """Generate every item not yet checkpointed for this job; returns a throughput report.
+
+        on_failure(index, item, error) is called for each prompt that produced no image.
+        """
+        concurrency = concurrency or Config.BULK_CONCURRENCY
+        batch_size = batch_size or Config.BULK_BATCH_SIZE
+        rate = rate or Config.BULK_REQUESTS_PER_SECOND
+        name = BulkGenerationService._checkpoint_name(job)
+        if restart:
+            JobCheckpoint.query.filter_by(name=name).delete(synchronize_session=False)
+        if db.session.get(JobCheckpoint, name) is None:
+            db.session.add(JobCheckpoint(name=name, position=0))
+        db.session.commit()
+
+        start = saved_through = done_through = BulkGenerationService.checkpoint(job)
+        stats = {'total': len(items), 'skipped': start, 'generated': 0, 'failed': 0}
+        started = time.time()
+        next_start = started
+        batch = []
+        window = deque()  # (index, future), in input order
+        next_index = start
+        pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bulk')
+
+        def collect(index, result):
+            nonlocal done_through
+            if 'error' in result:
+                stats['failed'] += 1
+                log.warning('item_failed', index=index, error=result['error'])
+                if on_failure:
+                    on_failure(index, items[index], result['error'])
+            else:
+                batch.append(result['row'])
+                stats['generated'] += 1
+            done_through = index + 1
+
+        def save():
+            nonlocal saved_through
+            BulkGenerationService._save(job, user_id, batch, saved_through, done_through)
+            batch.clear()
+            saved_through = done_through
+            elapsed = max(time.time() - started, 1e-6)
+            progress(f"Saved through item {done_through}/{len(items)}: {stats['generated']} generated, "
+                     f"{stats['failed']} failed ({stats['generated'] / elapsed * 60:.1f} images/min)")
+
+        try:
+            while next_index < len(items) or window:
+                # Keep the pool fed a little ahead so a slow item at the head doesn't idle it
+                while next_index < len(items) and len(window) < concurrency * 2:
+                    BulkGenerationService._admit(user_id, progress)
+                    wait = next_start - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+                    next_start = max(next_start, time.time()) + 1 / rate
+                    window.append((next_index, pool.submit(BulkGenerationService._render, gemini, items[next_index])))
+                    next_index += 1
+                index, future = window.popleft()
+                collect(index, future.result())
+                if done_through - saved_through >= batch_size or (not window and next_index >= len(items)):
+                    save()
+        except KeyboardInterrupt:
+            # Keep whatever already finished in order; the rest is redone on the next run
+            while window and window[0][1].done():
+                index, future = window.popleft()
+                collect(index, future.result())
+            if done_through > saved_through:
+                save()
+            stats['interrupted'] = True
+        finally:
+            pool.shutdown(wait=not stats.get('interrupted'), cancel_futures=True)
+            RollupService.flush_engine_attempts()
+
+        elapsed = time.time() - started
+        stats.update(
+            done=done_through,
+            seconds=round(elapsed, 1),
+            images_per_minute=round(stats['generated'] / elapsed * 60, 1) if elapsed else None
+        )
+        log.info('finished', job=job, **stats)
+        return stats
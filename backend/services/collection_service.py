@@ -0,0 +1,153 @@
+from datetime import datetime
+from sqlalchemy import desc, func, select, literal, and_
+from models.models import db, GeneratedImage, Collection, CollectionItem
+
+MAX_BULK_IMAGES = 500
+
+class CollectionService:
+    @staticmethod
+    def create_collection(user_id, name, description='', is_public=False):
+        existing = Collection.query.filter_by(user_id=user_id, name=name).first()
+        if existing:
+            raise ValueError('Collection with this name already exists')
+
+        collection = Collection(
+            user_id=user_id,
+            name=name,
+            description=description,
+            is_public=is_public
+        )
+        db.session.add(collection)
+        db.session.commit()
+        return collection
+
+    @staticmethod
+    def get_collection(user_id, collection_id):
+        collection = Collection.query.filter_by(id=collection_id, user_id=user_id).first()
+        if not collection:
+            raise ValueError('Collection not found')
+        return collection
+
+    @staticmethod
+    def update_collection(user_id, collection_id, name=None, description=None, is_public=None):
+        collection = CollectionService.get_collection(user_id, collection_id)
+
+        if name is not None and name != collection.name:
+            if Collection.query.filter_by(user_id=user_id, name=name).first():
+                raise ValueError('Collection with this name already exists')
+            collection.name = name
+        if description is not None:
+            collection.description = description
+        if is_public is not None:
+            collection.is_public = bool(is_public)
+
+        db.session.commit()
+        return collection
+
+    @staticmethod
+    def delete_collection(user_id, collection_id):
+        collection = CollectionService.get_collection(user_id, collection_id)
+        CollectionItem.query.filter_by(collection_id=collection.id).delete(synchronize_session=False)
+        db.session.delete(collection)
+        db.session.commit()
+        return True
+
+    @staticmethod
+    def list_collections(user_id):
+        """Return (collection, item_count, cover_image_id) rows in one grouped query.
+
+        The cover is the most recently added image; only its id is
+        returned so the listing never drags base64 payloads along.
+        """
+        cover = select(CollectionItem.image_id)\
+            .where(CollectionItem.collection_id == Collection.id)\
+            .order_by(desc(CollectionItem.added_at), desc(CollectionItem.id))\
+            .limit(1)\
+            .correlate(Collection)\
+            .scalar_subquery()
+        return db.session.query(
+                Collection,
+                func.count(CollectionItem.id).label('item_count'),
+                cover.label('cover_image_id')
+            )\
+            .outerjoin(CollectionItem, CollectionItem.collection_id == Collection.id)\
+            .filter(Collection.user_id == user_id)\
+            .group_by(Collection.id)\
+            .order_by(desc(Collection.updated_at))\
+            .all()
+
+    @staticmethod
+    def get_collection_images(user_id, collection_id, page=1, per_page=10):
+        collection = CollectionService.get_collection(user_id, collection_id)
+        # Ordered by (collection_id, added_at) so the covering index drives the scan
+        images = db.session.query(GeneratedImage, CollectionItem.added_at)\
+            .join(CollectionItem, CollectionItem.image_id == GeneratedImage.id)\
+            .filter(CollectionItem.collection_id == collection.id)\
+            .order_by(desc(CollectionItem.added_at))\
+            .paginate(page=page, per_page=per_page, error_out=False)
+        return collection, images
+
+    @staticmethod
+    def add_images(user_id, collection_id, image_ids):
+        """Add many images with a single INSERT ... SELECT.
+
+        Images that don't belong to the user or are already in the
+        collection are skipped by the SELECT itself. Returns the number of
+        rows inserted.
+        """
+        image_ids = CollectionService._clean_image_ids(image_ids)
+        collection = CollectionService.get_collection(user_id, collection_id)
+        now = datetime.utcnow()
+
+        candidates = select(
+                literal(collection.id),
+                GeneratedImage.id,
+                literal(now)
+            )\
+            .where(
+                GeneratedImage.user_id == user_id,
+                GeneratedImage.id.in_(image_ids),
+                ~select(CollectionItem.id).where(and_(
+                    CollectionItem.collection_id == collection.id,
+                    CollectionItem.image_id == GeneratedImage.id
+                )).exists()
+            )
+
+        result = db.session.execute(
+            CollectionItem.__table__.insert().from_select(
+                ['collection_id', 'image_id', 'added_at'], candidates
+            )
+        )
+        if result.rowcount:
+            collection.updated_at = now
+        db.session.commit()
+        return result.rowcount
+
+    @staticmethod
+    def remove_images(user_id, collection_id, image_ids):
+        """Remove many images with a single DELETE. Returns rows removed."""
+        image_ids = CollectionService._clean_image_ids(image_ids)
+        collection = CollectionService.get_collection(user_id, collection_id)
+
+        result = db.session.execute(
+            CollectionItem.__table__.delete().where(
+                CollectionItem.collection_id == collection.id,
+                CollectionItem.image_id.in_(image_ids)
+            )
+        )
+        if result.rowcount:
+            collection.updated_at = datetime.utcnow()
+        db.session.commit()
+        return result.rowcount
+
+    @staticmethod
+    def _clean_image_ids(image_ids):
+        if not isinstance(image_ids, list) or not image_ids:
+            raise ValueError('image_ids must be a non-empty list')
+        try:
+            cleaned = sorted({int(image_id) for image_id in image_ids})
+        except (TypeError, ValueError):
+            raise ValueError('image_ids must contain integers')
+        if len(cleaned) > MAX_BULK_IMAGES:
+            raise ValueError(f'At most {MAX_BULK_IMAGES} images per request')
+        return cleaned
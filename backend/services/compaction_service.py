@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import base64
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import text, bindparam, func
+from config import Config
+from models.models import db, GeneratedImage
+from services.image_hash import dhash
+from services.media_storage import MEDIA_REF_PREFIX, extension_for, release_media, store_bytes
+
+
+def _externalize(row):
+    """Pool worker: decode one data URL and write it to media storage"""
+    image_id, image_url = row
+    try:
+        header, _, payload = image_url.partition(',')
+        mime = header[len('data:'):].split(';')[0]
+        data = base64.b64decode(payload)
+        digest = hashlib.sha256(data).hexdigest()
+        name = store_bytes(data, extension_for(mime), digest)
+        try:
+            phash = dhash(data)
+        except Exception:
+            phash = None
+        return {
+            'id': image_id,
+            'name': name,
+            'content_hash': digest,
+            'phash': phash,
+            'reclaimed': len(image_url) - len(MEDIA_REF_PREFIX) - len(name)
+        }
+    except Exception as e:
+        return {'id': image_id, 'error': str(e)}
+
+
+class CompactionService:
+    @staticmethod
+    def checkpoint_path():
+        return os.path.join(Config.MEDIA_ROOT, '.compaction-checkpoint.json')
+
+    @staticmethod
+    def load_checkpoint():
+        try:
+            with open(CompactionService.checkpoint_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'last_id': 0, 'moved': 0, 'failed': 0, 'bytes_reclaimed': 0}
+
+    @staticmethod
+    def save_checkpoint(state):
+        path = CompactionService.checkpoint_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def compact(chunk_size=50, workers=None, restart=False, progress=print):
+        """Move inline data URLs to media storage, resuming from the last checkpoint.
+
+        Rows are walked in id order; each chunk is decoded and written to disk
+        by a process pool, then rewritten to media:// references in one
+        transaction before the checkpoint advances. Interrupting at any point
+        is safe: files are content-addressed and rows are only rewritten
+        after their file exists.
+        """
+        state = {'last_id': 0, 'moved': 0, 'failed': 0, 'bytes_reclaimed': 0} \
+            if restart else CompactionService.load_checkpoint()
+        started = time.time()
+        moved_this_run = 0
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                rows = db.session.query(GeneratedImage.id, GeneratedImage.image_url)\
+                    .filter(GeneratedImage.id > state['last_id'], GeneratedImage.image_url.like('data:%'))\
+                    .order_by(GeneratedImage.id)\
+                    .limit(chunk_size)\
+                    .all()
+                if not rows:
+                    break
+                # Release the ORM's copies before the payloads are pickled to workers
+                db.session.expunge_all()
+
+                results = list(pool.map(_externalize, [tuple(row) for row in rows]))
+                del rows
+                done = [r for r in results if 'error' not in r]
+                failed = len(results) - len(done)
+                for failure in (r for r in results if 'error' in r):
+                    progress(f"Image {failure['id']} skipped: {failure['error']}")
+
+                if done:
+                    # A row rewritten while its payload was decoded (refined, archived,
+                    # deduplicated) keeps its new value: refine sets a new content_hash
+                    db.session.execute(
+                        GeneratedImage.__table__.update()
+                        .where(GeneratedImage.id == bindparam('b_id'),
+                               GeneratedImage.image_url.like('data:%'),
+                               func.coalesce(GeneratedImage.content_hash, bindparam('b_content_hash'))
+                               == bindparam('b_content_hash'))
+                        .values(
+                            image_url=bindparam('b_url'),
+                            content_hash=func.coalesce(GeneratedImage.content_hash, bindparam('b_content_hash')),
+                            phash=func.coalesce(GeneratedImage.phash, bindparam('b_phash'))
+                        ),
+                        [{
+                            'b_id': r['id'],
+                            'b_url': f"{MEDIA_REF_PREFIX}{r['name']}",
+                            'b_content_hash': r['content_hash'],
+                            'b_phash': r['phash']
+                        } for r in done]
+                    )
+                    db.session.commit()
+                    current = dict(
+                        db.session.query(GeneratedImage.id, GeneratedImage.image_url)
+                        .filter(GeneratedImage.id.in_([r['id'] for r in done]))
+                        .all()
+                    )
+                    skipped = [r for r in done if current.get(r['id']) != f"{MEDIA_REF_PREFIX}{r['name']}"]
+                    if skipped:
+                        # Their files may now be referenced by nothing
+                        release_media([r['name'] for r in skipped])
+                        done = [r for r in done if r not in skipped]
+
+                state['last_id'] = max(r['id'] for r in results)
+                state['moved'] += len(done)
+                moved_this_run += len(done)
+                state['failed'] += failed
+                state['bytes_reclaimed'] += sum(r['reclaimed'] for r in done)
+                CompactionService.save_checkpoint(state)
+
+                elapsed = max(time.time() - started, 1e-6)
+                progress(f"Compacted through id {state['last_id']}: {state['moved']} moved, "
+                         f"{state['bytes_reclaimed'] / 1e6:.1f} MB reclaimed ({moved_this_run / elapsed:.0f} rows/s)")
+
+        state['file_bytes_reclaimed'] = CompactionService.vacuum()
+        return state
+
+    @staticmethod
+    def vacuum():
+        """Return freed pages to the OS; returns bytes the database file shrank by (SQLite)"""
+        engine = db.engine
+        db.session.remove()
+        if engine.dialect.name == 'sqlite':
+            path = engine.url.database
+            before = os.path.getsize(path) if path and os.path.exists(path) else 0
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                mode = conn.execute(text('PRAGMA auto_vacuum')).scalar()
+                if mode == 2:
+                    conn.execute(text('PRAGMA incremental_vacuum'))
+                else:
+                    # Switching to incremental mode needs one full VACUUM;
+                    # later runs only release free pages
+                    conn.execute(text('PRAGMA auto_vacuum = INCREMENTAL'))
+                    conn.execute(text('VACUUM'))
+            after = os.path.getsize(path) if path and os.path.exists(path) else 0
+            return max(0, before - after)
+        if engine.dialect.name == 'postgresql':
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(text('VACUUM (ANALYZE) generated_images'))
+        return 0
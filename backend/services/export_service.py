@@ -0,0 +1,142 @@
+import io
+import re
+import json
+import base64
+import zipfile
+from models.models import db, GeneratedImage
+from services.image_service import IMAGE_REF_PREFIX
+from services.tiering_service import ARCHIVE_REF_PREFIX, TieringService
+from services.media_storage import MEDIA_REF_PREFIX, extension_for, media_path
+
+# Multiple of 4 so every slice of a base64 payload decodes on its own
+DECODE_CHUNK_CHARS = 64 * 1024
+_SLUG_RE = re.compile(r"[^a-z0-9]+")
+
+
+class _StreamBuffer(io.RawIOBase):
+    """Unseekable sink for ZipFile; the generator drains it after every write"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return b''.join(chunks)
+
+
+class ExportService:
+    @staticmethod
+    def export_window(user_id, after_id=0, limit=500):
+        """Return (image_count, next_cursor) for one export part.
+
+        next_cursor is the id to resume from, or None if this part reaches
+        the end of the gallery.
+        """
+        base = db.session.query(GeneratedImage.id)\
+            .filter(GeneratedImage.user_id == user_id, GeneratedImage.id > after_id)\
+            .order_by(GeneratedImage.id)
+        count = base.limit(limit).count()
+        has_more = base.offset(limit).limit(1).first() is not None
+        if not has_more:
+            return count, None
+        last_in_part = base.offset(limit - 1).limit(1).scalar()
+        return count, last_in_part
+
+    @staticmethod
+    def stream_gallery(user_id, after_id=0, limit=500, next_cursor=None):
+        """Yield a ZIP of a user's images with id > after_id, built on the fly.
+
+        Rows are fetched one at a time from a streaming cursor and each
+        payload is base64-decoded in slices straight into the archive, so at
+        most one image is ever held in memory. manifest.json is written last.
+        """
+        buffer = _StreamBuffer()
+        manifest = []
+        rows = db.session.query(
+                GeneratedImage.id,
+                GeneratedImage.original_prompt,
+                GeneratedImage.improved_prompt,
+                GeneratedImage.image_url,
+                GeneratedImage.ai_enhanced,
+                GeneratedImage.style,
+                GeneratedImage.created_at
+            )\
+            .filter(GeneratedImage.user_id == user_id, GeneratedImage.id > after_id)\
+            .order_by(GeneratedImage.id)\
+            .limit(limit)\
+            .execution_options(stream_results=True, yield_per=1)
+
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for row in rows:
+                image_url = row.image_url
+                if image_url.startswith(IMAGE_REF_PREFIX):
+                    image_url = db.session.query(GeneratedImage.image_url)\
+                        .filter_by(id=int(image_url[len(IMAGE_REF_PREFIX):]))\
+                        .scalar() or ''
+                if image_url.startswith(ARCHIVE_REF_PREFIX):
+                    # Read from the cold tier without rehydrating: an export isn't a view
+                    archived_id = int(image_url[len(ARCHIVE_REF_PREFIX):])
+                    image_url = TieringService.load_archived([archived_id]).get(archived_id, '')
+
+                entry = {
+                    'id': row.id,
+                    'original_prompt': row.original_prompt,
+                    'improved_prompt': row.improved_prompt,
+                    'style': row.style,
+                    'ai_enhanced': bool(row.ai_enhanced),
+                    'created_at': row.created_at.isoformat() if row.created_at else None,
+                }
+
+                if image_url.startswith('data:'):
+                    header, _, payload = image_url.partition(',')
+                    mime = header[len('data:'):].split(';')[0]
+                    entry['file'] = f"images/{row.id}_{_slug(row.original_prompt)}.{extension_for(mime)}"
+
+                    # Images are already compressed; store them as-is
+                    with archive.open(zipfile.ZipInfo(entry['file'], _zip_time(row.created_at)), 'w') as out:
+                        for start in range(0, len(payload), DECODE_CHUNK_CHARS):
+                            out.write(base64.b64decode(payload[start:start + DECODE_CHUNK_CHARS]))
+                            yield buffer.drain()
+                elif image_url.startswith(MEDIA_REF_PREFIX):
+                    name = image_url[len(MEDIA_REF_PREFIX):]
+                    entry['file'] = f"images/{row.id}_{_slug(row.original_prompt)}.{name.rsplit('.', 1)[-1]}"
+                    with archive.open(zipfile.ZipInfo(entry['file'], _zip_time(row.created_at)), 'w') as out, \
+                            open(media_path(name), 'rb') as source:
+                        for chunk in iter(lambda: source.read(DECODE_CHUNK_CHARS), b''):
+                            out.write(chunk)
+                            yield buffer.drain()
+                else:
+                    # Remote fallbacks (picsum) are referenced, not downloaded
+                    entry['image_url'] = image_url
+
+                manifest.append(entry)
+                yield buffer.drain()
+
+            archive.writestr(
+                'manifest.json',
+                json.dumps({
+                    'after_id': after_id,
+                    'next_cursor': next_cursor,
+                    'count': len(manifest),
+                    'images': manifest
+                }, indent=2),
+                compress_type=zipfile.ZIP_DEFLATED
+            )
+        yield buffer.drain()
+
+
+def _slug(prompt):
+    return _SLUG_RE.sub('-', (prompt or '').lower()).strip('-')[:40] or 'image'
+
+
+def _zip_time(created_at):
+    if created_at is None or created_at.year < 1980:
+        return (1980, 1, 1, 0, 0, 0)
+    return created_at.timetuple()[:6]
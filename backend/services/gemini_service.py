@@ -1,9 +1,18 @@
 import time
-import random
+import asyncio
 import hashlib
 import google.generativeai as genai
 from config import Config
 from services.stability_service_clean import StabilityAIService
+from services.prompt_enhancer import prompt_enhancer
+from services.health_service import health
+from utils import tracing
+from utils.cassette import cassette
+from utils.log import get_logger
+
+log = get_logger('gemini')
+
+MODEL_NAME = "models/gemini-2.5-flash-latest"
 
 class GeminiService:
     def __init__(self):
@@ -11,22 +20,22 @@ class GeminiService:
         self.rate_limit_reset = 0
         self.last_request_time = 0
         self.request_cooldown = Config.REQUEST_COOLDOWN
+        self.model_name = MODEL_NAME
         
         # Use Stability.ai for image generation
         self.image_service = StabilityAIService()
         
-        if Config.GEMINI_API_KEY:
+        if Config.GEMINI_API_KEY or cassette.replaying:
             self._initialize_gemini()
     
     def _initialize_gemini(self):
         """Initialize Gemini for prompt improvement only"""
         try:
             genai.configure(api_key=Config.GEMINI_API_KEY)
-            self.model_name = "models/gemini-2.5-flash-latest"
             self.available = True
-            print("SUCCESS: Gemini Service initialized for prompt enhancement")
+            log.info('initialized', model=self.model_name)
         except Exception as e:
-            print(f"ERROR: Gemini Service init failed: {e}")
+            log.error('init_failed', error=str(e))
             self.available = False
     
     def can_make_request(self):
@@ -38,8 +47,19 @@ class GeminiService:
             return True
         return False
     
+    def probe(self):
+        """Health supervisor check: fetches model metadata, which spends no tokens"""
+        genai.configure(api_key=Config.GEMINI_API_KEY)
+        cassette.call('gemini', 'get_model', lambda: genai.get_model(self.model_name))
+        return {'gemini': None}
+    
+    @tracing.traced('GeminiService.improve_prompt', 'client')
     def improve_prompt(self, prompt):
-        """Improve the prompt using Gemini (text only)"""
+        """Improve the prompt using Gemini (text only); returns (improved_prompt, ai_enhanced).
+
+        ai_enhanced is True only when Gemini actually rewrote the prompt, not
+        when the local fallback did (unavailable, rate limited or failed).
+        """
         if not self.available or not self.can_make_request():
             return self._improve_prompt_fallback(prompt)
         
@@ -47,60 +67,73 @@ class GeminiService:
             model = genai.GenerativeModel(self.model_name)
             prompt_instruction = f"Improve this image description in 5-8 words: {prompt}"
             
-            response = model.generate_content(
+            response = cassette.call('gemini', 'generate_content', lambda: model.generate_content(
                 prompt_instruction,
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=30,
-                    temperature=0.3,
-                ),
+                generation_config=self._generation_config(),
                 request_options={"timeout": 15}
-            )
+            ), prompt=prompt)
             
-            improved_prompt = response.text.strip() if response.text else prompt
-            improved_prompt = improved_prompt.replace('"', '').replace("**", "")
-            print(f"Gemini improved: '{prompt}' -> '{improved_prompt}'")
-            return improved_prompt
+            return self._clean_response(prompt, response)
             
         except Exception as e:
-            error_str = str(e)
-            print(f"Gemini API error: {error_str}")
+            return self._handle_api_error(prompt, e)
+    
+    @tracing.traced('GeminiService.improve_prompt', 'client')
+    async def improve_prompt_async(self, prompt):
+        """Non-blocking variant of improve_prompt for the ASGI serving mode; same return value"""
+        if not self.available or not self.can_make_request():
+            return self._improve_prompt_fallback(prompt)
+        
+        try:
+            model = genai.GenerativeModel(self.model_name)
+            prompt_instruction = f"Improve this image description in 5-8 words: {prompt}"
             
-            if "429" in error_str or "quota" in error_str.lower():
-                self.available = False
-                self.rate_limit_reset = time.time() + 120
-                print("Gemini disabled due to rate limits. Retry in 2 minutes.")
+            response = await cassette.call_async('gemini', 'generate_content', lambda: asyncio.wait_for(
+                model.generate_content_async(
+                    prompt_instruction,
+                    generation_config=self._generation_config()
+                ),
+                timeout=15
+            ), prompt=prompt)
             
-            return self._improve_prompt_fallback(prompt)
+            return self._clean_response(prompt, response)
+            
+        except Exception as e:
+            return self._handle_api_error(prompt, e)
     
-    def _improve_prompt_fallback(self, prompt):
-        """Fallback prompt improvement"""
-        descriptive_words = {
-            "cute": ["adorable", "charming", "sweet"],
-            "baby": ["infant", "newborn", "little one"],
-            "cat": ["feline", "kitten", "cat"],
-            "dog": ["puppy", "canine", "dog"],
-            "photo": ["professional photography", "high-quality image", "crystal clear"],
-            "drawing": ["artistic illustration", "detailed artwork", "digital painting"],
-            "landscape": ["breathtaking landscape", "scenic view", "natural beauty"],
-            "portrait": ["professional portrait", "character study", "expressive face"],
-        }
-        
-        improved = prompt
-        
-        for basic_word, enhanced_options in descriptive_words.items():
-            if basic_word in improved.lower():
-                replacement = random.choice(enhanced_options)
-                improved = improved.replace(basic_word, replacement)
-                break
+    def _generation_config(self):
+        return genai.types.GenerationConfig(
+            max_output_tokens=30,
+            temperature=0.3,
+        )
+    
+    def _clean_response(self, prompt, response):
+        if not response.text:
+            return prompt, False
+        improved_prompt = response.text.strip().replace('"', '').replace("**", "")
+        log.debug('improved', prompt=prompt, improved=improved_prompt)
+        return improved_prompt, True
+    
+    def _handle_api_error(self, prompt, error):
+        error_str = str(error)
+        log.warning('api_error', error=error_str)
         
-        quality_terms = ["high resolution", "detailed", "sharp focus", "well-lit", "professional"]
-        if not any(term in improved.lower() for term in quality_terms):
-            improved += f", {random.choice(quality_terms)}"
+        if "429" in error_str or "quota" in error_str.lower():
+            self.rate_limit_reset = time.time() + 120
+            log.warning('rate_limited', retry_in_seconds=120)
+            health.report_failure('gemini', error_str, retry_after=120)
         
-        return improved
+        return self._improve_prompt_fallback(prompt)
+    
+    def _improve_prompt_fallback(self, prompt):
+        """Fallback prompt improvement"""
+        return prompt_enhancer.improve(prompt), False
     
-    def get_image_url(self, prompt, style='realistic'):
+    def get_image_url(self, prompt, style='realistic', options=None):
         """
         Use Stability.ai for real AI image generation
         """
-        return self.image_service.generate_image(prompt, style)
\ No newline at end of file
+        return self.image_service.generate_image(prompt, style, options)
+    
+    async def get_image_url_async(self, prompt, style='realistic', options=None):
+        return await self.image_service.generate_image_async(prompt, style, options)
\ No newline at end of file
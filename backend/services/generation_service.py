@@ -0,0 +1,190 @@
+import json
+import math
+import uuid
+from services.admission_service import AdmissionService
+from services.image_service import ImageService
+from services.pregeneration_service import PregenerationService, live_traffic
+from services.prompt_index import prompt_index
+from services.refine_service import RefineService
+from services.stability_service_clean import StabilityAIService
+
+
+RESPONSE_CHUNK = 64 * 1024
+
+
+class GenerationRejected(Exception):
+    """A generate request answered without generating: bad input, near-duplicates offered, or no quota"""
+
+    def __init__(self, payload, status=400, headers=None):
+        super().__init__(payload.get('error'))
+        self.payload = payload
+        self.status = status
+        self.headers = headers or {}
+
+
+class GenerationService:
+    """The /api/generate flow, shared by the Flask controller and the ASGI endpoint.
+
+    Every step but the upstream calls is a plain function both paths run,
+    the ASGI one on its DB thread pool; only render has a sync and an async
+    variant, and those differ in nothing but how they call Gemini and
+    Stability. generate() chains the steps for the Flask path.
+    """
+
+    @staticmethod
+    def parse(data):
+        """Validate a request body into generation params; raises GenerationRejected (400)"""
+        prompt = str(data.get('prompt', '')).strip()
+        if not prompt:
+            raise GenerationRejected({'error': 'Missing prompt'})
+        try:
+            options = StabilityAIService.generation_options(data)
+        except ValueError as e:
+            raise GenerationRejected({'error': str(e)})
+        return {
+            'prompt': prompt,
+            'style': data.get('style', 'realistic'),
+            'options': options,
+            'progressive': bool(data.get('progressive')),
+            'suggest_similar': bool(data.get('suggest_similar')) and not data.get('force')
+        }
+
+    @staticmethod
+    def check(user_id, params):
+        """Offer near-duplicates if asked, then take a quota token; returns the user's plan.
+
+        Raises GenerationRejected with the suggestions (200) or the quota
+        error (429), both before any upstream work.
+        """
+        if params['suggest_similar']:
+            similar = prompt_index.find_similar(user_id, params['prompt'], params['style'])
+            if similar:
+                urls = ImageService.resolve_image_urls([img.image_url for img, _ in similar])
+                raise GenerationRejected({
+                    'success': True,
+                    'generated': False,
+                    'similar_images': [{
+                        'id': img.id,
+                        'original_prompt': img.original_prompt,
+                        'improved_prompt': img.improved_prompt,
+                        'image_url': image_url,
+                        'style': img.style,
+                        'created_at': img.created_at.isoformat(),
+                        'similarity': round(score, 3)
+                    } for (img, score), image_url in zip(similar, urls)]
+                }, 200)
+
+        allowed, retry_after, plan = AdmissionService.admit(user_id)
+        if not allowed:
+            raise GenerationRejected({
+                'error': 'Generation quota exceeded',
+                'plan': plan,
+                'retry_after': math.ceil(retry_after)
+            }, 429, {'Retry-After': str(math.ceil(retry_after))})
+        return plan
+
+    @staticmethod
+    def claim(params):
+        """A speculative render of a trending prompt, as a render result, or None (default settings only)"""
+        if params['options'] or params['progressive']:
+            return None
+        pregenerated = PregenerationService.claim(params['prompt'], params['style'])
+        if pregenerated is None:
+            return None
+        return dict(pregenerated, draft=None, pregenerated=True)
+
+    @staticmethod
+    def _prepare(params, improved):
+        """The render result so far and the options to render with, once the prompt is improved"""
+        improved_prompt, ai_enhanced = improved
+        if params['style'] and params['style'] != 'realistic':
+            improved_prompt = f"{improved_prompt}, {params['style']} style"
+        # Progressive mode answers with a quick draft and refines it in the background
+        draft = RefineService.draft_options(params['options']) if params['progressive'] else None
+        result = {'improved_prompt': improved_prompt, 'ai_enhanced': ai_enhanced, 'draft': draft,
+                  'pregenerated': False}
+        return result, draft or params['options']
+
+    @staticmethod
+    def render(gemini, params):
+        result, options = GenerationService._prepare(params, gemini.improve_prompt(params['prompt']))
+        result['image_url'] = gemini.get_image_url(result['improved_prompt'], options=options)
+        return result
+
+    @staticmethod
+    async def render_async(gemini, params):
+        result, options = GenerationService._prepare(params, await gemini.improve_prompt_async(params['prompt']))
+        result['image_url'] = await gemini.get_image_url_async(result['improved_prompt'], options=options)
+        return result
+
+    @staticmethod
+    def save(app, gemini, user_id, params, result):
+        """Store the image and queue its refinement if it is a draft; returns the image id"""
+        # Only a real draft gets refined; placeholders are already final
+        draft = result['draft']
+        result['refine_status'] = 'pending' if draft and draft.get('engine') else None
+        image = ImageService.create_image(
+            user_id=user_id,
+            original_prompt=params['prompt'],
+            improved_prompt=result['improved_prompt'],
+            image_url=result['image_url'],
+            ai_enhanced=result['ai_enhanced'],
+            style=params['style'],
+            refine_status=result['refine_status']
+        )
+        if result['refine_status']:
+            RefineService.schedule(app, gemini.image_service, image.id, result['improved_prompt'],
+                                   params['options'], draft)
+        return image.id
+
+    @staticmethod
+    def response(params, result, image_id, image_url):
+        """The success payload; image_url is the stored one resolved for the caller"""
+        return {
+            'success': True,
+            'generated': True,
+            'original_prompt': params['prompt'],
+            'improved_prompt': result['improved_prompt'],
+            'image_url': image_url,
+            'ai_enhanced': result['ai_enhanced'],
+            'pregenerated': result['pregenerated'],
+            'refine_status': result['refine_status'],
+            'style': params['style'],
+            'gemini_used': result['ai_enhanced'],
+            'image_id': image_id
+        }
+
+    @staticmethod
+    def encode(payload):
+        """Yield a payload as JSON bytes, writing an inline image_url in pieces.
+
+        An inline data URL is nearly all of a success response; json.dumps
+        and then encode would hold two more whole copies of it at once.
+        Base64 text needs no JSON escaping, so it is sliced straight out of
+        the stored string instead.
+        """
+        image_url = payload.get('image_url')
+        if not (isinstance(image_url, str) and image_url.startswith('data:') and image_url.isascii()
+                and '"' not in image_url and '\\' not in image_url):
+            yield json.dumps(payload).encode('utf-8')
+            return
+        # A fresh placeholder no other field can contain; image_url is serialized where it sits
+        placeholder = f'"{uuid.uuid4().hex}"'
+        head, tail = json.dumps(dict(payload, image_url=placeholder[1:-1])).split(placeholder, 1)
+        yield (head + '"').encode('utf-8')
+        for start in range(0, len(image_url), RESPONSE_CHUNK):
+            yield image_url[start:start + RESPONSE_CHUNK].encode('ascii')
+        yield ('"' + tail).encode('utf-8')
+
+    @staticmethod
+    def generate(app, gemini, user_id, data):
+        """The whole flow, synchronously; returns the success payload or raises GenerationRejected"""
+        params = GenerationService.parse(data)
+        GenerationService.check(user_id, params)
+        result = GenerationService.claim(params)
+        if result is None:
+            with live_traffic.track():
+                result = GenerationService.render(gemini, params)
+        image_id = GenerationService.save(app, gemini, user_id, params, result)
+        image_url = ImageService.resolve_image_urls([result['image_url']])[0]
+        return GenerationService.response(params, result, image_id, image_url)
@@ -0,0 +1,276 @@
+import os
+import time
+import socket
+import threading
+from datetime import datetime
+from sqlalchemy import insert, or_, update
+from sqlalchemy.exc import IntegrityError
+from config import Config
+from models.models import db, ProviderHealth, ServiceLease
+from utils.log import get_logger
+
+log = get_logger('health')
+
+SUPERVISOR_LEASE = 'health_supervisor'
+# Providers that render images; Gemini only rewrites prompts, which has a local fallback
+IMAGE_PROVIDERS = ('stability',)
+
+
+def engine_provider(engine_id):
+    return f"stability:{engine_id}"
+
+
+def backoff(failures):
+    """Seconds before a provider that failed this many times in a row is probed again"""
+    return min(Config.HEALTH_BACKOFF_BASE_SECONDS * 2 ** max(failures - 1, 0), Config.HEALTH_BACKOFF_MAX_SECONDS)
+
+
+def _isoformat(timestamp):
+    return datetime.utcfromtimestamp(timestamp).isoformat() if timestamp else None
+
+
+class HealthState:
+    """This process's copy of provider_health, reloaded every supervisor tick.
+
+    Request paths only ever read it, so routing around a dead provider costs
+    a dict lookup. The dict is replaced rather than mutated, so readers need
+    no lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.providers = {}  # provider -> row as a dict
+        self.services = {}  # provider -> service whose `available` follows it
+        self.reported = {}  # provider -> (error, retry_after) awaiting the next tick
+        self.running = False
+        self.ticked_at = 0.0
+        self.refreshed_at = 0.0
+
+    def configure(self, services):
+        """Record the providers this worker has keys for, supervised or not"""
+        self.services = dict(services)
+
+    def is_up(self, provider):
+        """Providers never probed count as up, so nothing is skipped before the first probe"""
+        row = self.providers.get(provider)
+        return row is None or row['status'] == 'up'
+
+    def can_render(self):
+        """Whether some configured image provider is available and up, with at least one engine up"""
+        for provider in IMAGE_PROVIDERS:
+            service = self.services.get(provider)
+            if service is None or not service.available or not self.is_up(provider):
+                continue
+            engines = [row for name, row in self.providers.items() if name.startswith(f"{provider}:")]
+            if not engines or any(row['status'] == 'up' for row in engines):
+                return True
+        return False
+
+    def report_failure(self, provider, error, retry_after=None):
+        """Mark a provider down after a request saw it fail; other workers follow on the next tick"""
+        if not self.running:
+            return  # with no supervisor nothing would ever mark it up again
+        error = str(error)[:500]
+        with self.lock:
+            row = dict(self.providers.get(provider) or {'failures': 0, 'checked_at': None, 'next_probe_at': 0})
+            row.update(status='down', last_error=error)
+            self.providers = {**self.providers, provider: row}
+            self.reported[provider] = (error, retry_after)
+        self._apply()
+        log.warning('reported_down', provider=provider, error=error)
+
+    def drain_reports(self):
+        with self.lock:
+            reported, self.reported = self.reported, {}
+        return reported
+
+    def load(self, rows):
+        self.providers = {row.provider: {
+            'status': row.status,
+            'failures': row.failures,
+            'last_error': row.last_error,
+            'checked_at': row.checked_at,
+            'next_probe_at': row.next_probe_at
+        } for row in rows}
+        self.refreshed_at = time.time()
+        self._apply()
+
+    def _apply(self):
+        for provider, service in self.services.items():
+            if provider in self.providers:
+                service.available = self.is_up(provider)
+
+    def report(self):
+        """Liveness, readiness and per-provider state for /api/health, without touching the database"""
+        now = time.time()
+        stale_after = Config.HEALTH_LEASE_SECONDS + Config.HEALTH_TICK_SECONDS
+        live = not self.running or now - self.ticked_at <= stale_after
+        # Placeholders aren't traffic worth routing here: without a renderer the worker is not ready
+        can_render = self.can_render()
+        ready = (not self.running or now - self.refreshed_at <= stale_after) and can_render
+        providers = {
+            provider: {
+                'status': row['status'],
+                'failures': row['failures'],
+                'last_error': row['last_error'] if row['status'] == 'down' else None,
+                'checked_at': _isoformat(row['checked_at']),
+                'next_probe_in_seconds': round(max(0, row['next_probe_at'] - now), 1)
+            }
+            for provider, row in sorted(self.providers.items())
+        }
+        if not live or not ready:
+            status = 'unavailable'
+        elif any(row['status'] == 'down' for row in providers.values()):
+            status = 'degraded'
+        else:
+            status = 'healthy'
+        return {
+            'status': status,
+            'live': live,
+            'ready': ready,
+            'supervised': self.running,
+            'can_render': can_render,
+            'state_age_seconds': round(now - self.refreshed_at, 1) if self.refreshed_at else None,
+            'providers': providers
+        }
+
+
+health = HealthState()
+
+
+class HealthSupervisor:
+    """Probes upstream providers once for every worker and shares the result.
+
+    Every worker ticks every HEALTH_TICK_SECONDS: it publishes failures its
+    requests reported, renews or takes the supervisor lease, and reloads
+    provider_health. Only the lease holder probes, so Gemini and Stability
+    see one set of probes however many workers run. A provider that is up
+    is probed every HEALTH_PROBE_INTERVAL_SECONDS; one that is down waits
+    HEALTH_BACKOFF_BASE_SECONDS, doubling with each consecutive failure. A
+    provider that comes back keeps its failure count until it passes a
+    regular probe, so one that keeps failing real requests backs off too.
+    """
+
+    @staticmethod
+    def holder():
+        return f"{socket.gethostname()}:{os.getpid()}"  # read late: workers fork after import
+
+    @staticmethod
+    def acquire_lease(name, seconds):
+        """Take or renew a lease; True while this process holds it"""
+        now = time.time()
+        holder = HealthSupervisor.holder()
+        renewed = db.session.execute(
+            update(ServiceLease)
+            .where(ServiceLease.name == name, or_(ServiceLease.holder == holder, ServiceLease.expires_at < now))
+            .values(holder=holder, expires_at=now + seconds)
+        )
+        if not renewed.rowcount:
+            if db.session.get(ServiceLease, name) is not None:
+                db.session.rollback()
+                return False
+            try:
+                db.session.execute(insert(ServiceLease).values(name=name, holder=holder, expires_at=now + seconds))
+            except IntegrityError:
+                db.session.rollback()
+                return False
+        db.session.commit()
+        return True
+
+    @staticmethod
+    def record(provider, error=None, retry_after=None):
+        """Store one probe or reported result for a provider"""
+        now = time.time()
+        row = db.session.get(ProviderHealth, provider)
+        if row is None:
+            row = ProviderHealth(provider=provider, status='up', failures=0)
+            db.session.add(row)
+        status = 'up' if error is None else 'down'
+        if status != row.status:
+            row.changed_at = now
+            log.info('changed', provider=provider, status=status, error=error)
+        if error is None:
+            row.failures = 0 if row.status == 'up' else row.failures
+            row.next_probe_at = now + Config.HEALTH_PROBE_INTERVAL_SECONDS
+        else:
+            row.failures = (row.failures or 0) + 1
+            row.last_error = error[:500]
+            row.next_probe_at = now + max(backoff(row.failures), retry_after or 0)
+        row.status = status
+        row.checked_at = now
+
+    @staticmethod
+    def probe_due(services):
+        """Probe every service with a due provider; returns the providers probed"""
+        now = time.time()
+        rows = db.session.query(ProviderHealth.provider, ProviderHealth.status, ProviderHealth.next_probe_at).all()
+        due_at = {row.provider: row.next_probe_at for row in rows}
+        down = {row.provider for row in rows if row.status == 'down'}
+        # Don't hold a connection open across the network calls
+        db.session.rollback()
+
+        probed = []
+        for name, service in services.items():
+            # Engine rows come from their service's probe, so a due engine probes its service,
+            # unless the service itself is down and backing off
+            if name in due_at and due_at[name] > now:
+                if name in down or not any(
+                    p.startswith(f"{name}:") and due_at[p] <= now for p in due_at
+                ):
+                    continue
+            try:
+                results = service.probe()
+            except Exception as e:
+                results = {name: str(e) or type(e).__name__}
+            for provider, error in results.items():
+                if provider in due_at and due_at[provider] > now:
+                    continue  # still backing off after a reported failure
+                HealthSupervisor.record(provider, error)
+                probed.append(provider)
+        db.session.commit()
+        return probed
+
+    @staticmethod
+    def refresh():
+        health.load(ProviderHealth.query.all())
+        db.session.rollback()
+
+    @staticmethod
+    def tick(services):
+        health.ticked_at = time.time()
+        reported = health.drain_reports()
+        try:
+            for provider, (error, retry_after) in reported.items():
+                HealthSupervisor.record(provider, error, retry_after)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with health.lock:
+                health.reported = {**reported, **health.reported}
+            raise
+        if HealthSupervisor.acquire_lease(SUPERVISOR_LEASE, Config.HEALTH_LEASE_SECONDS):
+            HealthSupervisor.probe_due(services)
+        HealthSupervisor.refresh()
+
+    @staticmethod
+    def start(app, services):
+        """Follow provider health in this worker; services maps provider name -> service with probe()"""
+        health.configure(services)
+        health.running = True
+        health.ticked_at = time.time()  # live from the start, not only after the first tick
+        with app.app_context():
+            HealthSupervisor.refresh()
+
+        def loop():
+            while True:
+                time.sleep(Config.HEALTH_TICK_SECONDS)
+                with app.app_context():
+                    try:
+                        HealthSupervisor.tick(services)
+                    except Exception as e:
+                        db.session.rollback()
+                        log.error('failed', error=str(e))
+
+        thread = threading.Thread(target=loop, daemon=True, name='health-supervisor')
+        thread.start()
+        return thread
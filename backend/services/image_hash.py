@@ -0,0 +1,271 @@
+import io
+import base64
+import hashlib
+import threading
+import numpy as np
+from PIL import Image
+from models.models import db, GeneratedImage
+from services.media_storage import MEDIA_REF_PREFIX, media_path
+from utils.log import get_logger
+
+log = get_logger('image_hash')
+
+DATA_URL_PREFIX = 'data:'
+DECODE_CHUNK = 64 * 1024  # a multiple of 4, so every slice decodes on its own
+
+
+def decode_data_url(image_url):
+    """Return the raw bytes of a base64 data URL, or None for remote URLs"""
+    if not image_url or not image_url.startswith(DATA_URL_PREFIX):
+        return None
+    try:
+        _, encoded = image_url.split(',', 1)
+        return base64.b64decode(encoded)
+    except Exception:
+        return None
+
+
+def to_signed64(value):
+    """Fold an unsigned 64-bit hash into BigInteger range"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def hamming(a, b):
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+
+def dhash(image, size=8):
+    """64-bit difference hash: compare adjacent pixels of a 9x8 grayscale thumbnail.
+
+    image is the encoded bytes or a file object positioned at their start.
+    """
+    source = io.BytesIO(image) if isinstance(image, (bytes, bytearray)) else image
+    with Image.open(source) as opened:
+        thumbnail = opened.convert('L').resize((size + 1, size), Image.LANCZOS)
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    value = int(np.packbits(bits, bitorder='little').view('<u8')[0])
+    return to_signed64(value)
+
+
+def _decode_data_url_into(image_url, out, digest):
+    """Base64-decode a data URL's payload into `out` a slice at a time, hashing as it goes.
+
+    Decoding the whole payload at once would hold the base64 text twice more
+    (the split-off payload and b64decode's ASCII copy) next to the stored URL.
+    """
+    start = image_url.index(',') + 1
+    for offset in range(start, len(image_url), DECODE_CHUNK):
+        piece = base64.b64decode(image_url[offset:offset + DECODE_CHUNK], validate=True)
+        digest.update(piece)
+        out.write(piece)
+    out.seek(0)
+
+
+def compute_hashes(image_url):
+    """Return (phash, content_hash) for a stored image_url.
+
+    Remote URLs (picsum fallbacks) can't be hashed perceptually without a
+    download, so they only get a content hash of the URL itself. Payloads
+    are never copied whole: media files are read by PIL straight from disk
+    and data URLs are decoded piecewise into one buffer, which is the only
+    extra copy of the image this makes.
+    """
+    if image_url and image_url.startswith(MEDIA_REF_PREFIX):
+        # Media files are named after their SHA-256 already
+        name = image_url[len(MEDIA_REF_PREFIX):]
+        content_hash = name.split('.', 1)[0]
+        try:
+            with open(media_path(name), 'rb') as f:
+                return dhash(f), content_hash
+        except Exception as e:
+            log.warning('phash_failed', error=str(e))
+            return None, content_hash
+
+    if not image_url or not image_url.startswith(DATA_URL_PREFIX):
+        return None, hashlib.sha256((image_url or '').encode('utf-8')).hexdigest()
+
+    digest = hashlib.sha256()
+    with io.BytesIO() as image:
+        try:
+            _decode_data_url_into(image_url, image, digest)
+        except Exception:
+            return None, hashlib.sha256(image_url.encode('utf-8')).hexdigest()
+        try:
+            return dhash(image), digest.hexdigest()
+        except Exception as e:
+            log.warning('phash_failed', error=str(e))
+            return None, digest.hexdigest()
+
+
+class BKTree:
+    """Burkhard-Keller tree keyed on Hamming distance between 64-bit hashes.
+
+    Identical hashes share a node, so each node holds a list of values.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, key, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [key, [value], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(key, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [value], {}]
+                return
+            node = child
+
+    def search(self, key, radius):
+        """Yield (distance, value) for every entry within radius of key"""
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            node_key, values, children = stack.pop()
+            distance = hamming(key, node_key)
+            if distance <= radius:
+                for value in values:
+                    yield distance, value
+            for child_distance, child in children.items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+
+
+class ImageHashIndex:
+    """BK-tree over every stored phash, appended from the database by id watermark.
+
+    The tree only ever grows, so rows whose phash changed (refine) or that
+    were deleted (retention, user deletes) leave stale entries behind.
+    Matches are therefore checked against the database before they are
+    returned; refined rows are re-added under their new hash, and the tree
+    is rebuilt once stale entries make up a quarter of it.
+    """
+
+    def __init__(self, chunk_size=5000):
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()  # one refresh at a time, so no row is added twice
+        self.rebuild_lock = threading.Lock()
+        self.tree = BKTree()
+        self.last_id = 0
+        self.stale = set()
+        self.pending = None  # adds made while a rebuild is reading, replayed into the new tree
+
+    def _chunks(self, after_id):
+        """Yield lists of (id, user_id, phash) rows past after_id, a chunk at a time"""
+        while True:
+            rows = db.session.query(GeneratedImage.id, GeneratedImage.user_id, GeneratedImage.phash)\
+                .filter(GeneratedImage.id > after_id)\
+                .order_by(GeneratedImage.id)\
+                .limit(self.chunk_size)\
+                .all()
+            if rows:
+                yield rows
+                after_id = rows[-1][0]
+            if len(rows) < self.chunk_size:
+                return
+
+    def refresh(self):
+        with self.refresh_lock:
+            for rows in self._chunks(self.last_id):
+                with self.lock:
+                    for image_id, user_id, phash in rows:
+                        if phash is not None:
+                            self.tree.add(phash, (image_id, user_id))
+                    self.last_id = rows[-1][0]
+
+    def add(self, image_id, user_id, phash):
+        """Index a row whose phash changed after it was first indexed"""
+        if phash is None:
+            return
+        with self.lock:
+            self.tree.add(phash, (image_id, user_id))  # search dedupes by id if refresh added it too
+            if self.pending is not None:
+                self.pending.append((phash, (image_id, user_id)))
+
+    def _rebuild(self):
+        """Build a fresh tree beside the live one and swap it in once complete.
+
+        Searches keep using the old tree meanwhile; rows it takes in past the new
+        tree's watermark are picked up again by the next refresh.
+        """
+        if not self.rebuild_lock.acquire(blocking=False):
+            return  # another search is already rebuilding
+        try:
+            with self.lock:
+                self.pending = []
+            log.info('rebuilding')
+            tree, last_id = BKTree(), 0
+            for rows in self._chunks(0):
+                for image_id, user_id, phash in rows:
+                    if phash is not None:
+                        tree.add(phash, (image_id, user_id))
+                last_id = rows[-1][0]
+            with self.refresh_lock, self.lock:
+                for key, value in self.pending:
+                    tree.add(key, value)
+                self.tree, self.last_id, self.stale = tree, last_id, set()
+            log.info('rebuilt', size=tree.size)
+        finally:
+            with self.lock:
+                self.pending = None
+            self.rebuild_lock.release()
+
+    def warm(self, app):
+        """Load the index in a background thread, so the first similarity search doesn't"""
+        def load():
+            with app.app_context():
+                try:
+                    self.refresh()
+                    log.info('loaded', size=self.tree.size)
+                except Exception as e:
+                    log.error('load_failed', error=str(e))
+                finally:
+                    db.session.remove()
+
+        thread = threading.Thread(target=load, daemon=True, name='image-hash-index')
+        thread.start()
+        return thread
+
+    def search(self, phash, radius, user_id=None):
+        """Return [(image_id, distance)] sorted by distance"""
+        self.refresh()
+        with self.lock:
+            candidates = {
+                image_id
+                for distance, (image_id, owner_id) in self.tree.search(phash, radius)
+                if user_id is None or owner_id == user_id
+            }
+        if not candidates:
+            return []
+
+        current = dict(
+            db.session.query(GeneratedImage.id, GeneratedImage.phash)
+            .filter(GeneratedImage.id.in_(list(candidates)))
+            .all()
+        )
+        matches = []
+        for image_id in candidates:
+            current_hash = current.get(image_id)
+            distance = hamming(phash, current_hash) if current_hash is not None else None
+            if distance is not None and distance <= radius:
+                matches.append((image_id, distance))
+        with self.lock:
+            self.stale.update(candidates.difference(current))
+            rebuild = len(self.stale) * 4 > self.tree.size
+        if rebuild:
+            self._rebuild()
+        return sorted(matches, key=lambda match: (match[1], match[0]))
+
+
+image_hash_index = ImageHashIndex()
@@ -1,20 +1,42 @@
 from models.models import db, GeneratedImage, Favorite, Collection, CollectionItem
-from sqlalchemy import desc
-from datetime import datetime  # ADD THIS IMPORT
+from sqlalchemy import desc, func
+from sqlalchemy.orm import contains_eager
+from config import Config
+from utils import tracing
+from services.collection_service import CollectionService
+from services.prompt_index import prompt_index
+from services.image_hash import BKTree, compute_hashes, image_hash_index
+from services.media_storage import IMAGE_REF_PREFIX, MEDIA_REF_PREFIX, media_url
+from services.tiering_service import ARCHIVE_REF_PREFIX, TieringService
 
 class ImageService:
     @staticmethod
-    def create_image(user_id, original_prompt, improved_prompt, image_url, ai_enhanced=False, style='realistic'):
+    @tracing.traced()
+    def create_image(user_id, original_prompt, improved_prompt, image_url, ai_enhanced=False, style='realistic',
+                     refine_status=None):
+        phash, content_hash = compute_hashes(image_url)
         image = GeneratedImage(
             user_id=user_id,
             original_prompt=original_prompt,
             improved_prompt=improved_prompt,
             image_url=image_url,
             ai_enhanced=ai_enhanced,
-            style=style
+            style=style,
+            phash=phash,
+            content_hash=content_hash,
+            refine_status=refine_status
         )
         db.session.add(image)
         db.session.commit()
+        if prompt_index.loaded:
+            prompt_index.refresh()
+        return image
+    
+    @staticmethod
+    def get_image(user_id, image_id):
+        image = GeneratedImage.query.filter_by(id=image_id, user_id=user_id).first()
+        if not image:
+            raise ValueError('Image not found')
         return image
     
     @staticmethod
@@ -23,6 +45,161 @@ class ImageService:
             .order_by(desc(GeneratedImage.created_at))\
             .paginate(page=page, per_page=per_page, error_out=False)
     
+    @staticmethod
+    def resolve_image_urls(image_urls, base=None, public=False):
+        """Turn stored references into URLs a browser can load.
+
+        image:// references are replaced by the payload they point to (one
+        query for the whole page), archive:// stubs are rehydrated from the
+        cold tier, and media:// references become the public media URL of
+        the file, under `base` when given (see media_url for `public`).
+        """
+        ref_ids = {
+            int(url[len(IMAGE_REF_PREFIX):])
+            for url in image_urls if url and url.startswith(IMAGE_REF_PREFIX)
+        }
+        targets = {}
+        if ref_ids:
+            targets = dict(
+                db.session.query(GeneratedImage.id, GeneratedImage.image_url)
+                .filter(GeneratedImage.id.in_(ref_ids))
+                .all()
+            )
+        
+        resolved = [
+            targets.get(int(url[len(IMAGE_REF_PREFIX):])) if url and url.startswith(IMAGE_REF_PREFIX) else url
+            for url in image_urls
+        ]
+        
+        # Archived payloads are restored to their rows the first time they're viewed
+        archived_ids = {
+            int(url[len(ARCHIVE_REF_PREFIX):])
+            for url in resolved if url and url.startswith(ARCHIVE_REF_PREFIX)
+        }
+        restored = TieringService.rehydrate(archived_ids) if archived_ids else {}
+        
+        for i, url in enumerate(resolved):
+            if url and url.startswith(ARCHIVE_REF_PREFIX):
+                resolved[i] = restored.get(int(url[len(ARCHIVE_REF_PREFIX):]))
+            elif url and url.startswith(MEDIA_REF_PREFIX):
+                resolved[i] = media_url(url[len(MEDIA_REF_PREFIX):], base, public)
+        return resolved
+    
+    @staticmethod
+    def find_similar_images(user_id, image_id, max_distance=10, limit=20):
+        image = GeneratedImage.query.filter_by(id=image_id, user_id=user_id).first()
+        if not image:
+            raise ValueError('Image not found')
+        if image.phash is None:
+            return image, []
+        
+        matches = [
+            match for match in image_hash_index.search(image.phash, max_distance, user_id)
+            if match[0] != image.id
+        ][:limit]
+        distances = dict(matches)
+        similar = GeneratedImage.query.filter(GeneratedImage.id.in_(list(distances))).all()
+        return image, sorted(
+            ((img, distances[img.id]) for img in similar),
+            key=lambda pair: (pair[1], pair[0].id)
+        )
+    
+    @staticmethod
+    def backfill_hashes(batch_size=200):
+        """Compute phash/content_hash for rows created before they existed"""
+        updated = 0
+        last_id = 0
+        while True:
+            rows = db.session.query(GeneratedImage.id, GeneratedImage.image_url)\
+                .filter(GeneratedImage.id > last_id, GeneratedImage.content_hash.is_(None))\
+                .order_by(GeneratedImage.id)\
+                .limit(batch_size)\
+                .all()
+            if not rows:
+                return updated
+            mappings = []
+            for image_id, image_url in rows:
+                phash, content_hash = compute_hashes(image_url)
+                mappings.append({'id': image_id, 'phash': phash, 'content_hash': content_hash})
+            db.session.bulk_update_mappings(GeneratedImage, mappings)
+            db.session.commit()
+            updated += len(rows)
+            last_id = rows[-1][0]
+    
+    @staticmethod
+    def deduplicate_images(max_distance=None, batch_size=500):
+        """Collapse byte-identical and near-identical inline payloads per user.
+
+        The lowest id of each group keeps its payload; the others are
+        rewritten to an image:// reference to it. Collapsing stays within a
+        user so deleting one account can never orphan another's references.
+        """
+        if max_distance is None:
+            max_distance = Config.DEDUP_MAX_DISTANCE
+        hashed = ImageService.backfill_hashes()
+        inline = GeneratedImage.image_url.like('data:%')
+        duplicates = {}
+        
+        # Byte-identical payloads share a content hash
+        groups = db.session.query(
+                GeneratedImage.user_id,
+                GeneratedImage.content_hash,
+                func.min(GeneratedImage.id)
+            )\
+            .filter(inline, GeneratedImage.content_hash.isnot(None))\
+            .group_by(GeneratedImage.user_id, GeneratedImage.content_hash)\
+            .having(func.count(GeneratedImage.id) > 1)\
+            .all()
+        for user_id, content_hash, canonical_id in groups:
+            ids = db.session.query(GeneratedImage.id)\
+                .filter_by(user_id=user_id, content_hash=content_hash)\
+                .filter(inline, GeneratedImage.id != canonical_id)\
+                .all()
+            for (image_id,) in ids:
+                duplicates[image_id] = canonical_id
+        
+        # Near-identical payloads are within max_distance of an earlier canonical
+        if max_distance > 0:
+            trees = {}
+            rows = db.session.query(GeneratedImage.id, GeneratedImage.user_id, GeneratedImage.phash)\
+                .filter(inline, GeneratedImage.phash.isnot(None))\
+                .order_by(GeneratedImage.id)\
+                .yield_per(batch_size)
+            for image_id, user_id, phash in rows:
+                if image_id in duplicates:
+                    continue
+                tree = trees.setdefault(user_id, BKTree())
+                nearest = min(tree.search(phash, max_distance), default=None)
+                if nearest:
+                    duplicates[image_id] = nearest[1]
+                else:
+                    tree.add(phash, image_id)
+        
+        # Point every duplicate straight at a row that still holds its payload
+        for image_id, canonical_id in duplicates.items():
+            while canonical_id in duplicates:
+                canonical_id = duplicates[canonical_id]
+            duplicates[image_id] = canonical_id
+        
+        bytes_reclaimed = 0
+        pending = list(duplicates.items())
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            bytes_reclaimed += db.session.query(func.coalesce(func.sum(func.length(GeneratedImage.image_url)), 0))\
+                .filter(GeneratedImage.id.in_([image_id for image_id, _ in batch]))\
+                .scalar()
+            db.session.bulk_update_mappings(GeneratedImage, [
+                {'id': image_id, 'image_url': f'{IMAGE_REF_PREFIX}{canonical_id}'}
+                for image_id, canonical_id in batch
+            ])
+            db.session.commit()
+        
+        return {
+            'hashed': hashed,
+            'collapsed': len(duplicates),
+            'bytes_reclaimed': int(bytes_reclaimed)
+        }
+    
     @staticmethod
     def add_favorite(user_id, image_id):
         # Check if image exists and belongs to user
@@ -54,47 +231,20 @@ class ImageService:
     def get_favorites(user_id, page=1, per_page=10):
         return Favorite.query.filter_by(user_id=user_id)\
             .join(GeneratedImage)\
+            .options(contains_eager(Favorite.image))\
             .order_by(desc(Favorite.created_at))\
             .paginate(page=page, per_page=per_page, error_out=False)
     
     @staticmethod
     def create_collection(user_id, name, description='', is_public=False):
-        existing = Collection.query.filter_by(user_id=user_id, name=name).first()
-        if existing:
-            raise ValueError('Collection with this name already exists')
-        
-        collection = Collection(
-            user_id=user_id,
-            name=name,
-            description=description,
-            is_public=is_public
-        )
-        db.session.add(collection)
-        db.session.commit()
-        return collection
+        return CollectionService.create_collection(user_id, name, description, is_public)
     
     @staticmethod
     def add_to_collection(collection_id, image_id, user_id):
-        # Verify collection belongs to user
-        collection = Collection.query.filter_by(id=collection_id, user_id=user_id).first()
-        if not collection:
-            raise ValueError('Collection not found')
-        
-        # Verify image belongs to user
-        image = GeneratedImage.query.filter_by(id=image_id, user_id=user_id).first()
-        if not image:
-            raise ValueError('Image not found')
-        
-        # Check if already in collection
-        existing = CollectionItem.query.filter_by(collection_id=collection_id, image_id=image_id).first()
-        if existing:
-            raise ValueError('Image already in collection')
-        
-        item = CollectionItem(collection_id=collection_id, image_id=image_id)
-        db.session.add(item)
-        collection.updated_at = datetime.utcnow()  # FIXED THIS LINE
-        db.session.commit()
-        return item
+        added = CollectionService.add_images(user_id, collection_id, [image_id])
+        if not added:
+            raise ValueError('Image not found or already in collection')
+        return CollectionItem.query.filter_by(collection_id=collection_id, image_id=image_id).first()
     
     @staticmethod
     def get_user_stats(user_id):
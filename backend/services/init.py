@@ -1,6 +1,19 @@
 from .auth_service import AuthService
 from .image_service import ImageService
+from .collection_service import CollectionService
+from .search_service import SearchService
+from .export_service import ExportService
+from .compaction_service import CompactionService
+from .admission_service import AdmissionService
+from .pregeneration_service import PregenerationService
+from .refine_service import RefineService
+from .generation_service import GenerationService
+from .rollup_service import RollupService
+from .snapshot_service import PublicSnapshotService
+from .tiering_service import TieringService
+from .health_service import HealthSupervisor
+from .bulk_generation_service import BulkGenerationService
 from .gemini_service import GeminiService
 from .stability_service_clean import StabilityAIService
 
-__all__ = ['AuthService', 'ImageService', 'GeminiService', 'StabilityAIService']
\ No newline at end of file
+__all__ = ['AuthService', 'ImageService', 'CollectionService', 'SearchService', 'ExportService', 'CompactionService', 'AdmissionService', 'PregenerationService', 'RefineService', 'GenerationService', 'RollupService', 'PublicSnapshotService', 'TieringService', 'HealthSupervisor', 'BulkGenerationService', 'GeminiService', 'StabilityAIService']
\ No newline at end of file
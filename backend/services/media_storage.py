@@ -0,0 +1,103 @@
+import os
+import hmac
+import time
+import hashlib
+import tempfile
+from flask import has_request_context, request
+from config import Config
+from models.models import db, GeneratedImage, PregeneratedImage
+
+# Rows whose payload lives on disk store this prefix + the file name
+MEDIA_REF_PREFIX = 'media://'
+# Rows collapsed onto another row's payload store this prefix + the row id
+IMAGE_REF_PREFIX = 'image://'
+_EXTENSIONS = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/webp': 'webp', 'image/gif': 'gif'}
+
+
+def extension_for(mime):
+    return _EXTENSIONS.get(mime, 'bin')
+
+
+def media_path(name):
+    """Files are content-addressed and fanned out as ab/cd/<sha256>.<ext>"""
+    return os.path.join(Config.MEDIA_ROOT, name[:2], name[2:4], name)
+
+
+def store_bytes(data, extension, digest=None):
+    """Write bytes under their SHA-256 name (no-op if already stored), return the name"""
+    digest = digest or hashlib.sha256(data).hexdigest()
+    name = f"{digest}.{extension}"
+    path = media_path(name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return name
+
+
+def release_media(names):
+    """Delete the files no generated or pregenerated image refers to any more; returns how many went"""
+    refs = {MEDIA_REF_PREFIX + name: name for name in names}
+    if not refs:
+        return 0
+    in_use = set()
+    for model in (GeneratedImage, PregeneratedImage):
+        in_use.update(url for (url,) in db.session.query(model.image_url).filter(model.image_url.in_(list(refs))))
+    removed = 0
+    for ref, name in refs.items():
+        if ref in in_use:
+            continue
+        try:
+            os.remove(media_path(name))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def sign_media(name, expires, scope='private'):
+    message = f"{name}:{expires}:{scope}".encode('utf-8')
+    return hmac.new(Config.SECRET_KEY.encode('utf-8'), message, hashlib.sha256).hexdigest()[:32]
+
+
+def media_expiry(now=None, ttl=None):
+    """Expiry for a new media URL: the end of the next window of ttl (MEDIA_URL_TTL_SECONDS).
+
+    Rounding to a window keeps a URL identical across page loads, so
+    browsers can cache it, and still valid for at least one full window.
+    """
+    ttl = ttl or Config.MEDIA_URL_TTL_SECONDS
+    return (int(now or time.time()) // ttl + 2) * ttl
+
+
+def verify_media(name, expires, signature, scope='private', now=None):
+    """True when signature was issued for name in this scope and has not expired"""
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires < (now or time.time()):
+        return False
+    return hmac.compare_digest(sign_media(name, expires, scope), signature or '')
+
+
+def media_url(name, base=None, public=False):
+    """Signed URL of a media file.
+
+    Files are only served with a valid signature, so a URL handed to the
+    image's owner stops working after MEDIA_URL_TTL_SECONDS or so. Images
+    published in a public collection get a public-scope signature good for
+    MEDIA_PUBLIC_URL_TTL_SECONDS or so, renewed by the snapshot job only
+    while the collection stays public.
+    """
+    base = Config.MEDIA_BASE_URL or base
+    if not base and has_request_context():
+        base = request.url_root
+    if public:
+        expires = media_expiry(ttl=Config.MEDIA_PUBLIC_URL_TTL_SECONDS)
+        return (f"{(base or '/').rstrip('/')}/media/{name}?expires={expires}&scope=public"
+                f"&sig={sign_media(name, expires, 'public')}")
+    expires = media_expiry()
+    return f"{(base or '/').rstrip('/')}/media/{name}?expires={expires}&sig={sign_media(name, expires)}"
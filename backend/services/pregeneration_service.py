@@ -0,0 +1,283 @@
+import re
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import func, update
+from sqlalchemy.exc import IntegrityError
+from config import Config
+from models.models import db, GeneratedImage, PregeneratedImage, PregenerationSpend, RateLimitBucket
+from services.health_service import HealthSupervisor
+from utils import tracing
+from utils.log import get_logger
+
+log = get_logger('pregeneration')
+
+PREGEN_LEASE = 'pregeneration'
+
+
+def normalize_prompt(prompt):
+    """Case, punctuation and spacing don't make a different request"""
+    return ' '.join(re.sub(r'[^\w\s]', ' ', (prompt or '').lower()).split())
+
+
+def prompt_key(prompt, style):
+    key = f"{normalize_prompt(prompt)}\x1f{style or 'realistic'}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class LiveTraffic:
+    """Live generations running in this process, so speculation can stay out of their way"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.last_seen = 0.0
+
+    @contextmanager
+    def track(self):
+        with self.lock:
+            self.in_flight += 1
+            self.last_seen = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.last_seen = time.time()
+
+    def idle(self, seconds):
+        return self.in_flight == 0 and time.time() - self.last_seen >= seconds
+
+
+live_traffic = LiveTraffic()
+
+
+class PregenerationService:
+    """Spend spare upstream capacity rendering trending prompts ahead of demand.
+
+    A background thread wakes every PREGEN_INTERVAL_SECONDS in every worker,
+    but only the holder of the pregeneration lease prunes and renders. It
+    only renders when nothing live has been admitted for PREGEN_IDLE_SECONDS
+    (in this process, or in any worker according to the rate-limit buckets),
+    renders one image at a time, and stops for the day at PREGEN_DAILY_CAP.
+    Each render first takes a slot from the day's pregeneration_spend row
+    with a conditional UPDATE, so the cap holds however many processes
+    render and however many renders have since been claimed and pruned.
+    Renders bypass the provider's live cooldown, so a user arriving
+    mid-render is never pushed onto a placeholder.
+    """
+
+    @staticmethod
+    def _ttl_cutoff():
+        return datetime.utcnow() - timedelta(hours=Config.PREGEN_TTL_HOURS)
+
+    @staticmethod
+    @tracing.traced()
+    def claim(prompt, style):
+        """Take one unclaimed render for this prompt/style, or None"""
+        key = prompt_key(prompt, style)
+        for _ in range(3):
+            row = PregeneratedImage.query\
+                .filter(PregeneratedImage.prompt_key == key,
+                        PregeneratedImage.served_at.is_(None),
+                        PregeneratedImage.created_at >= PregenerationService._ttl_cutoff())\
+                .order_by(PregeneratedImage.id)\
+                .first()
+            if row is None:
+                return None
+
+            claimed = {
+                'improved_prompt': row.improved_prompt,
+                'image_url': row.image_url,
+                'ai_enhanced': row.ai_enhanced
+            }
+            # Conditional on still being unclaimed, so concurrent requests can't share a render
+            result = db.session.execute(
+                update(PregeneratedImage)
+                .where(PregeneratedImage.id == row.id, PregeneratedImage.served_at.is_(None))
+                .values(served_at=datetime.utcnow())
+            )
+            if result.rowcount:
+                db.session.commit()
+                return claimed
+            db.session.rollback()
+        return None
+
+    @staticmethod
+    def trending():
+        """Prompt/style pairs requested at least PREGEN_MIN_COUNT times in the window, busiest first"""
+        since = datetime.utcnow() - timedelta(hours=Config.PREGEN_WINDOW_HOURS)
+        prompt_expr = func.lower(func.trim(GeneratedImage.original_prompt))
+        groups = db.session.query(
+            prompt_expr,
+            GeneratedImage.style,
+            func.count(GeneratedImage.id),
+            func.max(GeneratedImage.id)
+        ).filter(GeneratedImage.created_at >= since)\
+            .group_by(prompt_expr, GeneratedImage.style)\
+            .order_by(func.count(GeneratedImage.id).desc())\
+            .limit(Config.PREGEN_TOP_N * 10)\
+            .all()
+
+        # SQL can only fold case; merge the groups that normalize to the same request
+        pairs = {}
+        for prompt, style, count, latest_id in groups:
+            key = prompt_key(prompt, style)
+            pair = pairs.setdefault(key, {'key': key, 'style': style or 'realistic', 'count': 0, 'latest_id': 0})
+            pair['count'] += count
+            pair['latest_id'] = max(pair['latest_id'], latest_id)
+
+        top = sorted(
+            (p for p in pairs.values() if p['count'] >= Config.PREGEN_MIN_COUNT),
+            key=lambda p: -p['count']
+        )[:Config.PREGEN_TOP_N]
+        if not top:
+            return []
+
+        # Reuse the most recent improved prompt, so pre-generation spends nothing on Gemini
+        sources = {
+            row.id: row for row in db.session.query(
+                GeneratedImage.id,
+                GeneratedImage.original_prompt,
+                GeneratedImage.improved_prompt,
+                GeneratedImage.ai_enhanced
+            ).filter(GeneratedImage.id.in_([p['latest_id'] for p in top]))
+        }
+        for pair in top:
+            source = sources[pair['latest_id']]
+            pair.update(
+                original_prompt=source.original_prompt,
+                improved_prompt=source.improved_prompt,
+                ai_enhanced=source.ai_enhanced
+            )
+        return top
+
+    @staticmethod
+    def spent_today():
+        return db.session.query(PregenerationSpend.renders)\
+            .filter_by(day=datetime.utcnow().date())\
+            .scalar() or 0
+
+    @staticmethod
+    def reserve():
+        """Take one of today's PREGEN_DAILY_CAP render slots; False when the day is spent"""
+        day = datetime.utcnow().date()
+        for _ in range(2):
+            result = db.session.execute(
+                update(PregenerationSpend)
+                .where(PregenerationSpend.day == day, PregenerationSpend.renders < Config.PREGEN_DAILY_CAP)
+                .values(renders=PregenerationSpend.renders + 1)
+            )
+            if result.rowcount:
+                db.session.commit()
+                return True
+            if db.session.get(PregenerationSpend, day) is not None:
+                db.session.rollback()
+                return False
+            try:
+                db.session.add(PregenerationSpend(day=day, renders=1))
+                db.session.commit()
+                return True
+            except IntegrityError:
+                # Another worker opened the day first; retry the update
+                db.session.rollback()
+        return False
+
+    @staticmethod
+    def release(day):
+        """Give back a slot whose render produced nothing"""
+        db.session.execute(
+            update(PregenerationSpend)
+            .where(PregenerationSpend.day == day, PregenerationSpend.renders > 0)
+            .values(renders=PregenerationSpend.renders - 1)
+        )
+        db.session.commit()
+
+    @staticmethod
+    def upstream_idle():
+        if not live_traffic.idle(Config.PREGEN_IDLE_SECONDS):
+            return False
+        # Admission stamps the bucket of every live request, whichever worker served it
+        last_admitted = db.session.query(func.max(RateLimitBucket.updated_at)).scalar()
+        return last_admitted is None or time.time() - last_admitted >= Config.PREGEN_IDLE_SECONDS
+
+    @staticmethod
+    def run_once(stability):
+        """Render the busiest under-stocked trending pair if there is spare capacity.
+
+        Returns the new PregeneratedImage, or None when nothing was spent.
+        """
+        if not stability.available or not PregenerationService.upstream_idle():
+            return None
+        if PregenerationService.spent_today() >= Config.PREGEN_DAILY_CAP:
+            return None
+
+        trending = PregenerationService.trending()
+        if not trending:
+            return None
+        stocked = dict(
+            db.session.query(PregeneratedImage.prompt_key, func.count(PregeneratedImage.id))
+            .filter(PregeneratedImage.prompt_key.in_([p['key'] for p in trending]),
+                    PregeneratedImage.served_at.is_(None),
+                    PregeneratedImage.created_at >= PregenerationService._ttl_cutoff())
+            .group_by(PregeneratedImage.prompt_key)
+            .all()
+        )
+        pair = next((p for p in trending if stocked.get(p['key'], 0) < Config.PREGEN_DEPTH), None)
+        if pair is None:
+            return None
+
+        day = datetime.utcnow().date()
+        if not PregenerationService.reserve():
+            return None
+        # Don't hold a connection open for the length of the render
+        db.session.rollback()
+        # Same prompt the live path sends: style is already folded into improved_prompt
+        image_url = stability.render_image(pair['improved_prompt'])
+        if not image_url:
+            PregenerationService.release(day)
+            return None
+
+        image = PregeneratedImage(
+            prompt_key=pair['key'],
+            original_prompt=pair['original_prompt'],
+            improved_prompt=pair['improved_prompt'],
+            image_url=image_url,
+            ai_enhanced=pair['ai_enhanced'],
+            style=pair['style']
+        )
+        db.session.add(image)
+        db.session.commit()
+        log.info('rendered', prompt=pair['original_prompt'], style=pair['style'], requests=pair['count'])
+        return image
+
+    @staticmethod
+    def prune():
+        """Drop claimed and expired renders"""
+        deleted = PregeneratedImage.query\
+            .filter((PregeneratedImage.served_at.isnot(None)) |
+                    (PregeneratedImage.created_at < PregenerationService._ttl_cutoff()))\
+            .delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+    @staticmethod
+    def start_scheduler(app, stability):
+        def loop():
+            while True:
+                time.sleep(Config.PREGEN_INTERVAL_SECONDS)
+                with app.app_context():
+                    try:
+                        if not HealthSupervisor.acquire_lease(PREGEN_LEASE, Config.PREGEN_LEASE_SECONDS):
+                            continue
+                        PregenerationService.prune()
+                        PregenerationService.run_once(stability)
+                    except Exception as e:
+                        db.session.rollback()
+                        log.error('failed', error=str(e))
+
+        thread = threading.Thread(target=loop, daemon=True, name='pregeneration')
+        thread.start()
+        return thread
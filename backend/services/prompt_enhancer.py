@@ -0,0 +1,103 @@
+import re
+import json
+import hashlib
+from functools import lru_cache
+from config import Config
+
+
+def _word_pattern(words, plurals=False):
+    """One case-insensitive alternation for all words, longest first, on word boundaries.
+
+    With plurals, an "s"/"es" suffix also matches and the word itself is
+    captured, so findall() returns "cat" for "cats".
+    """
+    alternatives = sorted({w.lower() for w in words}, key=lambda w: (-len(w), w))
+    body = "|".join(re.escape(w) for w in alternatives)
+    if plurals:
+        return re.compile(r"\b(" + body + r")(?:e?s)?\b", re.IGNORECASE)
+    return re.compile(r"\b(?:" + body + r")\b", re.IGNORECASE)
+
+
+class PromptEnhancer:
+    """Rule-based prompt rewriting and fallback-image matching.
+
+    The vocabulary is loaded and compiled once; every lookup is a single
+    scan with a precompiled word-boundary pattern, so "cat" no longer
+    matches inside "education" (categories still match plurals, as the
+    old substring scan did: "cats" is a cat). Choices are seeded by a hash of the prompt,
+    which makes the output deterministic and therefore cacheable.
+    """
+
+    def __init__(self, vocabulary):
+        self.descriptive_words = vocabulary['descriptive_words']
+        self.quality_terms = vocabulary['quality_terms']
+        self.image_database = vocabulary['image_database']
+        self.synonym_map = vocabulary['synonyms']
+
+        # Dict order is priority order, as in the original fallbacks
+        self.descriptive_priority = {w.lower(): i for i, w in enumerate(self.descriptive_words)}
+        self.descriptive_pattern = _word_pattern(self.descriptive_words)
+        self.word_patterns = {w.lower(): _word_pattern([w]) for w in self.descriptive_words}
+        self.quality_pattern = _word_pattern(self.quality_terms)
+
+        self.category_for_word = {}
+        self.category_priority = {}
+        for i, category in enumerate(self.image_database):
+            self.category_priority[category] = i
+            for word in [category] + self.synonym_map.get(category, []):
+                self.category_for_word.setdefault(word.lower(), category)
+        self.category_pattern = _word_pattern(self.category_for_word, plurals=True)
+
+        # Outputs depend only on their inputs, so repeated prompts are served from memory
+        self.improve = lru_cache(maxsize=Config.PROMPT_ENHANCER_CACHE_SIZE)(self.improve)
+        self.fallback_image = lru_cache(maxsize=Config.PROMPT_ENHANCER_CACHE_SIZE)(self.fallback_image)
+
+    @classmethod
+    def from_file(cls, path=None):
+        with open(path or Config.PROMPT_VOCABULARY_PATH, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    @staticmethod
+    def seed(*parts):
+        digest = hashlib.blake2b('\x1f'.join(parts).encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+
+    def improve(self, prompt):
+        """Swap the highest-priority descriptive word and add a quality term if missing"""
+        seed = self.seed(prompt)
+        improved = prompt
+
+        matches = self.descriptive_pattern.findall(prompt)
+        if matches:
+            word = min((m.lower() for m in matches), key=self.descriptive_priority.__getitem__)
+            options = self.descriptive_words[word]
+            improved = self.word_patterns[word].sub(options[seed % len(options)], improved)
+
+        if not self.quality_pattern.search(improved):
+            improved += f", {self.quality_terms[(seed >> 16) % len(self.quality_terms)]}"
+
+        return improved
+
+    def match_category(self, prompt):
+        matches = self.category_pattern.findall(prompt)
+        if not matches:
+            return None
+        return min((self.category_for_word[m.lower()] for m in matches), key=self.category_priority.__getitem__)
+
+    def fallback_image(self, prompt, style):
+        """Return (picsum_url, category) for a prompt, category is None for the seeded default"""
+        seed = self.seed(prompt, style or '')
+        category = self.match_category(prompt)
+        if category:
+            ids = self.image_database[category]
+            return f"https://picsum.photos/id/{ids[seed % len(ids)]}/512/512", category
+
+        # Same seed as before the engine existed, so stored URLs stay stable
+        picsum_seed = hashlib.md5(f"{prompt}_{style}".encode()).hexdigest()[:10]
+        return f"https://picsum.photos/seed/{picsum_seed}/512/512", None
+
+    def synonyms(self, word):
+        return self.synonym_map.get(word, [])
+
+
+prompt_enhancer = PromptEnhancer.from_file()
@@ -0,0 +1,240 @@
+import re
+import time
+import zlib
+import threading
+import numpy as np
+from config import Config
+from models.models import db, GeneratedImage
+from utils import tracing
+from utils.log import get_logger
+
+log = get_logger('prompt_index')
+
+SIGNATURE_BITS = 64
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize_prompt(prompt):
+    return ' '.join(_WORD_RE.findall((prompt or '').lower()))
+
+
+class PromptSimilarityIndex:
+    """In-memory cosine index over hashed n-gram vectors of original prompts.
+
+    Every prompt becomes an L2-normalised vector of hashed character
+    trigrams and words, stored as a row of a float16 matrix. A 64-bit
+    random-hyperplane signature is kept per row so a lookup first narrows
+    the whole index to a few hundred candidates with one XOR/popcount pass,
+    then reranks only those with exact cosine similarity. That keeps lookups
+    in the low milliseconds at 1M rows where a full matrix-vector product
+    would not be.
+
+    Rows are appended from the database by id watermark, so every worker
+    picks up rows inserted by other workers on its next lookup. Rows
+    deleted since (retention, user deletes) are noticed when a lookup
+    returns them and dropped from then on. The first
+    full load runs in a background thread at startup (warm), retried with
+    backoff if it fails; until it finishes, lookups return no suggestions
+    rather than load in a request.
+    """
+
+    def __init__(self, dim=None, chunk_size=5000):
+        self.dim = dim or Config.PROMPT_INDEX_DIM
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()  # one refresh at a time, so no row is appended twice
+        self.loaded = False
+        self.size = 0
+        self.last_id = 0
+        self.styles = {}
+
+        rng = np.random.default_rng(0x5EED)
+        self.planes = rng.standard_normal((self.dim, SIGNATURE_BITS)).astype(np.float32)
+        self._allocate(1024)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self.vectors = np.zeros((capacity, self.dim), dtype=np.float16)
+        self.signatures = np.zeros(capacity, dtype=np.uint64)
+        self.image_ids = np.zeros(capacity, dtype=np.int64)
+        self.user_ids = np.zeros(capacity, dtype=np.int64)
+        self.style_ids = np.zeros(capacity, dtype=np.int32)
+        self._xor = np.empty(capacity, dtype=np.uint64)
+        self._distance = np.empty(capacity, dtype=np.uint8)
+
+    def _grow(self, needed):
+        if needed <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        old = (self.vectors, self.signatures, self.image_ids, self.user_ids, self.style_ids)
+        self._allocate(capacity)
+        for new, previous in zip(
+            (self.vectors, self.signatures, self.image_ids, self.user_ids, self.style_ids), old
+        ):
+            new[:self.size] = previous[:self.size]
+
+    def vectorize(self, prompts):
+        """Hash prompts into an (n, dim) float32 matrix of unit rows"""
+        matrix = np.zeros((len(prompts), self.dim), dtype=np.float32)
+        mask = self.dim - 1 if self.dim & (self.dim - 1) == 0 else None
+        for row, prompt in enumerate(prompts):
+            text = normalize_prompt(prompt)
+            padded = f" {text} "
+            features = [padded[i:i + 3] for i in range(len(padded) - 2)] + text.split()
+            if not features:
+                continue
+            hashes = np.fromiter(
+                (zlib.crc32(f.encode('utf-8')) for f in features), dtype=np.uint32, count=len(features)
+            )
+            buckets = hashes & mask if mask is not None else hashes % self.dim
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0)
+            matrix[row] = np.bincount(buckets.astype(np.intp), weights=signs, minlength=self.dim)
+
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix
+
+    def _signatures(self, matrix):
+        bits = (matrix @ self.planes) > 0
+        return np.packbits(bits, axis=1, bitorder='little').view(np.uint64).ravel()
+
+    def _style_id(self, style):
+        return self.styles.setdefault(style or 'realistic', len(self.styles))
+
+    def append(self, image_ids, user_ids, prompts, styles):
+        if not image_ids:
+            return
+        matrix = self.vectorize(prompts)
+        signatures = self._signatures(matrix)
+        with self.lock:
+            start, end = self.size, self.size + len(image_ids)
+            self._grow(end)
+            self.vectors[start:end] = matrix
+            self.signatures[start:end] = signatures
+            self.image_ids[start:end] = image_ids
+            self.user_ids[start:end] = user_ids
+            self.style_ids[start:end] = [self._style_id(s) for s in styles]
+            self.size = end
+            self.last_id = max(self.last_id, int(max(image_ids)))
+
+    def discard(self, image_ids):
+        """Stop matching rows whose images no longer exist; their slots stay allocated"""
+        with self.lock:
+            rows = np.flatnonzero(np.isin(self.image_ids[:self.size], list(image_ids)))
+            self.style_ids[rows] = -1
+
+    def refresh(self):
+        """Append rows created since the last refresh, in id order"""
+        with self.refresh_lock:
+            while True:
+                rows = db.session.query(
+                        GeneratedImage.id,
+                        GeneratedImage.user_id,
+                        GeneratedImage.original_prompt,
+                        GeneratedImage.style
+                    )\
+                    .filter(GeneratedImage.id > self.last_id)\
+                    .order_by(GeneratedImage.id)\
+                    .limit(self.chunk_size)\
+                    .all()
+                if rows:
+                    ids, users, prompts, styles = zip(*rows)
+                    self.append(list(ids), list(users), list(prompts), list(styles))
+                if len(rows) < self.chunk_size:
+                    break
+            self.loaded = True
+
+    def warm(self, app):
+        """Load the index in a background thread, retrying with backoff until it succeeds"""
+        def load():
+            delay = Config.PROMPT_INDEX_RETRY_BASE_SECONDS
+            while not self.loaded:
+                with app.app_context():
+                    try:
+                        self.refresh()
+                        log.info('loaded', size=self.size)
+                    except Exception as e:
+                        log.error('load_failed', error=str(e), retry_in=delay)
+                    finally:
+                        db.session.remove()
+                if not self.loaded:
+                    time.sleep(delay)
+                    delay = min(delay * 2, Config.PROMPT_INDEX_RETRY_MAX_SECONDS)
+
+        thread = threading.Thread(target=load, daemon=True, name='prompt-index')
+        thread.start()
+        return thread
+
+    def search(self, prompt, k=5, min_similarity=0.0, user_id=None, style=None, max_candidates=512):
+        """Return up to k (image_id, similarity) pairs, best first"""
+        query = self.vectorize([prompt])
+        if not query.any():
+            return []
+        signature = self._signatures(query)[0]
+        query = query[0]
+
+        with self.lock:
+            n = self.size
+            if n == 0:
+                return []
+            np.bitwise_xor(self.signatures[:n], signature, out=self._xor[:n])
+            distance = np.bitwise_count(self._xor[:n], out=self._distance[:n])
+
+            if min_similarity > 0:
+                # Hamming distance between signatures grows with the angle
+                # between vectors; 1.5x slack keeps recall high near the cutoff
+                angle = np.arccos(min(min_similarity, 1.0))
+                radius = int(SIGNATURE_BITS * angle / np.pi * 1.5) + 2
+                candidates = np.flatnonzero(distance <= radius)
+            else:
+                candidates = np.arange(n)
+            candidates = candidates[self.style_ids[candidates] >= 0]  # skip discarded rows
+            if user_id is not None:
+                candidates = candidates[self.user_ids[candidates] == user_id]
+            if style is not None:
+                style_id = self.styles.get(style)
+                if style_id is None:
+                    return []
+                candidates = candidates[self.style_ids[candidates] == style_id]
+            if candidates.size > max_candidates:
+                nearest = np.argpartition(distance[candidates], max_candidates)[:max_candidates]
+                candidates = candidates[nearest]
+            if candidates.size == 0:
+                return []
+
+            scores = np.minimum(self.vectors[candidates].astype(np.float32) @ query, 1.0)
+            keep = scores >= min_similarity
+            candidates, scores = candidates[keep], scores[keep]
+            order = np.argsort(-scores)[:k]
+            return [(int(self.image_ids[candidates[i]]), float(scores[i])) for i in order]
+
+    @tracing.traced('PromptSimilarityIndex.find_similar')
+    def find_similar(self, user_id, prompt, style=None, k=None):
+        """Existing images whose prompt is close enough to reuse instead of generating"""
+        if not self.loaded:
+            return []  # still warming up; suggestions are optional
+        self.refresh()
+        scope_user = user_id if Config.SIMILAR_PROMPT_SCOPE == 'user' else None
+        matches = self.search(
+            prompt,
+            k=k or Config.SIMILAR_PROMPT_LIMIT,
+            min_similarity=Config.SIMILAR_PROMPT_THRESHOLD,
+            user_id=scope_user,
+            style=style
+        )
+        if not matches:
+            return []
+
+        similarity = dict(matches)
+        images = GeneratedImage.query.filter(GeneratedImage.id.in_(list(similarity))).all()
+        if len(images) < len(similarity):
+            self.discard(set(similarity).difference(image.id for image in images))
+        return sorted(
+            ((image, similarity[image.id]) for image in images),
+            key=lambda pair: -pair[1]
+        )
+
+
+prompt_index = PromptSimilarityIndex()
@@ -0,0 +1,80 @@
+import random
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from models.models import db, GeneratedImage
+from services.image_hash import compute_hashes, image_hash_index
+from services.media_storage import MEDIA_REF_PREFIX, release_media
+from services.snapshot_service import PublicSnapshotService
+from services.stability_service_clean import DEFAULT_STEPS, MAX_SEED
+from utils.log import get_logger
+
+log = get_logger('refine')
+
+refine_executor = ThreadPoolExecutor(max_workers=Config.REFINE_WORKERS, thread_name_prefix='refine')
+
+
+class RefineService:
+    """Draft-then-refine generation.
+
+    The draft is rendered in the request with DRAFT_STEPS steps on a smaller
+    canvas where the engine allows it. The full render then runs in the
+    background with the same prompt, seed, cfg_scale and engine, and
+    replaces the draft on the same GeneratedImage row; a draft stored as a
+    media file is deleted once nothing refers to it. A refine lost with its
+    process would leave the row 'pending' for good, which also keeps
+    tiering away from it, so expire_stale marks such rows failed.
+    """
+
+    @staticmethod
+    def draft_options(options):
+        """Pin a seed on options and return the options for the draft pass"""
+        options.setdefault('seed', random.randint(0, MAX_SEED))
+        steps = min(Config.DRAFT_STEPS, options.get('steps', DEFAULT_STEPS))
+        return dict(options, steps=steps, draft=True)
+
+    @staticmethod
+    def schedule(app, stability, image_id, prompt, options, draft_options):
+        """Queue the full render; the draft's engine is reused so the seed means the same image"""
+        refine_options = dict(options, engine=draft_options['engine'])
+        return refine_executor.submit(RefineService.refine, app, stability, image_id, prompt, refine_options)
+
+    @staticmethod
+    def refine(app, stability, image_id, prompt, options):
+        image_url = stability.render_image(prompt, options=options)
+        with app.app_context():
+            try:
+                image = db.session.get(GeneratedImage, image_id)
+                if image is None:  # deleted while rendering
+                    return None
+                draft_url = image.image_url
+                if image_url:
+                    image.image_url = image_url
+                    image.phash, image.content_hash = compute_hashes(image_url)
+                    image.refine_status = 'done'
+                else:
+                    image.refine_status = 'failed'
+                db.session.commit()
+                log.info('finished', image_id=image_id, status=image.refine_status)
+                if image_url:
+                    image_hash_index.add(image.id, image.user_id, image.phash)
+                    if draft_url.startswith(MEDIA_REF_PREFIX) and draft_url != image_url:
+                        release_media([draft_url[len(MEDIA_REF_PREFIX):]])
+                    PublicSnapshotService.image_changed(image_id)
+                return image.refine_status
+            except Exception as e:
+                db.session.rollback()
+                log.error('failed', image_id=image_id, error=str(e))
+                return None
+
+    @staticmethod
+    def expire_stale():
+        """Mark refines pending for over REFINE_STALE_MINUTES as failed; returns how many"""
+        cutoff = datetime.utcnow() - timedelta(minutes=Config.REFINE_STALE_MINUTES)
+        expired = GeneratedImage.query\
+            .filter(GeneratedImage.refine_status == 'pending', GeneratedImage.created_at < cutoff)\
+            .update({'refine_status': 'failed'}, synchronize_session=False)
+        db.session.commit()
+        if expired:
+            log.warning('expired_stale', count=expired)
+        return expired
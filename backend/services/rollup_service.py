@@ -0,0 +1,280 @@
+import time
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, insert, update
+from sqlalchemy.exc import IntegrityError
+from config import Config
+from models.models import db, GeneratedImage, UsageRollup, EngineRollup, RollupWatermark
+from utils.log import get_logger
+
+log = get_logger('rollups')
+
+GRANULARITIES = ('hour', 'day')
+USAGE_WATERMARK = 'usage_rollups'
+
+
+def bucket_start(moment, granularity):
+    moment = moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0) if granularity == 'day' else moment
+
+
+def _ceil_bucket(moment, granularity):
+    start = bucket_start(moment, granularity)
+    if start == moment:
+        return start
+    return start + (timedelta(days=1) if granularity == 'day' else timedelta(hours=1))
+
+
+class EngineAttempts:
+    """Stability attempts per engine and hour, held in memory until the next flush"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = Counter()  # (hour, engine, succeeded) -> attempts
+
+    def record(self, engine, succeeded):
+        key = (bucket_start(datetime.utcnow(), 'hour'), engine, bool(succeeded))
+        with self.lock:
+            self.pending[key] += 1
+
+    def drain(self):
+        with self.lock:
+            pending, self.pending = self.pending, Counter()
+        return pending
+
+    def restore(self, pending):
+        with self.lock:
+            self.pending.update(pending)
+
+
+engine_attempts = EngineAttempts()
+
+
+class RollupService:
+    """Hourly and daily usage rollups, so analytics never scan generated_images.
+
+    Generations are folded in by a catch-up job that walks generated_images
+    in id order past a stored watermark. The watermark advances with a
+    compare-and-set in the same transaction as the rollup increments, so
+    every worker can run the job and each row is still counted exactly once.
+    Engine attempts never reach the database on their own; they are counted
+    in process and flushed by the same job.
+    """
+
+    @staticmethod
+    def _increment(model, key, counts):
+        """Add counts to the rollup row at key, creating it on first use"""
+        result = db.session.execute(
+            update(model)
+            .where(*(getattr(model, column) == value for column, value in key.items()))
+            .values({column: getattr(model, column) + n for column, n in counts.items()})
+        )
+        if not result.rowcount:
+            db.session.execute(insert(model).values(**key, **counts))
+
+    @staticmethod
+    def catch_up(batch_size=None):
+        """Fold new generated_images rows into usage_rollups; returns the number of rows folded"""
+        batch_size = batch_size or Config.ROLLUP_BATCH_SIZE
+        # Rows younger than this may still have lower-id neighbours in flight
+        settled = datetime.utcnow() - timedelta(seconds=Config.ROLLUP_SETTLE_SECONDS)
+        # Fallback placeholders are the only remote URLs; every stored form of a real render
+        # (data:, media://, image:// after dedup, archive:// after tiering) counts as rendered
+        rendered = and_(GeneratedImage.image_url.notlike('http://%'),
+                        GeneratedImage.image_url.notlike('https://%'))
+        folded = 0
+        while True:
+            watermark = db.session.get(RollupWatermark, USAGE_WATERMARK)
+            last_id = watermark.last_id if watermark else 0
+            rows = db.session.query(
+                GeneratedImage.id,
+                GeneratedImage.created_at,
+                GeneratedImage.style,
+                GeneratedImage.ai_enhanced,
+                rendered.label('rendered')
+            ).filter(GeneratedImage.id > last_id)\
+                .order_by(GeneratedImage.id)\
+                .limit(batch_size)\
+                .all()
+            full_batch = len(rows) == batch_size
+            young = next((i for i, row in enumerate(rows) if row.created_at > settled), None)
+            if young is not None:
+                rows, full_batch = rows[:young], False
+            if not rows:
+                db.session.rollback()
+                return folded
+
+            # Claim the batch first; losing the race means another worker is folding it
+            if watermark is None:
+                try:
+                    db.session.execute(insert(RollupWatermark).values(name=USAGE_WATERMARK, last_id=rows[-1].id))
+                except IntegrityError:
+                    db.session.rollback()
+                    return folded
+            else:
+                claimed = db.session.execute(
+                    update(RollupWatermark)
+                    .where(RollupWatermark.name == USAGE_WATERMARK, RollupWatermark.last_id == last_id)
+                    .values(last_id=rows[-1].id)
+                )
+                if not claimed.rowcount:
+                    db.session.rollback()
+                    return folded
+
+            counts = {}
+            for row in rows:
+                for granularity in GRANULARITIES:
+                    key = (granularity, bucket_start(row.created_at, granularity), row.style or 'realistic')
+                    bucket = counts.setdefault(key, Counter())
+                    bucket['generations'] += 1
+                    bucket['ai_enhanced'] += bool(row.ai_enhanced)
+                    bucket['placeholders'] += not row.rendered
+            for (granularity, start, style), bucket in counts.items():
+                RollupService._increment(
+                    UsageRollup,
+                    {'granularity': granularity, 'bucket_start': start, 'style': style},
+                    {'generations': bucket['generations'], 'ai_enhanced': bucket['ai_enhanced'],
+                     'placeholders': bucket['placeholders']}
+                )
+            db.session.commit()
+            folded += len(rows)
+            if not full_batch:
+                return folded
+
+    @staticmethod
+    def flush_engine_attempts():
+        """Write this process's engine attempt counters to engine_rollups"""
+        pending = engine_attempts.drain()
+        if not pending:
+            return 0
+        counts = {}
+        for (hour, engine, succeeded), n in pending.items():
+            for granularity in GRANULARITIES:
+                bucket = counts.setdefault((granularity, bucket_start(hour, granularity), engine), Counter())
+                bucket['attempts'] += n
+                bucket['successes'] += n if succeeded else 0
+        try:
+            for (granularity, start, engine), bucket in counts.items():
+                RollupService._increment(
+                    EngineRollup,
+                    {'granularity': granularity, 'bucket_start': start, 'engine': engine},
+                    {'attempts': bucket['attempts'], 'successes': bucket['successes']}
+                )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            engine_attempts.restore(pending)
+            raise
+        return sum(pending.values())
+
+    @staticmethod
+    def rebuild():
+        """Drop the usage rollups and watermark so the next catch-up recounts every row"""
+        UsageRollup.query.delete(synchronize_session=False)
+        RollupWatermark.query.filter_by(name=USAGE_WATERMARK).delete(synchronize_session=False)
+        db.session.commit()
+
+    @staticmethod
+    def _covering_ranges(start, end, granularity):
+        """(granularity, from, to) rollup ranges that cover [start, end) exactly.
+
+        Whole days come from the daily rollups and the partial days at
+        either edge from the hourly ones.
+        """
+        if granularity == 'hour':
+            return [('hour', start, end)]
+        first_day, last_day = _ceil_bucket(start, 'day'), bucket_start(end, 'day')
+        if first_day >= last_day:
+            return [('hour', start, end)]
+        ranges = [('hour', start, first_day), ('day', first_day, last_day), ('hour', last_day, end)]
+        return [r for r in ranges if r[1] < r[2]]
+
+    @staticmethod
+    def _rows(model, columns, ranges):
+        return db.session.query(model.bucket_start, *columns).filter(or_(*(
+            and_(model.granularity == granularity, model.bucket_start >= lo, model.bucket_start < hi)
+            for granularity, lo, hi in ranges
+        ))).all()
+
+    @staticmethod
+    def analytics(start, end, granularity=None):
+        """Usage between start and end (naive UTC), answered from the rollups alone.
+
+        The range is widened to whole hours. granularity sets the series
+        resolution and defaults to hourly for ranges up to
+        ROLLUP_HOURLY_SERIES_DAYS days, daily beyond that.
+        """
+        start, end = bucket_start(start, 'hour'), _ceil_bucket(end, 'hour')
+        if end <= start:
+            raise ValueError('end must be after start')
+        if granularity is None:
+            granularity = 'hour' if end - start <= timedelta(days=Config.ROLLUP_HOURLY_SERIES_DAYS) else 'day'
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"granularity must be one of: {', '.join(GRANULARITIES)}")
+        if granularity == 'hour' and end - start > timedelta(days=Config.ROLLUP_MAX_HOURLY_DAYS):
+            raise ValueError(f'Hourly series are limited to {Config.ROLLUP_MAX_HOURLY_DAYS} days')
+
+        ranges = RollupService._covering_ranges(start, end, granularity)
+        totals = Counter()
+        series = {}
+        styles = Counter()
+        for row in RollupService._rows(UsageRollup, (
+            UsageRollup.style, UsageRollup.generations, UsageRollup.ai_enhanced, UsageRollup.placeholders
+        ), ranges):
+            counts = {'generations': row.generations, 'ai_enhanced': row.ai_enhanced,
+                      'placeholders': row.placeholders}
+            totals.update(counts)
+            series.setdefault(bucket_start(row.bucket_start, granularity), Counter()).update(counts)
+            styles[row.style] += row.generations
+
+        engines = {}
+        for row in RollupService._rows(EngineRollup, (
+            EngineRollup.engine, EngineRollup.attempts, EngineRollup.successes
+        ), ranges):
+            engines.setdefault(row.engine, Counter()).update(attempts=row.attempts, successes=row.successes)
+
+        generations = totals['generations']
+        return {
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'granularity': granularity,
+            'totals': {
+                'generations': generations,
+                'ai_enhanced': totals['ai_enhanced'],
+                'placeholders': totals['placeholders'],
+                'ai_enhanced_ratio': round(totals['ai_enhanced'] / generations, 4) if generations else None,
+                'placeholder_ratio': round(totals['placeholders'] / generations, 4) if generations else None
+            },
+            'series': [
+                {'bucket_start': bucket.isoformat(), 'generations': counts['generations'],
+                 'ai_enhanced': counts['ai_enhanced'], 'placeholders': counts['placeholders']}
+                for bucket, counts in sorted(series.items())
+            ],
+            'styles': dict(styles.most_common()),
+            'engines': {
+                engine: {
+                    'attempts': counts['attempts'],
+                    'successes': counts['successes'],
+                    'success_rate': round(counts['successes'] / counts['attempts'], 4) if counts['attempts'] else None
+                }
+                for engine, counts in sorted(engines.items())
+            }
+        }
+
+    @staticmethod
+    def start_scheduler(app):
+        def loop():
+            while True:
+                time.sleep(Config.ROLLUP_INTERVAL_SECONDS)
+                with app.app_context():
+                    try:
+                        RollupService.catch_up()
+                        RollupService.flush_engine_attempts()
+                    except Exception as e:
+                        db.session.rollback()
+                        log.error('failed', error=str(e))
+
+        thread = threading.Thread(target=loop, daemon=True, name='usage-rollups')
+        thread.start()
+        return thread
@@ -0,0 +1,199 @@
+import re
+import json
+import base64
+from sqlalchemy import text
+from models.models import db
+from utils.log import get_logger
+
+log = get_logger('search')
+
+FTS_TABLE = 'generated_images_fts'
+
+_SQLITE_SETUP = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        original_prompt, improved_prompt,
+        content='generated_images', content_rowid='id',
+        tokenize='porter unicode61'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON generated_images BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, original_prompt, improved_prompt)
+        VALUES (new.id, new.original_prompt, new.improved_prompt);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON generated_images BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, original_prompt, improved_prompt)
+        VALUES ('delete', old.id, old.original_prompt, old.improved_prompt);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au
+        AFTER UPDATE OF original_prompt, improved_prompt ON generated_images BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, original_prompt, improved_prompt)
+        VALUES ('delete', old.id, old.original_prompt, old.improved_prompt);
+        INSERT INTO {FTS_TABLE}(rowid, original_prompt, improved_prompt)
+        VALUES (new.id, new.original_prompt, new.improved_prompt);
+    END""",
+]
+
+# A generated column keeps the vector in sync on insert/update without triggers
+_POSTGRES_SETUP = [
+    """ALTER TABLE generated_images ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(original_prompt, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(improved_prompt, '')), 'B')
+        ) STORED""",
+    """CREATE INDEX IF NOT EXISTS ix_generated_images_search_vector
+        ON generated_images USING GIN (search_vector)""",
+]
+
+# bm25() is needed for every match to order them, but snippet() only for the page:
+# the outer query (CROSS JOIN keeps page as the driving table) re-matches just those rowids
+_SQLITE_SEARCH = f"""
+    WITH matches AS (
+        SELECT gi.id, bm25({FTS_TABLE}, 2.0, 1.0) AS score
+        FROM {FTS_TABLE}
+        JOIN generated_images gi ON gi.id = {FTS_TABLE}.rowid
+        WHERE {FTS_TABLE} MATCH :query AND gi.user_id = :user_id
+    ), page AS (
+        SELECT * FROM matches
+        WHERE score > :after_score OR (score = :after_score AND id > :after_id)
+        ORDER BY score, id
+        LIMIT :limit
+    )
+    SELECT gi.id, gi.original_prompt, gi.improved_prompt, gi.image_url,
+           gi.ai_enhanced, gi.style, gi.created_at, page.score,
+           snippet({FTS_TABLE}, -1, '<mark>', '</mark>', '…', 12) AS snippet
+    FROM page
+    CROSS JOIN {FTS_TABLE}
+    JOIN generated_images gi ON gi.id = page.id
+    WHERE {FTS_TABLE} MATCH :query AND {FTS_TABLE}.rowid = page.id
+    ORDER BY page.score, page.id
+"""
+
+# ts_rank is negated so both dialects page in ascending score order
+_POSTGRES_SEARCH = """
+    WITH matches AS (
+        SELECT gi.id, gi.original_prompt, gi.improved_prompt, gi.image_url,
+               gi.ai_enhanced, gi.style, gi.created_at,
+               -ts_rank_cd(gi.search_vector, q)::float8 AS score, q
+        FROM generated_images gi, websearch_to_tsquery('english', :query) q
+        WHERE gi.search_vector @@ q AND gi.user_id = :user_id
+    ), page AS (
+        SELECT * FROM matches
+        WHERE score > :after_score OR (score = :after_score AND id > :after_id)
+        ORDER BY score, id
+        LIMIT :limit
+    )
+    SELECT id, original_prompt, improved_prompt, image_url, ai_enhanced, style, created_at, score,
+           ts_headline('english', improved_prompt || ' — ' || original_prompt, q,
+                       'StartSel=<mark>, StopSel=</mark>, MaxWords=20, MinWords=8') AS snippet
+    FROM page
+    ORDER BY score, id
+"""
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class SearchService:
+    fts_available = False
+
+    @staticmethod
+    def init_index():
+        """Create the full-text index and its sync hooks if missing"""
+        dialect = db.engine.dialect.name
+        try:
+            if dialect == 'sqlite':
+                created = not db.session.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE name = :name"), {'name': FTS_TABLE}
+                ).first()
+                for statement in _SQLITE_SETUP:
+                    db.session.execute(text(statement))
+                if created:
+                    # Index rows that existed before the FTS table did
+                    db.session.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+            elif dialect == 'postgresql':
+                for statement in _POSTGRES_SETUP:
+                    db.session.execute(text(statement))
+            else:
+                return False
+            db.session.commit()
+            SearchService.fts_available = True
+        except Exception as e:
+            db.session.rollback()
+            log.warning('fts_unavailable', fallback='like', error=str(e))
+            SearchService.fts_available = False
+        return SearchService.fts_available
+
+    @staticmethod
+    def search_images(user_id, query, cursor=None, limit=20):
+        """Ranked search over a user's prompts with keyset pagination.
+
+        Returns (rows, next_cursor). Each row carries a `snippet` with
+        matches wrapped in <mark> tags.
+        """
+        tokens = _TOKEN_RE.findall(query or '')
+        if not tokens:
+            raise ValueError('Search query is required')
+
+        after_score, after_id = SearchService._decode_cursor(cursor)
+        params = {
+            'user_id': user_id,
+            'after_score': after_score,
+            'after_id': after_id,
+            'limit': limit + 1,
+        }
+
+        if not SearchService.fts_available:
+            return SearchService._search_like(user_id, tokens, after_id, limit)
+
+        if db.engine.dialect.name == 'sqlite':
+            # Quote every token so user input can't inject FTS syntax; the last
+            # one is a prefix match so results appear while the user is typing
+            params['query'] = ' '.join(f'"{t}"' for t in tokens) + '*'
+            statement = _SQLITE_SEARCH
+        else:
+            params['query'] = ' '.join(tokens)
+            statement = _POSTGRES_SEARCH
+
+        rows = db.session.execute(text(statement), params).mappings().all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = SearchService._encode_cursor(rows[-1]['score'], rows[-1]['id'])
+        return rows, next_cursor
+
+    @staticmethod
+    def _search_like(user_id, tokens, after_id, limit):
+        """Unranked fallback for databases without a full-text index"""
+        conditions = []
+        params = {'user_id': user_id, 'limit': limit + 1}
+        for i, token in enumerate(tokens):
+            params[f't{i}'] = f'%{token}%'
+            conditions.append(f"(original_prompt LIKE :t{i} OR improved_prompt LIKE :t{i})")
+
+        rows = db.session.execute(text(f"""
+            SELECT id, original_prompt, improved_prompt, image_url, ai_enhanced, style, created_at,
+                   0.0 AS score, improved_prompt AS snippet
+            FROM generated_images
+            WHERE user_id = :user_id AND id > :after_id AND {' AND '.join(conditions)}
+            ORDER BY id
+            LIMIT :limit
+        """), {**params, 'after_id': after_id}).mappings().all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = SearchService._encode_cursor(0.0, rows[-1]['id'])
+        return rows, next_cursor
+
+    @staticmethod
+    def _encode_cursor(score, image_id):
+        payload = json.dumps([score, image_id]).encode('utf-8')
+        return base64.urlsafe_b64encode(payload).decode('ascii')
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        if not cursor:
+            return float('-inf'), 0
+        try:
+            score, image_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            return float(score), int(image_id)
+        except Exception:
+            raise ValueError('Invalid cursor')
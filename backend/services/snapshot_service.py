@@ -0,0 +1,511 @@
+import os
+import re
+import json
+import time
+import base64
+import shutil
+import hashlib
+import tempfile
+import threading
+from functools import lru_cache
+from sqlalchemy import delete, desc, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from config import Config
+from models.models import db, User, GeneratedImage, Collection, CollectionItem, SnapshotRebuild
+from services.health_service import HealthSupervisor
+from services.image_service import ImageService
+from services.media_storage import extension_for, media_path, media_url, store_bytes
+from utils.log import get_logger
+
+log = get_logger('snapshots')
+
+SNAPSHOT_URL_PREFIX = '/api/public/snapshots/'
+_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+SNAPSHOT_LEASE = 'snapshots'
+_last_prune = 0.0
+_renewed_window = None
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _ref_path(key):
+    return os.path.join(Config.SNAPSHOT_ROOT, 'refs', *key.split('/'))
+
+
+def _object_path(digest):
+    return os.path.join(Config.SNAPSHOT_ROOT, 'objects', digest[:2], f"{digest}.json")
+
+
+def snapshot_url(digest):
+    return f"{SNAPSHOT_URL_PREFIX}{digest}.json"
+
+
+def feed_key(page):
+    return f"feed/{page}"
+
+
+def collection_key(collection_id, page):
+    return f"collections/{collection_id}/{page}"
+
+
+def published_collection_ids():
+    """Ids of the collections that currently have pages published"""
+    directory = os.path.join(Config.SNAPSHOT_ROOT, 'refs', 'collections')
+    if not os.path.isdir(directory):
+        return set()
+    return {int(name) for name in os.listdir(directory) if name.isdigit()}
+
+
+def _live_digests():
+    """Digests some ref currently points at"""
+    live = set()
+    for root, _, files in os.walk(os.path.join(Config.SNAPSHOT_ROOT, 'refs')):
+        for name in files:
+            with open(os.path.join(root, name)) as f:
+                live.add(f.read().strip())
+    return live
+
+
+def read_ref(key):
+    """Digest of the snapshot currently published under key, or None"""
+    try:
+        with open(_ref_path(key)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+@lru_cache(maxsize=Config.SNAPSHOT_CACHE_SIZE)
+def _load_object(digest):
+    with open(_object_path(digest), 'rb') as f:
+        return f.read()
+
+
+def load_object(digest):
+    """Snapshot body by digest, or None. Bodies never change, so they are cached in memory."""
+    if not _DIGEST_RE.match(digest or ''):
+        return None
+    if not os.path.exists(_object_path(digest)):
+        return None  # purged, possibly by the worker holding the lease; don't serve it from cache
+    try:
+        return _load_object(digest)
+    except OSError:
+        return None
+
+
+class PublicSnapshotService:
+    """Public collection pages, rendered ahead of time into immutable JSON files.
+
+    Every page is stored once under the SHA-256 of its body
+    (objects/ab/<digest>.json) and published under a stable key
+    (refs/feed/<page>, refs/collections/<id>/<page>) that holds the digest.
+    Anonymous reads are a ref lookup plus a cached file read, with no
+    database access. Pages are rebuilt only when a public collection (or
+    one that just stopped being public) changes, and never in the request:
+    writes queue the collection in snapshot_rebuilds and a background job
+    drains the queue every SNAPSHOT_REBUILD_SECONDS. The job runs only
+    while its process holds the 'snapshots' lease, so a single writer
+    publishes refs and a later publish always comes from a later read.
+    """
+
+    @staticmethod
+    def _publish(key, payload):
+        body = json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        digest = hashlib.sha256(body).hexdigest()
+        path = _object_path(digest)
+        if not os.path.exists(path):
+            _write_atomic(path, body)
+        if read_ref(key) != digest:
+            _write_atomic(_ref_path(key), digest.encode('ascii'))
+        return digest
+
+    @staticmethod
+    def _unpublish_pages(prefix, keep):
+        """Remove the refs of pages past `keep` under a feed or collection prefix"""
+        directory = _ref_path(prefix)
+        if not os.path.isdir(directory):
+            return
+        if keep == 0:
+            shutil.rmtree(directory, ignore_errors=True)
+            return
+        for name in os.listdir(directory):
+            if name.isdigit() and int(name) > keep:
+                os.remove(os.path.join(directory, name))
+
+    @staticmethod
+    def _public_image_urls(image_urls, content_hashes):
+        """Like resolve_image_urls, but host-relative and never inline.
+
+        Inline data URLs are written to media storage under their content
+        hash (the same name compaction would give them) so snapshots stay
+        small and images are cached separately. The row's content_hash
+        names the file, so a payload is only decoded the first time.
+        """
+        resolved = []
+        urls = ImageService.resolve_image_urls(image_urls, base='/', public=True)
+        for url, content_hash in zip(urls, content_hashes):
+            if url and url.startswith('data:'):
+                header, _, payload = url.partition(',')
+                extension = extension_for(header[len('data:'):].split(';')[0])
+                name = f"{content_hash}.{extension}" if content_hash else None
+                if name is None or not os.path.exists(media_path(name)):
+                    name = store_bytes(base64.b64decode(payload), extension)
+                url = media_url(name, '/', public=True)
+            resolved.append(url)
+        return resolved
+
+    @staticmethod
+    def _build_collection(collection_id):
+        """Publish every page of a public collection; returns the first page's digest or None"""
+        prefix = f"collections/{collection_id}"
+        row = db.session.query(Collection, User.username)\
+            .join(User, User.id == Collection.user_id)\
+            .filter(Collection.id == collection_id, Collection.is_public.is_(True))\
+            .first()
+        if row is None:
+            PublicSnapshotService._unpublish_pages(prefix, 0)
+            return None
+        collection, owner = row
+
+        per_page = Config.SNAPSHOT_PAGE_SIZE
+        total = db.session.query(func.count(CollectionItem.id))\
+            .filter(CollectionItem.collection_id == collection_id)\
+            .scalar()
+        pages = max(1, -(-total // per_page))
+        meta = {
+            'id': collection.id,
+            'name': collection.name,
+            'description': collection.description,
+            'owner': owner,
+            'item_count': total,
+            'created_at': collection.created_at.isoformat(),
+            'updated_at': collection.updated_at.isoformat() if collection.updated_at else None
+        }
+
+        # Last page first, so each page can link to the next one's immutable URL
+        next_digest = None
+        for page in range(pages, 0, -1):
+            items = db.session.query(
+                GeneratedImage.id,
+                GeneratedImage.original_prompt,
+                GeneratedImage.improved_prompt,
+                GeneratedImage.image_url,
+                GeneratedImage.content_hash,
+                GeneratedImage.ai_enhanced,
+                GeneratedImage.style,
+                GeneratedImage.created_at,
+                CollectionItem.added_at
+            ).join(CollectionItem, CollectionItem.image_id == GeneratedImage.id)\
+                .filter(CollectionItem.collection_id == collection_id)\
+                .order_by(desc(CollectionItem.added_at), desc(CollectionItem.id))\
+                .offset((page - 1) * per_page)\
+                .limit(per_page)\
+                .all()
+            urls = PublicSnapshotService._public_image_urls(
+                [item.image_url for item in items], [item.content_hash for item in items]
+            )
+            next_digest = PublicSnapshotService._publish(collection_key(collection_id, page), {
+                'collection': meta,
+                'images': [{
+                    'id': item.id,
+                    'original_prompt': item.original_prompt,
+                    'improved_prompt': item.improved_prompt,
+                    'image_url': image_url,
+                    'ai_enhanced': item.ai_enhanced,
+                    'style': item.style,
+                    'created_at': item.created_at.isoformat(),
+                    'added_at': item.added_at.isoformat()
+                } for item, image_url in zip(items, urls)],
+                'total': total,
+                'pages': pages,
+                'current_page': page,
+                'next': snapshot_url(next_digest) if next_digest else None
+            })
+        PublicSnapshotService._unpublish_pages(prefix, pages)
+        return next_digest
+
+    @staticmethod
+    def _build_feed():
+        """Publish the public collections feed, most recently updated first"""
+        per_page = Config.SNAPSHOT_PAGE_SIZE
+        # The cover is the most recently added image, not the newest generated one
+        cover = select(CollectionItem.image_id)\
+            .where(CollectionItem.collection_id == Collection.id)\
+            .order_by(desc(CollectionItem.added_at), desc(CollectionItem.id))\
+            .limit(1)\
+            .correlate(Collection)\
+            .scalar_subquery()
+        rows = db.session.query(
+                Collection.id,
+                Collection.name,
+                Collection.description,
+                Collection.updated_at,
+                User.username,
+                func.count(CollectionItem.id).label('item_count'),
+                cover.label('cover_image_id')
+            )\
+            .join(User, User.id == Collection.user_id)\
+            .outerjoin(CollectionItem, CollectionItem.collection_id == Collection.id)\
+            .filter(Collection.is_public.is_(True))\
+            .group_by(Collection.id, User.username)\
+            .order_by(desc(Collection.updated_at), desc(Collection.id))\
+            .limit(per_page * Config.SNAPSHOT_FEED_MAX_PAGES)\
+            .all()
+
+        cover_ids = [row.cover_image_id for row in rows if row.cover_image_id]
+        covers = db.session.query(GeneratedImage.id, GeneratedImage.image_url, GeneratedImage.content_hash)\
+            .filter(GeneratedImage.id.in_(cover_ids))\
+            .all() if cover_ids else []
+        cover_urls = dict(zip(
+            [cover.id for cover in covers],
+            PublicSnapshotService._public_image_urls([cover.image_url for cover in covers],
+                                                     [cover.content_hash for cover in covers])
+        ))
+
+        entries = []
+        for row in rows:
+            digest = read_ref(collection_key(row.id, 1))
+            if digest is None:  # made public before snapshots existed
+                digest = PublicSnapshotService._build_collection(row.id)
+            entries.append({
+                'id': row.id,
+                'name': row.name,
+                'description': row.description,
+                'owner': row.username,
+                'item_count': row.item_count,
+                'cover_image_url': cover_urls.get(row.cover_image_id),
+                'updated_at': row.updated_at.isoformat() if row.updated_at else None,
+                'url': snapshot_url(digest) if digest else None
+            })
+
+        pages = max(1, -(-len(entries) // per_page))
+        next_digest = None
+        for page in range(pages, 0, -1):
+            next_digest = PublicSnapshotService._publish(feed_key(page), {
+                'collections': entries[(page - 1) * per_page:page * per_page],
+                'total': len(entries),
+                'pages': pages,
+                'current_page': page,
+                'next': snapshot_url(next_digest) if next_digest else None
+            })
+        PublicSnapshotService._unpublish_pages('feed', pages)
+        return next_digest
+
+    @staticmethod
+    def _queue(collection_ids):
+        """Mark collections stale; a rebuild already queued just moves to the latest request"""
+        now = time.time()
+        for collection_id in collection_ids:
+            queued = db.session.execute(
+                update(SnapshotRebuild)
+                .where(SnapshotRebuild.collection_id == collection_id)
+                .values(requested_at=now)
+            )
+            if not queued.rowcount:
+                try:
+                    db.session.execute(insert(SnapshotRebuild).values(collection_id=collection_id, requested_at=now))
+                except IntegrityError:
+                    db.session.rollback()  # queued by another worker in between, which is all we need
+                    continue
+            db.session.commit()
+
+    @staticmethod
+    def collection_changed(collection_id, is_public=None):
+        """Queue a rebuild after a write to a collection.
+
+        is_public is the collection's visibility after the write when the
+        caller has it at hand; otherwise having published pages means it is
+        public. Private collections that were never published cost nothing.
+        """
+        if not is_public and read_ref(collection_key(collection_id, 1)) is None:
+            return False
+        try:
+            PublicSnapshotService._queue([collection_id])
+        except Exception as e:
+            # The write already committed; `flask rebuild-snapshots` repairs a missed rebuild
+            db.session.rollback()
+            log.error('queue_failed', collection_id=collection_id, error=str(e))
+            return False
+        if Config.SNAPSHOT_REBUILD_SECONDS <= 0:
+            PublicSnapshotService.rebuild_pending()
+        return True
+
+    @staticmethod
+    def image_changed(image_id):
+        """Rebuild the public collections that show an image whose payload changed"""
+        collection_ids = [
+            collection_id for (collection_id,) in db.session.query(CollectionItem.collection_id)
+            .join(Collection, Collection.id == CollectionItem.collection_id)
+            .filter(CollectionItem.image_id == image_id, Collection.is_public.is_(True))
+        ]
+        for collection_id in collection_ids:
+            PublicSnapshotService.collection_changed(collection_id)
+        return len(collection_ids)
+
+    @staticmethod
+    def rebuild_pending():
+        """Drain the rebuild queue, then republish the feed once; returns collections rebuilt.
+
+        Does nothing unless this process holds the snapshots lease. A
+        queue entry is only removed if no write requeued it while its
+        pages were being built.
+        """
+        if not HealthSupervisor.acquire_lease(SNAPSHOT_LEASE, Config.SNAPSHOT_LEASE_SECONDS):
+            return 0
+        PublicSnapshotService._renew_links()
+        pending = db.session.query(SnapshotRebuild.collection_id, SnapshotRebuild.requested_at).all()
+        if not pending:
+            return 0
+        rebuilt = 0
+        withdrawn = []
+        for collection_id, requested_at in pending:
+            # Renewed per collection, so a long drain never outlives the lease
+            if not HealthSupervisor.acquire_lease(SNAPSHOT_LEASE, Config.SNAPSHOT_LEASE_SECONDS):
+                return rebuilt
+            try:
+                digest = PublicSnapshotService._build_collection(collection_id)
+            except Exception as e:
+                db.session.rollback()
+                log.error('rebuild_failed', collection_id=collection_id, error=str(e))
+                continue
+            rebuilt += 1
+            if digest is None:
+                # No longer public: stays queued until its bodies are purged below
+                withdrawn.append((collection_id, requested_at))
+                continue
+            PublicSnapshotService._dequeue(collection_id, requested_at)
+        PublicSnapshotService._build_feed()
+        db.session.commit()
+        if withdrawn:
+            PublicSnapshotService._purge([collection_id for collection_id, _ in withdrawn])
+            for collection_id, requested_at in withdrawn:
+                PublicSnapshotService._dequeue(collection_id, requested_at)
+        PublicSnapshotService._maybe_prune()
+        log.info('rebuilt', collections=rebuilt)
+        return rebuilt
+
+    @staticmethod
+    def _dequeue(collection_id, requested_at):
+        db.session.execute(
+            delete(SnapshotRebuild)
+            .where(SnapshotRebuild.collection_id == collection_id,
+                   SnapshotRebuild.requested_at == requested_at)
+        )
+        db.session.commit()
+
+    @staticmethod
+    def _renew_links():
+        """Queue every published collection once per MEDIA_PUBLIC_URL_TTL_SECONDS window.
+
+        Public media links expire at the end of the next window, so pages
+        republished at the start of each one never show an expired link,
+        while pages no longer published stop being renewed.
+        """
+        global _renewed_window
+        window = int(time.time()) // Config.MEDIA_PUBLIC_URL_TTL_SECONDS
+        if window != _renewed_window:
+            PublicSnapshotService._queue(sorted(published_collection_ids()))
+            _renewed_window = window
+
+    @staticmethod
+    def rebuild_all():
+        """Queue every public collection, and every published one that no longer is, then drain.
+
+        Returns the number of collections queued. Where a worker holds the
+        snapshots lease, the drain happens there on its next tick.
+        """
+        collection_ids = {cid for (cid,) in db.session.query(Collection.id).filter(Collection.is_public.is_(True))}
+        collection_ids.update(published_collection_ids())
+        PublicSnapshotService._queue(sorted(collection_ids))
+        PublicSnapshotService.rebuild_pending()
+        if read_ref(feed_key(1)) is None and HealthSupervisor.acquire_lease(
+                SNAPSHOT_LEASE, Config.SNAPSHOT_LEASE_SECONDS):
+            PublicSnapshotService._build_feed()  # nothing public yet: publish the empty feed
+        PublicSnapshotService.prune()
+        return len(collection_ids)
+
+    @staticmethod
+    def init_snapshots():
+        """Publish the feed on first start so anonymous reads never fall through to the database"""
+        if read_ref(feed_key(1)) is None:
+            PublicSnapshotService.rebuild_all()
+
+    @staticmethod
+    def start_scheduler(app):
+        def loop():
+            while True:
+                time.sleep(Config.SNAPSHOT_REBUILD_SECONDS or 60)
+                with app.app_context():
+                    try:
+                        PublicSnapshotService.rebuild_pending()
+                    except Exception as e:
+                        db.session.rollback()
+                        log.error('failed', error=str(e))
+
+        thread = threading.Thread(target=loop, daemon=True, name='public-snapshots')
+        thread.start()
+        return thread
+
+    @staticmethod
+    def prune():
+        """Delete snapshot bodies no ref points at once they are older than SNAPSHOT_TTL_HOURS.
+
+        Superseded pages stay readable for a while, since clients and CDNs
+        may still hold links to their immutable URLs; those of a collection
+        that stopped being public are purged as soon as it is unpublished.
+        """
+        live = _live_digests()
+        cutoff = time.time() - Config.SNAPSHOT_TTL_HOURS * 3600
+        removed = 0
+        for root, _, files in os.walk(os.path.join(Config.SNAPSHOT_ROOT, 'objects')):
+            for name in files:
+                path = os.path.join(root, name)
+                if name[:-len('.json')] not in live and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+    @staticmethod
+    def _purge(collection_ids):
+        """Delete every unreferenced body that shows one of these collections, without waiting for the TTL.
+
+        Run once the collections are unpublished and the feed republished
+        without them, so a collection made private stops being readable
+        through old page URLs or through superseded feed pages linking to it.
+        """
+        withdrawn = set(collection_ids)
+        live = _live_digests()
+        removed = 0
+        for root, _, files in os.walk(os.path.join(Config.SNAPSHOT_ROOT, 'objects')):
+            for name in files:
+                if name[:-len('.json')] in live:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    with open(path, 'rb') as f:
+                        payload = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if 'collection' in payload:
+                    shown = {payload['collection']['id']}
+                else:
+                    shown = {entry['id'] for entry in payload.get('collections', [])}
+                if shown & withdrawn:
+                    os.remove(path)
+                    removed += 1
+        _load_object.cache_clear()
+        log.info('purged', collections=sorted(withdrawn), objects=removed)
+        return removed
+
+    @staticmethod
+    def _maybe_prune():
+        global _last_prune
+        if time.time() - _last_prune >= 3600:
+            _last_prune = time.time()
+            PublicSnapshotService.prune()
@@ -1,8 +1,116 @@
 import os
 import base64
 import time
+import httpx
 import requests
 from config import Config
+from services.prompt_enhancer import prompt_enhancer
+from services.media_storage import MEDIA_REF_PREFIX, store_bytes
+from services.rollup_service import engine_attempts
+from services.health_service import health, engine_provider
+from utils import tracing
+from utils.cassette import ReplayedError, cassette
+from utils.log import get_logger
+
+log = get_logger('stability')
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Only these say something about the engine; decoding or storage errors are ours and leave it up
+UPSTREAM_ERRORS = (requests.RequestException, httpx.TransportError, ReplayedError)
+
+# Engines to try in order
+ENGINES_TO_TRY = [
+    ("stable-diffusion-v1-6", 512, 512),  # SD 1.6 supports 512x512
+    ("stable-diffusion-512-v2-1", 512, 512),  # Specifically for 512x512
+    ("stable-diffusion-xl-1024-v1-0", 1024, 1024),  # SDXL requires 1024x1024
+]
+
+# Size presets selectable on /api/generate, each with its own engine chain
+SIZE_PRESETS = {
+    'small': [("stable-diffusion-v1-6", 512, 512), ("stable-diffusion-512-v2-1", 512, 512)],
+    'medium': [("stable-diffusion-v1-6", 768, 768)],
+    'large': [("stable-diffusion-xl-1024-v1-0", 1024, 1024)],
+}
+
+# Engines that accept a smaller canvas for drafts; the rest draft at full size with fewer steps
+DRAFT_SIZES = {
+    "stable-diffusion-v1-6": (384, 384),
+}
+
+DEFAULT_STEPS = 30
+DEFAULT_CFG_SCALE = 7
+STEPS_RANGE = (10, 50)
+CFG_SCALE_RANGE = (0, 35)
+MAX_SEED = 4294967295
+
+# Every engine a request can be routed to, probed by the health supervisor
+KNOWN_ENGINES = sorted({engine_id for chain in (ENGINES_TO_TRY, *SIZE_PRESETS.values()) for engine_id, _, _ in chain})
+
+class ArtifactStreamDecoder:
+    """Pull the first artifact out of a Stability JSON body as it arrives.
+
+    The body is never held whole: chunks are scanned for the "base64" key
+    and the string value is validated in 4-character-aligned pieces and
+    appended to a single bytearray. By default the pieces are decoded to
+    raw image bytes; given a prefix, the already-encoded text is kept after
+    it instead, which is all a data URL needs. Anything after the closing
+    quote is ignored.
+    """
+
+    KEY = b'"base64"'
+
+    def __init__(self, prefix=None):
+        self.prefix = prefix
+        self.buffer = bytearray(prefix or b'')
+        self.done = False
+        self._state = 'key'
+        self._carry = b''
+
+    def feed(self, chunk):
+        if self.done:
+            return
+        data = self._carry + chunk
+        self._carry = b''
+
+        if self._state == 'key':
+            start = data.find(self.KEY)
+            if start < 0:
+                # Keep enough of the tail to match a key split across chunks
+                self._carry = data[-(len(self.KEY) - 1):]
+                return
+            data = data[start + len(self.KEY):]
+            self._state = 'open'
+
+        if self._state == 'open':
+            quote = data.find(b'"')
+            if quote < 0:
+                return
+            data = data[quote + 1:]
+            self._state = 'value'
+
+        end = data.find(b'"')
+        value = data if end < 0 else data[:end]
+        if b'\\' in value:  # JSON may escape "/" as "\/"
+            value = value.replace(b'\\', b'')
+        if end >= 0:
+            self.done = True
+            usable = len(value)
+        else:
+            usable = len(value) - len(value) % 4
+        self._append(value[:usable])
+        self._carry = value[usable:]
+
+    def _append(self, encoded):
+        decoded = base64.b64decode(encoded, validate=True)
+        self.buffer += decoded if self.prefix is None else encoded
+
+    def result(self):
+        """The image bytes (or prefixed base64), None if the body held no complete artifact"""
+        if not self.done or len(self.buffer) == len(self.prefix or b''):
+            return None
+        return self.buffer
+
 
 class StabilityAIService:
     def __init__(self):
@@ -11,15 +119,17 @@ class StabilityAIService:
         self.request_cooldown = 3
         self.api_key = os.getenv('STABILITY_API_KEY')
         self.api_host = 'https://api.stability.ai'
+        self._async_client = None
         
-        if self.api_key:
+        if self.api_key or cassette.replaying:
             self._initialize_stability()
     
     def _initialize_stability(self):
         """Initialize Stability.ai connection"""
         try:
             # Test the API key
-            response = requests.get(
+            response = cassette.get(
+                'stability', 'engines_list',
                 f"{self.api_host}/v1/engines/list",
                 headers={"Authorization": f"Bearer {self.api_key}"},
                 timeout=10
@@ -28,17 +138,46 @@ class StabilityAIService:
             if response.status_code == 200:
                 self.available = True
                 engines = response.json()
-                print("SUCCESS: Stability.ai service initialized!")
-                print(f"Available engines: {[engine['id'] for engine in engines]}")
+                log.info('initialized', engines=[engine['id'] for engine in engines])
             else:
-                print(f"Stability.ai connection failed: {response.status_code}")
-                print(f"Response: {response.text}")
+                log.error('init_failed', status=response.status_code, body=response.text)
                 self.available = False
                 
         except Exception as e:
-            print(f"Stability.ai initialization failed: {e}")
+            log.error('init_failed', error=str(e))
             self.available = False
     
+    def probe(self):
+        """Health supervisor check: account balance and the engine list, no generation.
+
+        Returns {provider: error or None} for the account and every known engine.
+        """
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        timeout = Config.HEALTH_PROBE_TIMEOUT_SECONDS
+        response = cassette.get('stability', 'balance', f"{self.api_host}/v1/user/balance",
+                                headers=headers, timeout=timeout)
+        if response.status_code != 200:
+            return {'stability': f"balance: HTTP {response.status_code}"}
+        if response.json().get('credits', 0) <= 0:
+            return {'stability': 'out of credits'}
+        
+        response = cassette.get('stability', 'engines_list', f"{self.api_host}/v1/engines/list",
+                                headers=headers, timeout=timeout)
+        if response.status_code != 200:
+            return {'stability': f"engines: HTTP {response.status_code}"}
+        listed = {engine['id'] for engine in response.json()}
+        results = {'stability': None}
+        for engine_id in KNOWN_ENGINES:
+            results[engine_provider(engine_id)] = None if engine_id in listed else 'not listed'
+        return results
+    
+    def _report_failure(self, engine_id, status=None, error=None):
+        """Route later requests away from what failed: the account on auth/credit errors, else the engine"""
+        if status in (401, 402, 403):
+            health.report_failure('stability', f"HTTP {status}")
+        elif status is None or status == 404 or status >= 500:
+            health.report_failure(engine_provider(engine_id), error or f"HTTP {status}")
+    
     def can_make_request(self):
         """Basic rate limiting"""
         current_time = time.time()
@@ -47,33 +186,93 @@ class StabilityAIService:
             return True
         return False
     
-    def generate_image(self, prompt, style='realistic'):
+    @tracing.traced('StabilityAIService.generate_image')
+    def generate_image(self, prompt, style='realistic', options=None):
         """
         Generate real AI images using Stability.ai
         """
         if not self.available or not self.can_make_request():
-            print("Stability.ai not available - using enhanced fallback")
+            log.info('fallback', reason='unavailable' if not self.available else 'cooldown')
             return self._get_enhanced_fallback_image(prompt, style)
         
         try:
             # Enhance prompt with style
             enhanced_prompt = self._enhance_prompt_for_style(prompt, style)
-            print(f"Generating with Stability.ai: {enhanced_prompt}")
+            log.debug('generating', prompt=enhanced_prompt)
             
             # Generate the image
-            image_url = self._generate_with_stability(enhanced_prompt)
+            image_url = self._generate_with_stability(enhanced_prompt, options)
             
-            if image_url and image_url.startswith('data:image'):
-                print("REAL AI image generated with Stability.ai!")
+            if image_url and image_url.startswith(('data:image', MEDIA_REF_PREFIX)):
+                log.info('generated')
                 return image_url
             else:
-                print("Stability.ai returned no image data, using fallback")
+                log.warning('fallback', reason='no_image')
                 return self._get_enhanced_fallback_image(prompt, style)
                 
         except Exception as e:
-            print(f"Stability.ai generation error: {e}")
+            log.error('fallback', reason='error', error=str(e))
             return self._get_enhanced_fallback_image(prompt, style)
     
+    @tracing.traced('StabilityAIService.generate_image')
+    async def generate_image_async(self, prompt, style='realistic', options=None):
+        """
+        Non-blocking variant of generate_image for the ASGI serving mode
+        """
+        if not self.available or not self.can_make_request():
+            log.info('fallback', reason='unavailable' if not self.available else 'cooldown')
+            return self._get_enhanced_fallback_image(prompt, style)
+        
+        try:
+            enhanced_prompt = self._enhance_prompt_for_style(prompt, style)
+            log.debug('generating', prompt=enhanced_prompt)
+            
+            image_url = await self._generate_with_stability_async(enhanced_prompt, options)
+            
+            if image_url and image_url.startswith(('data:image', MEDIA_REF_PREFIX)):
+                log.info('generated')
+                return image_url
+            else:
+                log.warning('fallback', reason='no_image')
+                return self._get_enhanced_fallback_image(prompt, style)
+                
+        except Exception as e:
+            log.error('fallback', reason='error', error=str(e))
+            return self._get_enhanced_fallback_image(prompt, style)
+    
+    def render_image(self, prompt, style='realistic', options=None):
+        """
+        Render outside the live path (pre-generation, refinement): leaves the cooldown alone and never falls back
+        """
+        if not self.available:
+            return None
+        image_url = self._generate_with_stability(self._enhance_prompt_for_style(prompt, style), options)
+        if image_url and image_url.startswith(('data:image', MEDIA_REF_PREFIX)):
+            return image_url
+        return None
+    
+    @staticmethod
+    def generation_options(data):
+        """Validate steps, cfg_scale and size from a request body into engine options"""
+        options = {}
+        for name, cast, (low, high) in (('steps', int, STEPS_RANGE), ('cfg_scale', float, CFG_SCALE_RANGE)):
+            if data.get(name) is None:
+                continue
+            try:
+                value = cast(data[name])
+            except (TypeError, ValueError):
+                value = None
+            if value is None or not low <= value <= high:
+                raise ValueError(f"{name} must be a number between {low} and {high}")
+            options[name] = value
+        
+        size = data.get('size')
+        if size is not None:
+            if size not in SIZE_PRESETS:
+                raise ValueError(f"size must be one of: {', '.join(SIZE_PRESETS)}")
+            options['size'] = size
+        return options
+    
     def _enhance_prompt_for_style(self, prompt, style):
         """Enhance prompt based on selected style"""
         style_prompts = {
@@ -87,104 +286,172 @@ class StabilityAIService:
         style_desc = style_prompts.get(style, 'high quality, detailed')
         return f"{prompt}, {style_desc}"
     
-    def _generate_with_stability(self, prompt):
+    def _generate_with_stability(self, prompt, options=None):
         """
         Generate image using Stability.ai REST API with multiple engine fallbacks
+
+        On success options['engine'] records the engine that served the
+        request, so a refine pass can pin the same one.
         """
+        engine_id = None
         try:
-            # List of engines to try in order
-            engines_to_try = [
-                ("stable-diffusion-v1-6", 512, 512),  # SD 1.6 supports 512x512
-                ("stable-diffusion-512-v2-1", 512, 512),  # Specifically for 512x512
-                ("stable-diffusion-xl-1024-v1-0", 1024, 1024),  # SDXL requires 1024x1024
-            ]
-            
-            for engine_id, width, height in engines_to_try:
-                print(f"Trying engine: {engine_id} with {width}x{height}")
+            for engine in self._engine_chain(options):
+                engine_id, width, height = self._canvas(engine, options)
+                log.debug('attempt', engine=engine_id, width=width, height=height)
                 
-                response = requests.post(
-                    f"{self.api_host}/v1/generation/{engine_id}/text-to-image",
-                    headers={
-                        "Content-Type": "application/json",
-                        "Accept": "application/json",
-                        "Authorization": f"Bearer {self.api_key}"
-                    },
-                    json={
-                        "text_prompts": [{"text": prompt}],
-                        "cfg_scale": 7,
-                        "height": height,
-                        "width": width,
-                        "samples": 1,
-                        "steps": 30,
-                    },
-                    timeout=60
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    print(f"SUCCESS: Image generated with engine {engine_id}")
-                    return self._process_stability_response(data)
-                else:
-                    print(f"Engine {engine_id} failed: {response.status_code}")
-                    if response.status_code != 404:  # Don't print details for 404 (engine not found)
-                        print(f"Error: {response.text}")
-                    continue  # Try next engine
+                with tracing.span('stability.text_to_image', 'client', engine=engine_id, width=width,
+                                  height=height) as attempt:
+                    with cassette.post_stream(
+                        'stability', 'text_to_image',
+                        f"{self.api_host}/v1/generation/{engine_id}/text-to-image",
+                        key=engine_id,
+                        headers=self._request_headers(),
+                        json=self._request_body(prompt, width, height, options),
+                        timeout=60
+                    ) as response:
+                        attempt.set_attribute('http.status_code', response.status_code)
+                        if response.status_code == 200:
+                            decoder = self._artifact_decoder()
+                            for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                                decoder.feed(chunk)
+                            engine_attempts.record(engine_id, True)
+                            log.info('engine_succeeded', engine=engine_id)
+                            if options is not None:
+                                options['engine'] = engine
+                            return self._image_url(decoder)
+                        else:
+                            attempt.set_error(f"HTTP {response.status_code}")
+                            engine_attempts.record(engine_id, False)
+                            self._report_failure(engine_id, response.status_code)
+                            # No body for 404 (engine not found)
+                            log.warning('engine_failed', engine=engine_id, status=response.status_code,
+                                        body=response.text if response.status_code != 404 else None)
+                            continue  # Try next engine
                     
-            print("All engines failed or not available")
+            log.warning('engines_exhausted')
             return None
             
         except Exception as e:
-            print(f"Stability.ai API call failed: {e}")
+            if engine_id is not None:
+                engine_attempts.record(engine_id, False)
+                if isinstance(e, UPSTREAM_ERRORS):
+                    self._report_failure(engine_id, error=str(e))
+            log.error('request_failed', error=str(e))
             return None
     
-    def _process_stability_response(self, data):
-        """Process Stability.ai response and return image URL"""
+    async def _generate_with_stability_async(self, prompt, options=None):
+        """
+        Same engine fallback chain as _generate_with_stability over a shared async client
+        """
+        engine_id = None
         try:
-            for image in data["artifacts"]:
-                image_binary = base64.b64decode(image["base64"])
-                image_base64 = base64.b64encode(image_binary).decode('utf-8')
-                image_url = f"data:image/png;base64,{image_base64}"
-                return image_url
+            if self._async_client is None:
+                self._async_client = httpx.AsyncClient(
+                    base_url=self.api_host,
+                    timeout=60,
+                    limits=httpx.Limits(max_connections=Config.ASYNC_MAX_CONCURRENT_GENERATIONS)
+                )
+            
+            for engine in self._engine_chain(options):
+                engine_id, width, height = self._canvas(engine, options)
+                log.debug('attempt', engine=engine_id, width=width, height=height)
+                
+                with tracing.span('stability.text_to_image', 'client', engine=engine_id, width=width,
+                                  height=height) as attempt:
+                    async with cassette.stream_async(
+                        self._async_client, 'stability', 'text_to_image', 'POST',
+                        f"/v1/generation/{engine_id}/text-to-image",
+                        key=engine_id,
+                        headers=self._request_headers(),
+                        json=self._request_body(prompt, width, height, options)
+                    ) as response:
+                        attempt.set_attribute('http.status_code', response.status_code)
+                        if response.status_code == 200:
+                            decoder = self._artifact_decoder()
+                            async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                                decoder.feed(chunk)
+                            engine_attempts.record(engine_id, True)
+                            log.info('engine_succeeded', engine=engine_id)
+                            if options is not None:
+                                options['engine'] = engine
+                            return self._image_url(decoder)
+                        else:
+                            attempt.set_error(f"HTTP {response.status_code}")
+                            engine_attempts.record(engine_id, False)
+                            self._report_failure(engine_id, response.status_code)
+                            log.warning('engine_failed', engine=engine_id, status=response.status_code,
+                                        body=await response.aread() if response.status_code != 404 else None)
+                            continue
+                    
+            log.warning('engines_exhausted')
+            return None
+            
         except Exception as e:
-            print(f"Error processing Stability.ai response: {e}")
-        
-        return None
+            if engine_id is not None:
+                engine_attempts.record(engine_id, False)
+                if isinstance(e, UPSTREAM_ERRORS):
+                    self._report_failure(engine_id, error=str(e))
+            log.error('request_failed', error=str(e))
+            return None
+    
+    def _request_headers(self):
+        return {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Authorization": f"Bearer {self.api_key}",
+            **tracing.propagation_headers()
+        }
+    
+    def _engine_chain(self, options):
+        options = options or {}
+        if options.get('engine'):
+            return [options['engine']]
+        # Engines the health supervisor has seen fail are skipped until they pass a probe
+        return [engine for engine in SIZE_PRESETS.get(options.get('size'), ENGINES_TO_TRY)
+                if health.is_up(engine_provider(engine[0]))]
+    
+    def _canvas(self, engine, options):
+        engine_id, width, height = engine
+        if options and options.get('draft'):
+            width, height = DRAFT_SIZES.get(engine_id, (width, height))
+        return engine_id, width, height
+    
+    def _request_body(self, prompt, width, height, options=None):
+        options = options or {}
+        body = {
+            "text_prompts": [{"text": prompt}],
+            "cfg_scale": options.get('cfg_scale', DEFAULT_CFG_SCALE),
+            "height": height,
+            "width": width,
+            "samples": 1,
+            "steps": options.get('steps', DEFAULT_STEPS),
+        }
+        if 'seed' in options:
+            body["seed"] = options['seed']
+        return body
+    
+    def _artifact_decoder(self):
+        """Decode to bytes for media storage, keep the base64 for inline data URLs"""
+        if Config.IMAGE_STORAGE == 'media':
+            return ArtifactStreamDecoder()
+        return ArtifactStreamDecoder(prefix=b'data:image/png;base64,')
+    
+    def _image_url(self, decoder):
+        """Turn a finished decoder into the image_url that gets stored"""
+        image = decoder.result()
+        if image is None:
+            log.error('no_artifact')
+            return None
+        if decoder.prefix is None:
+            return MEDIA_REF_PREFIX + store_bytes(image, 'png')
+        return image.decode('ascii')
     
     def _get_enhanced_fallback_image(self, prompt, style):
         """Enhanced fallback with better image matching"""
-        import hashlib
-        import random
-        
-        # Image database with categories
-        image_database = {
-            'cat': [237, 219, 222, 257, 96, 144, 145],
-            'dog': [1062, 1074, 1080, 1081, 1084, 200, 201],
-            'baby': [1005, 1011, 1012, 1018, 1025, 300, 301],
-            'landscape': [1015, 1016, 1018, 1020, 1021, 1022, 1023, 1028],
-            'portrait': [1005, 1009, 1011, 1012, 1019, 1027, 1000, 1001],
-            'art': [100, 101, 102, 103, 104, 105, 106],
-        }
-        
-        prompt_lower = prompt.lower()
-        
-        # Find best matching category
-        for category, ids in image_database.items():
-            if any(word in prompt_lower for word in [category] + self._get_synonyms(category)):
-                selected_id = random.choice(ids)
-                print(f"Using enhanced fallback for '{category}': image {selected_id}")
-                return f"https://picsum.photos/id/{selected_id}/512/512"
-        
-        # Final fallback
-        seed = hashlib.md5(f"{prompt}_{style}".encode()).hexdigest()[:10]
-        return f"https://picsum.photos/seed/{seed}/512/512"
+        image_url, category = prompt_enhancer.fallback_image(prompt, style)
+        if category:
+            log.info('fallback_image', category=category, image_url=image_url)
+        return image_url
     
     def _get_synonyms(self, word):
-        synonyms = {
-            'cat': ['kitten', 'feline', 'kitty'],
-            'dog': ['puppy', 'canine', 'doggy'],
-            'baby': ['child', 'infant', 'toddler'],
-            'landscape': ['mountain', 'nature', 'scenery'],
-            'portrait': ['person', 'face', 'people'],
-            'art': ['painting', 'drawing', 'sketch'],
-        }
-        return synonyms.get(word, [])
\ No newline at end of file
+        return prompt_enhancer.synonyms(word)
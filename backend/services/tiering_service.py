@@ -0,0 +1,281 @@
+import time
+import zlib
+import base64
+import statistics
+from datetime import datetime, timedelta
+from sqlalchemy import String, bindparam, cast, func, literal, update
+from sqlalchemy.orm import aliased
+from config import Config
+from models.models import db, User, GeneratedImage, Favorite, CollectionItem, ArchivedImage
+from services.media_storage import IMAGE_REF_PREFIX, MEDIA_REF_PREFIX, release_media
+from utils.log import get_logger
+
+log = get_logger('tiering')
+
+# Stubs left in generated_images store this prefix + their own id
+ARCHIVE_REF_PREFIX = 'archive://'
+GALLERY_PAGE_SIZE = 10
+
+
+def _unprotected():
+    """Rows tiering and retention may touch: not favorited, not collected, not mid-refine"""
+    return (
+        ~db.session.query(Favorite.id).filter(Favorite.image_id == GeneratedImage.id).exists(),
+        ~db.session.query(CollectionItem.id).filter(CollectionItem.image_id == GeneratedImage.id).exists(),
+        func.coalesce(GeneratedImage.refine_status, '') != 'pending',
+    )
+
+
+def _unreferenced():
+    """Rows no other row of the same user points at with image:// (those hold its payload too)"""
+    referrer = aliased(GeneratedImage)
+    return ~db.session.query(referrer.id).filter(
+        referrer.user_id == GeneratedImage.user_id,
+        referrer.image_url == literal(IMAGE_REF_PREFIX) + cast(GeneratedImage.id, String)
+    ).exists()
+
+
+def _data_url(archived):
+    return f"{archived.header},{base64.b64encode(zlib.decompress(archived.data)).decode('ascii')}"
+
+
+class TieringService:
+    """Moves cold inline payloads out of generated_images and enforces retention.
+
+    The archive may live in another database (COLD_DATABASE_URL), so the two
+    sides are never written in one transaction: archiving commits the
+    archive row before stubbing the hot row, and rehydrating restores the
+    hot row before deleting the archive row. An interruption leaves at
+    worst an orphan archive row, which the next run overwrites.
+    """
+
+    @staticmethod
+    def _cold(cutoff):
+        """Filters for the rows tier() archives"""
+        return (
+            GeneratedImage.image_url.like('data:%'),
+            func.coalesce(GeneratedImage.rehydrated_at, GeneratedImage.created_at) < cutoff,
+            *_unprotected(),
+        )
+
+    @staticmethod
+    def _candidates(cutoff, after_id, limit):
+        return [image_id for (image_id,) in db.session.query(GeneratedImage.id)
+                .filter(GeneratedImage.id > after_id, *TieringService._cold(cutoff))
+                .order_by(GeneratedImage.id)
+                .limit(limit)]
+
+    @staticmethod
+    def archive_batch(image_ids):
+        """Archive these inline rows; returns (archived, bytes_before, bytes_after)"""
+        archived = []
+        for image_id, image_url in db.session.query(GeneratedImage.id, GeneratedImage.image_url)\
+                .filter(GeneratedImage.id.in_(image_ids), GeneratedImage.image_url.like('data:%')):
+            header, _, payload = image_url.partition(',')
+            raw = base64.b64decode(payload)
+            if base64.b64encode(raw).decode('ascii') != payload:
+                log.warning('skipped_noncanonical', image_id=image_id)  # would not round-trip
+                continue
+            archived.append(ArchivedImage(
+                image_id=image_id,
+                header=header,
+                data=zlib.compress(raw, 6),
+                original_size=len(image_url)
+            ))
+        if not archived:
+            return 0, 0, 0
+
+        ids = [a.image_id for a in archived]
+        ArchivedImage.query.filter(ArchivedImage.image_id.in_(ids)).delete(synchronize_session=False)
+        db.session.add_all(archived)
+        db.session.commit()
+
+        # Only rows still inline are stubbed; anything rewritten meanwhile keeps its new payload
+        db.session.execute(
+            update(GeneratedImage.__table__)
+            .where(GeneratedImage.id == bindparam('image_id'), GeneratedImage.image_url.like('data:%'))
+            .values(image_url=bindparam('stub')),
+            [{'image_id': image_id, 'stub': f"{ARCHIVE_REF_PREFIX}{image_id}"} for image_id in ids]
+        )
+        db.session.commit()
+        before = sum(a.original_size for a in archived)
+        after = sum(len(a.data) + len(ARCHIVE_REF_PREFIX) + len(str(a.image_id)) for a in archived)
+        return len(archived), before, after
+
+    @staticmethod
+    def load_archived(image_ids):
+        """{id: data URL} straight from the archive, without touching the hot rows"""
+        return {
+            archived.image_id: _data_url(archived)
+            for archived in ArchivedImage.query.filter(ArchivedImage.image_id.in_(image_ids))
+        }
+
+    @staticmethod
+    def rehydrate(image_ids):
+        """Restore archived payloads into their rows; returns {id: data URL}"""
+        restored = TieringService.load_archived(image_ids)
+        if not restored:
+            return {}
+        db.session.execute(
+            update(GeneratedImage.__table__)
+            .where(GeneratedImage.id == bindparam('image_id'), GeneratedImage.image_url == bindparam('stub'))
+            .values(image_url=bindparam('image_url'), rehydrated_at=datetime.utcnow()),
+            [{'image_id': image_id, 'stub': f"{ARCHIVE_REF_PREFIX}{image_id}", 'image_url': image_url}
+             for image_id, image_url in restored.items()]
+        )
+        db.session.commit()
+        ArchivedImage.query.filter(ArchivedImage.image_id.in_(list(restored)))\
+            .delete(synchronize_session=False)
+        db.session.commit()
+        log.info('rehydrated', images=len(restored))
+        return restored
+
+    @staticmethod
+    def tier(batch_size=None, dry_run=False, progress=None):
+        """Archive every eligible row, batch_size per pair of transactions"""
+        batch_size = batch_size or Config.TIER_BATCH_SIZE
+        cutoff = datetime.utcnow() - timedelta(days=Config.TIER_AFTER_DAYS)
+        stats = {'archived': 0, 'bytes_before': 0, 'bytes_after': 0}
+        after_id = 0
+        while True:
+            ids = TieringService._candidates(cutoff, after_id, batch_size)
+            if not ids:
+                return stats
+            after_id = ids[-1]
+            if dry_run:
+                stats['archived'] += len(ids)
+                stats['bytes_before'] += db.session.query(func.sum(func.length(GeneratedImage.image_url)))\
+                    .filter(GeneratedImage.id.in_(ids)).scalar() or 0
+                continue
+            archived, before, after = TieringService.archive_batch(ids)
+            stats['archived'] += archived
+            stats['bytes_before'] += before
+            stats['bytes_after'] += after
+            if progress:
+                progress(f"archived {stats['archived']} images through id {after_id}")
+
+    @staticmethod
+    def enforce_retention(batch_size=None, dry_run=False, progress=None):
+        """Delete each user's oldest unprotected images beyond their plan's RETENTION_MAX_IMAGES.
+
+        Media files only the deleted rows used are removed with them. The
+        workers' in-memory prompt and hash indexes drop deleted ids on
+        their own, the first time a lookup turns one up.
+        """
+        batch_size = batch_size or Config.TIER_BATCH_SIZE
+        deleted = 0
+        for plan, limit in Config.RETENTION_MAX_IMAGES.items():
+            if not limit:
+                continue
+            over = db.session.query(GeneratedImage.user_id, func.count(GeneratedImage.id))\
+                .join(User, User.id == GeneratedImage.user_id)\
+                .filter(func.coalesce(User.plan, 'free') == plan)\
+                .group_by(GeneratedImage.user_id)\
+                .having(func.count(GeneratedImage.id) > limit)\
+                .all()
+            for user_id, count in over:
+                excess = count - limit
+                deletable = db.session.query(GeneratedImage.id, GeneratedImage.image_url)\
+                    .filter(GeneratedImage.user_id == user_id, _unreferenced(), *_unprotected())\
+                    .order_by(GeneratedImage.created_at, GeneratedImage.id)
+                if dry_run:
+                    deleted += min(excess, deletable.count())
+                    continue
+                while excess > 0:
+                    rows = deletable.limit(min(batch_size, excess)).all()
+                    if not rows:
+                        break  # everything left is protected
+                    ids = [image_id for image_id, _ in rows]
+                    # Rechecked in the DELETE: a row favorited, collected or made a dedup target
+                    # since the SELECT stays
+                    GeneratedImage.query\
+                        .filter(GeneratedImage.id.in_(ids), _unreferenced(), *_unprotected())\
+                        .delete(synchronize_session=False)
+                    db.session.commit()
+                    kept = {image_id for (image_id,) in db.session.query(GeneratedImage.id)
+                            .filter(GeneratedImage.id.in_(ids))}
+                    rows = [row for row in rows if row[0] not in kept]
+                    gone = [image_id for image_id, _ in rows]
+                    if gone:
+                        ArchivedImage.query.filter(ArchivedImage.image_id.in_(gone)).delete(synchronize_session=False)
+                        db.session.commit()
+                        release_media([url[len(MEDIA_REF_PREFIX):] for _, url in rows
+                                       if url and url.startswith(MEDIA_REF_PREFIX)])
+                    deleted += len(gone)
+                    excess -= len(ids)  # kept rows are protected now; don't retry them
+                if progress:
+                    progress(f"user {user_id} ({plan}): {count} images, limit {limit}")
+        return deleted
+
+    @staticmethod
+    def _hot_bytes():
+        """Payload bytes held in generated_images"""
+        return db.session.query(func.sum(func.length(GeneratedImage.image_url))).scalar() or 0
+
+    @staticmethod
+    def _sample_page(cutoff):
+        """Ids of a gallery page tiering will move: the newest cold rows of the user with the most"""
+        cold = TieringService._cold(cutoff)
+        user_id = db.session.query(GeneratedImage.user_id)\
+            .filter(*cold)\
+            .group_by(GeneratedImage.user_id)\
+            .order_by(func.count(GeneratedImage.id).desc())\
+            .limit(1)\
+            .scalar()
+        if user_id is None:
+            return []
+        return [image_id for (image_id,) in db.session.query(GeneratedImage.id)
+                .filter(GeneratedImage.user_id == user_id, *cold)
+                .order_by(GeneratedImage.created_at.desc())
+                .limit(GALLERY_PAGE_SIZE)]
+
+    @staticmethod
+    def _page_profile(image_ids):
+        """(rows, payload bytes, median ms to load them) for one gallery page"""
+        if not image_ids:
+            return 0, 0, None
+        rows, page_bytes = db.session.query(
+                func.count(GeneratedImage.id),
+                func.sum(func.length(GeneratedImage.image_url))
+            )\
+            .filter(GeneratedImage.id.in_(image_ids))\
+            .one()
+        timings = []
+        for _ in range(5):
+            started = time.perf_counter()
+            GeneratedImage.query.filter(GeneratedImage.id.in_(image_ids))\
+                .order_by(GeneratedImage.created_at.desc())\
+                .all()
+            timings.append((time.perf_counter() - started) * 1000)
+            db.session.expunge_all()
+        return rows, page_bytes or 0, round(statistics.median(timings), 2)
+
+    @staticmethod
+    def run(batch_size=None, dry_run=False, retention=True, progress=None):
+        """Retention, then tiering; returns a report of what moved and what it saved"""
+        started = time.time()
+        hot_bytes_before = TieringService._hot_bytes()
+        deleted = TieringService.enforce_retention(batch_size, dry_run, progress) if retention else 0
+        # The same page, made of rows about to be archived, is measured on both sides
+        page = TieringService._sample_page(datetime.utcnow() - timedelta(days=Config.TIER_AFTER_DAYS))
+        page_rows, page_bytes_before, latency_before = TieringService._page_profile(page)
+        stats = TieringService.tier(batch_size, dry_run, progress)
+        hot_bytes_after = TieringService._hot_bytes()
+        _, page_bytes_after, latency_after = TieringService._page_profile(page)
+        report = {
+            'dry_run': dry_run,
+            'deleted': deleted,
+            'archived': stats['archived'],
+            'archived_bytes_before': stats['bytes_before'],
+            'archived_bytes_after': stats['bytes_after'],
+            'hot_payload_bytes_before': hot_bytes_before,
+            'hot_payload_bytes_after': hot_bytes_after,
+            'gallery_page_rows': page_rows,
+            'gallery_page_bytes_before': page_bytes_before,
+            'gallery_page_bytes_after': page_bytes_after,
+            'gallery_page_ms_before': latency_before,
+            'gallery_page_ms_after': latency_after,
+            'duration_seconds': round(time.time() - started, 1)
+        }
+        log.info('finished', **report)
+        return report
@@ -0,0 +1,486 @@
+import os
+import json
+import time
+import zlib
+import struct
+import base64
+import asyncio
+import hashlib
+import threading
+import statistics
+from types import SimpleNamespace
+from functools import lru_cache
+from contextlib import asynccontextmanager
+from collections import Counter
+from datetime import datetime
+from urllib.parse import urlsplit
+import requests
+from config import Config
+from utils.log import get_logger
+
+log = get_logger('cassette')
+
+MODES = ('off', 'record', 'replay')
+MAX_TEXT = 4000
+
+
+class ReplayMiss(LookupError):
+    """Replay mode was asked for a call the cassettes hold nothing for"""
+
+
+class ReplayedError(Exception):
+    """A recorded failure (timeout, quota error...) raised again on replay with its original message"""
+
+
+def _digest(text):
+    return hashlib.sha1((text or '').encode('utf-8')).hexdigest()
+
+
+def redact(text):
+    """Prompts stay out of cassettes unless PROVIDER_CASSETTE_KEEP_PROMPTS: only their size and hash"""
+    if Config.PROVIDER_CASSETTE_KEEP_PROMPTS:
+        return text
+    return {'chars': len(text or ''), 'sha1': _digest(text)}
+
+
+def _sanitize_body(body):
+    if not isinstance(body, dict):
+        return None
+    body = dict(body)
+    if 'text_prompts' in body:
+        body['text_prompts'] = [dict(p, text=redact(p.get('text'))) for p in body['text_prompts']]
+    return body
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+@lru_cache(maxsize=16)
+def synthetic_png(size):
+    """A valid 8x8 PNG padded with a private ancillary chunk to `size` bytes (or its minimum)"""
+    pixels = b''.join(b'\x00' + bytes(8 * 3) for _ in range(8))
+    head = b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', struct.pack('>IIBBBBB', 8, 8, 8, 2, 0, 0, 0)) \
+        + _png_chunk(b'IDAT', zlib.compress(pixels))
+    tail = _png_chunk(b'IEND', b'')
+    padding = size - len(head) - len(tail) - 12
+    return head + (_png_chunk(b'prVt', bytes(padding)) if padding >= 0 else b'') + tail
+
+
+@lru_cache(maxsize=16)
+def synthetic_artifact_body(body_bytes):
+    """A Stability text-to-image body of about body_bytes wrapping a synthetic PNG"""
+    wrapper = '{"artifacts":[{"base64":"%s","seed":0,"finishReason":"SUCCESS"}]}'
+    encoded_length = max(body_bytes - len(wrapper) + 2, 0) // 4 * 4
+    png = base64.b64encode(synthetic_png(encoded_length // 4 * 3)).decode('ascii')
+    return (wrapper % png).encode('ascii')
+
+
+def latency_scale():
+    """PROVIDER_REPLAY_LATENCY: 'recorded' (1.0), 'zero' (0) or a multiplier"""
+    value = Config.PROVIDER_REPLAY_LATENCY
+    if value == 'recorded':
+        return 1.0
+    if value == 'zero':
+        return 0.0
+    return max(float(value), 0.0)
+
+
+def _elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+class ReplayResponse:
+    """Stands in for a requests or httpx response, rebuilt from a recorded exchange.
+
+    The body arrives in chunks spread over the recorded transfer time,
+    so streaming consumers see the same pacing they saw in production.
+    """
+
+    def __init__(self, entry, body, transfer_seconds=0.0):
+        self.status_code = entry.get('status')
+        self.content = body
+        self.transfer_seconds = transfer_seconds
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def _chunks(self, chunk_size):
+        chunks = [self.content[i:i + chunk_size] for i in range(0, len(self.content), chunk_size)] or [b'']
+        return chunks, self.transfer_seconds / len(chunks)
+
+    def iter_content(self, chunk_size=1):
+        chunks, pause = self._chunks(chunk_size)
+        for chunk in chunks:
+            if pause:
+                time.sleep(pause)
+            yield chunk
+
+    async def aiter_bytes(self, chunk_size=None):
+        chunks, pause = self._chunks(chunk_size or 65536)
+        for chunk in chunks:
+            if pause:
+                await asyncio.sleep(pause)
+            yield chunk
+
+    async def aread(self):
+        return self.content
+
+
+class RecordingResponse:
+    """Wraps a live streamed response, counting the body as it passes and recording it when closed.
+
+    Successful bodies are image payloads, so only their size is kept;
+    error bodies are kept as text.
+    """
+
+    def __init__(self, cassette, entry, started, response):
+        self.cassette = cassette
+        self.entry = entry
+        self.started = started
+        self.response = response
+        self.body_bytes = 0
+        self.text_body = None
+        self.closed = False
+
+    @property
+    def status_code(self):
+        return self.response.status_code
+
+    @property
+    def text(self):
+        self.text_body = self.response.text
+        return self.text_body
+
+    def iter_content(self, chunk_size=1):
+        for chunk in self.response.iter_content(chunk_size):
+            self.body_bytes += len(chunk)
+            yield chunk
+
+    async def aiter_bytes(self, chunk_size=None):
+        async for chunk in self.response.aiter_bytes(chunk_size):
+            self.body_bytes += len(chunk)
+            yield chunk
+
+    async def aread(self):
+        body = await self.response.aread()
+        self.text_body = body.decode('utf-8', 'replace')
+        return body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(exc)
+        self.response.__exit__(exc_type, exc, tb)
+        return False
+
+    def finish(self, error=None):
+        if self.closed:
+            return
+        self.closed = True
+        if self.status_code == 200 and self.text_body is None:
+            response = {'body_bytes': self.body_bytes, 'synthetic': True}
+        else:
+            response = {'body': (self.text_body or '')[:MAX_TEXT]}
+        self.cassette.finish(self.entry, self.started, response=response, error=error)
+
+
+class Cassette:
+    """Record/replay of upstream provider traffic, for offline performance testing.
+
+    PROVIDER_CASSETTE_MODE picks the behaviour of every Stability and
+    Gemini call routed through here:
+
+    - 'off' calls the provider directly; nothing else happens.
+    - 'record' calls it and appends the exchange to a JSONL cassette under
+      PROVIDER_CASSETTE_DIR (one file per process): request minus
+      credentials and prompt text, status, error, time to first byte,
+      total time and body size.
+    - 'replay' never touches the network. Calls are answered from every
+      cassette in the directory, in recorded order per provider,
+      operation and engine (wrapping around), after the recorded delay
+      times PROVIDER_REPLAY_LATENCY. Image bodies are synthesized at
+      their recorded size, and recorded failures are raised again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._file = None
+        self._file_pid = None
+        self._tracks = None  # (provider, op, key) -> recorded entries; key '*' holds all of them
+        self._positions = Counter()
+
+    @property
+    def mode(self):
+        return Config.PROVIDER_CASSETTE_MODE  # read late so a CLI or benchmark can switch it
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    # Recording
+
+    def _write(self, entry):
+        line = json.dumps(entry, separators=(',', ':'))
+        with self.lock:
+            if self._file is None or self._file_pid != os.getpid():
+                os.makedirs(Config.PROVIDER_CASSETTE_DIR, exist_ok=True)
+                name = f"{datetime.utcnow():%Y%m%dT%H%M%S}-{os.getpid()}.jsonl"
+                self._file = open(os.path.join(Config.PROVIDER_CASSETTE_DIR, name), 'a', encoding='utf-8')
+                self._file_pid = os.getpid()
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    @staticmethod
+    def _entry(provider, op, key, request):
+        return {'provider': provider, 'op': op, 'key': key, 'request': request,
+                'recorded_at': datetime.utcnow().isoformat()}
+
+    def finish(self, entry, started, response=None, error=None):
+        entry['latency_ms'] = _elapsed_ms(started)
+        entry.setdefault('ttfb_ms', entry['latency_ms'])
+        if response is not None:
+            entry['response'] = response
+        if error is not None:
+            entry['error'] = {'type': type(error).__name__, 'message': str(error)[:MAX_TEXT]}
+        try:
+            self._write(entry)
+        except OSError as e:
+            log.warning('record_failed', error=str(e))
+
+    # Replaying
+
+    def load(self, path=None):
+        """Read every cassette under path (a file or a directory, default PROVIDER_CASSETTE_DIR)"""
+        path = path or Config.PROVIDER_CASSETTE_DIR
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.jsonl'))
+        else:
+            files = [path] if os.path.isfile(path) else []
+        tracks = {}
+        for file_path in files:
+            with open(file_path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    tracks.setdefault((entry['provider'], entry['op'], entry.get('key')), []).append(entry)
+                    tracks.setdefault((entry['provider'], entry['op'], '*'), []).append(entry)
+        with self.lock:
+            self._tracks = tracks
+            self._positions.clear()
+        log.info('loaded', files=len(files), exchanges=sum(len(t) for k, t in tracks.items() if k[2] == '*'))
+        return tracks
+
+    def _next(self, provider, op, key):
+        if self._tracks is None:
+            self.load()
+        with self.lock:
+            track_key = (provider, op, key)
+            if track_key not in self._tracks:
+                track_key = (provider, op, '*')  # e.g. an engine never seen while recording
+            track = self._tracks.get(track_key)
+            if not track:
+                raise ReplayMiss(f"No recorded {provider} {op} exchanges")
+            entry = track[self._positions[track_key] % len(track)]
+            self._positions[track_key] += 1
+        return entry
+
+    @staticmethod
+    def _replay_body(entry):
+        response = entry.get('response') or {}
+        if response.get('synthetic'):
+            return synthetic_artifact_body(response['body_bytes'])
+        return (response.get('body') or '').encode('utf-8')
+
+    @staticmethod
+    def _delays(entry):
+        """(seconds before the response, seconds spread over its body)"""
+        scale = latency_scale()
+        ttfb = entry.get('ttfb_ms', entry.get('latency_ms', 0))
+        return ttfb * scale / 1000, max(entry.get('latency_ms', 0) - ttfb, 0) * scale / 1000
+
+    @staticmethod
+    def _raise_recorded(entry):
+        if entry.get('error'):
+            raise ReplayedError(entry['error']['message'])
+
+    # Call sites
+
+    def get(self, provider, op, url, key=None, **kwargs):
+        """requests.get through the cassette; for small JSON answers"""
+        if self.mode == 'off':
+            return requests.get(url, **kwargs)
+        if self.replaying:
+            entry = self._next(provider, op, key)
+            before, after = self._delays(entry)
+            time.sleep(before + after)
+            self._raise_recorded(entry)
+            return ReplayResponse(entry, self._replay_body(entry))
+
+        entry = self._entry(provider, op, key, {'method': 'GET', 'path': urlsplit(url).path})
+        started = time.perf_counter()
+        try:
+            response = requests.get(url, **kwargs)
+        except Exception as e:
+            self.finish(entry, started, error=e)
+            raise
+        entry['status'] = response.status_code
+        # Successful answers (engine list, balance) are replayed verbatim; errors only need a sample
+        text = response.text if response.status_code == 200 else response.text[:MAX_TEXT]
+        self.finish(entry, started, response={'body': text, 'body_bytes': len(response.content)})
+        return response
+
+    def post_stream(self, provider, op, url, key=None, **kwargs):
+        """requests.post(..., stream=True) through the cassette, used as a context manager"""
+        if self.mode == 'off':
+            return requests.post(url, stream=True, **kwargs)
+        if self.replaying:
+            entry = self._next(provider, op, key)
+            before, after = self._delays(entry)
+            time.sleep(before)
+            self._raise_recorded(entry)
+            return ReplayResponse(entry, self._replay_body(entry), after)
+
+        entry = self._entry(provider, op, key, {'method': 'POST', 'path': urlsplit(url).path,
+                                                'body': _sanitize_body(kwargs.get('json'))})
+        started = time.perf_counter()
+        try:
+            response = requests.post(url, stream=True, **kwargs)
+        except Exception as e:
+            self.finish(entry, started, error=e)
+            raise
+        entry.update(status=response.status_code, ttfb_ms=_elapsed_ms(started))
+        return RecordingResponse(self, entry, started, response)
+
+    @asynccontextmanager
+    async def stream_async(self, client, provider, op, method, url, key=None, **kwargs):
+        """httpx AsyncClient.stream through the cassette"""
+        if self.mode == 'off':
+            async with client.stream(method, url, **kwargs) as response:
+                yield response
+            return
+        if self.replaying:
+            entry = self._next(provider, op, key)
+            before, after = self._delays(entry)
+            await asyncio.sleep(before)
+            self._raise_recorded(entry)
+            yield ReplayResponse(entry, self._replay_body(entry), after)
+            return
+
+        entry = self._entry(provider, op, key, {'method': method, 'path': urlsplit(str(url)).path,
+                                                'body': _sanitize_body(kwargs.get('json'))})
+        started = time.perf_counter()
+        recording = None
+        try:
+            async with client.stream(method, url, **kwargs) as response:
+                entry.update(status=response.status_code, ttfb_ms=_elapsed_ms(started))
+                recording = RecordingResponse(self, entry, started, response)
+                yield recording
+        except Exception as e:
+            if recording is None:
+                self.finish(entry, started, error=e)
+            else:
+                recording.finish(e)
+            raise
+        if recording is not None:
+            recording.finish()
+
+    @staticmethod
+    def _summarize(result):
+        try:
+            text = result.text
+        except Exception:  # e.g. a blocked Gemini candidate has no text
+            return {'text': None}
+        return {'text': text if Config.PROVIDER_CASSETTE_KEEP_PROMPTS else None, 'chars': len(text or '')}
+
+    def _replay_result(self, entry, prompt):
+        text = (entry.get('response') or {}).get('text')
+        return SimpleNamespace(text=text if text is not None else prompt)
+
+    def call(self, provider, op, fn, prompt=None, key=None):
+        """A client-library call through the cassette.
+
+        Replays return an object whose .text is the recorded text, or the
+        prompt itself when prompts were not kept.
+        """
+        if self.mode == 'off':
+            return fn()
+        if self.replaying:
+            entry = self._next(provider, op, key)
+            before, after = self._delays(entry)
+            time.sleep(before + after)
+            self._raise_recorded(entry)
+            return self._replay_result(entry, prompt)
+
+        entry = self._entry(provider, op, key, {'prompt': redact(prompt)} if prompt is not None else None)
+        started = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            self.finish(entry, started, error=e)
+            raise
+        self.finish(entry, started, response=self._summarize(result))
+        return result
+
+    async def call_async(self, provider, op, fn, prompt=None, key=None):
+        """Awaitable variant of call; fn returns the coroutine to await"""
+        if self.mode == 'off':
+            return await fn()
+        if self.replaying:
+            entry = self._next(provider, op, key)
+            before, after = self._delays(entry)
+            await asyncio.sleep(before + after)
+            self._raise_recorded(entry)
+            return self._replay_result(entry, prompt)
+
+        entry = self._entry(provider, op, key, {'prompt': redact(prompt)} if prompt is not None else None)
+        started = time.perf_counter()
+        try:
+            result = await fn()
+        except BaseException as e:  # includes cancellation by wait_for's timeout
+            self.finish(entry, started, error=e if isinstance(e, Exception) else TimeoutError('cancelled'))
+            raise
+        self.finish(entry, started, response=self._summarize(result))
+        return result
+
+
+cassette = Cassette()
+
+
+def summarize(tracks):
+    """Per provider/op/key/status: count, latency percentiles and body sizes, from Cassette.load()"""
+    groups = {}
+    for (provider, op, key), entries in tracks.items():
+        if key == '*':
+            continue
+        for entry in entries:
+            status = entry.get('status') or (entry['error']['type'] if entry.get('error') else 'ok')
+            groups.setdefault((provider, op, key, str(status)), []).append(entry)
+    rows = []
+    for (provider, op, key, status), entries in sorted(groups.items(), key=lambda g: tuple(map(str, g[0]))):
+        latencies = sorted(entry.get('latency_ms', 0) for entry in entries)
+        sizes = [(entry.get('response') or {}).get('body_bytes') for entry in entries]
+        sizes = [size for size in sizes if size is not None]
+        rows.append({
+            'provider': provider,
+            'op': op,
+            'key': key,
+            'status': status,
+            'count': len(entries),
+            'p50_ms': statistics.median(latencies),
+            'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'mean_body_bytes': round(statistics.mean(sizes)) if sizes else None
+        })
+    return rows
@@ -1,6 +1,7 @@
 from functools import wraps
 from flask import request, jsonify, g  # ADDED jsonify IMPORT
 from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from models.models import db, User
 
 def jwt_required_custom(fn):
     @wraps(fn)
@@ -20,4 +21,14 @@ def validate_json(f):  # FIXED THIS FUNCTION
         if not request.is_json:
             return jsonify({'error': 'Request must be JSON'}), 400
         return f(*args, **kwargs)
-    return decorated_function
\ No newline at end of file
+    return decorated_function
+
+def admin_required(fn):
+    """Use under jwt_required_custom; admins are flagged with `flask set-admin`"""
+    @wraps(fn)
+    def decorated_function(*args, **kwargs):
+        user = db.session.get(User, g.user_id)
+        if user is None or not user.is_admin:
+            return jsonify({'error': 'Admin access required'}), 403
+        return fn(*args, **kwargs)
+    return decorated_function
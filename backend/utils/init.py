@@ -1,3 +1,8 @@
 from .decorators import jwt_required_custom, validate_json
+from .query_budget import init_query_budget, assert_query_budget
+from .tracing import init_tracing, span, traced
+from .log import get_logger
+from .profiler import init_profiler
+from .cassette import cassette
 
-__all__ = ['jwt_required_custom', 'validate_json']
\ No newline at end of file
+__all__ = ['jwt_required_custom', 'validate_json', 'init_query_budget', 'assert_query_budget', 'init_tracing', 'span', 'traced', 'get_logger', 'init_profiler', 'cassette']
\ No newline at end of file
@@ -0,0 +1,180 @@
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from config import Config
+
+_configure_lock = threading.Lock()
+_listener = None
+
+
+def _truncate(value, limit=None):
+    limit = limit or Config.LOG_MAX_FIELD_CHARS
+    if isinstance(value, (bytes, bytearray)):
+        value = bytes(value[:limit]).decode('utf-8', 'replace')
+    if isinstance(value, str) and len(value) > limit:
+        return f"{value[:limit]}...(+{len(value) - limit} chars)"
+    if isinstance(value, (list, tuple)) and len(value) > 20:
+        return [_truncate(v, limit) for v in value[:20]] + [f"...(+{len(value) - 20} items)"]
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, category, event, then the record's fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'category': getattr(record, 'category', record.name),
+            'event': record.getMessage(),
+        }
+        for key, value in getattr(record, 'fields', {}).items():
+            if value is not None:
+                entry[key] = _truncate(value)
+        if record.exc_info:
+            entry['exc'] = _truncate(self.formatException(record.exc_info), 2000)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable variant for local development"""
+
+    def format(self, record):
+        fields = ' '.join(
+            f"{k}={_truncate(v)!r}" for k, v in getattr(record, 'fields', {}).items() if v is not None
+        )
+        line = f"{record.levelname:<7} {getattr(record, 'category', record.name)}.{record.getMessage()} {fields}"
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands raw records to the listener thread; drops instead of blocking when it falls behind"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting (and truncation) happens on the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogSampler:
+    """Per-event sampling and per-minute rate limits from Config.LOG_SAMPLING.
+
+    Rules are looked up by "category.event", then by "category". When a
+    record is let through after others were suppressed, it carries the
+    suppressed count so nothing disappears silently.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.lock = threading.Lock()
+        self.state = {}  # key -> [window_start, emitted_in_window, suppressed]
+
+    def admit(self, key):
+        """None to drop the record, otherwise the number suppressed since the last one"""
+        rule = self.rules.get(key) or self.rules.get(key.split('.', 1)[0])
+        if rule is None:
+            return 0
+        with self.lock:
+            state = self.state.setdefault(key, [0.0, 0, 0])
+            if random.random() >= rule.get('rate', 1.0):
+                state[2] += 1
+                return None
+            per_minute = rule.get('per_minute')
+            if per_minute:
+                now = time.monotonic()
+                if now - state[0] >= 60:
+                    state[0], state[1] = now, 0
+                if state[1] >= per_minute:
+                    state[2] += 1
+                    return None
+                state[1] += 1
+            suppressed, state[2] = state[2], 0
+            return suppressed
+
+
+sampler = LogSampler(Config.LOG_SAMPLING)
+
+
+def configure_logging():
+    """Route the app's loggers through a queue to stdout, once per process"""
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            return
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(JsonFormatter() if Config.LOG_FORMAT == 'json' else TextFormatter())
+        log_queue = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+
+        root = logging.getLogger('app')
+        root.setLevel(Config.LOG_LEVEL.upper())
+        root.addHandler(DroppingQueueHandler(log_queue))
+        root.propagate = False
+
+        _listener = QueueListener(log_queue, stream, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+class StructuredLogger:
+    """Logger for one category; every call is an event name plus keyword fields.
+
+        log = get_logger('stability')
+        log.warning('engine_failed', engine=engine_id, status=response.status_code)
+    """
+
+    def __init__(self, category):
+        self.category = category
+        self.logger = logging.getLogger(f"app.{category}")
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def _log(self, level, event, fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        suppressed = sampler.admit(f"{self.category}.{event}")
+        if suppressed is None:
+            return
+        if suppressed:
+            fields['suppressed'] = suppressed
+
+        # Request context has to be read here; the listener thread can't see it
+        from utils.tracing import current_span
+        span = current_span()
+        if span is not None:
+            fields['request_id'] = span.trace.request_id
+            fields['trace_id'] = span.trace.trace_id
+
+        self.logger.log(level, event, extra={'category': self.category, 'fields': fields})
+
+
+def get_logger(category):
+    configure_logging()
+    return StructuredLogger(category)
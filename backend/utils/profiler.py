@@ -0,0 +1,354 @@
+import os
+import sys
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import tempfile
+import threading
+from io import StringIO
+from collections import Counter
+from datetime import datetime
+from flask import g, request
+from config import Config
+from utils.log import get_logger
+
+log = get_logger('profiler')
+
+MODES = ('sample', 'cprofile')
+
+
+def _dir(name):
+    path = os.path.join(Config.PROFILE_ROOT, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _write_atomic(path, text):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _frame_label(filename, name):
+    return f"{name} ({os.path.basename(filename)})"
+
+
+def collapse(stacks):
+    """Brendan Gregg's folded format: "root;child;leaf count" per line, heaviest first"""
+    return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.most_common())
+
+
+def collapse_cprofile(profile_stats, max_depth=64, min_share=1e-4):
+    """Folded stacks (microseconds) rebuilt from cProfile's caller graph.
+
+    cProfile keeps caller -> callee edges rather than whole stacks, so each
+    function's own time is split across its callers in proportion to the
+    time spent under each of them, the same reconstruction flameprof uses.
+    """
+    stats = profile_stats.stats  # func -> (cc, nc, tottime, cumtime, callers)
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    stacks = Counter()
+
+    def walk(func, path, share):
+        _, _, tottime, cumtime, _ = stats[func]
+        path = path + (_frame_label(func[0], func[2]),)
+        own = round(tottime * share * 1e6)
+        if own:
+            stacks[path] += own
+        if len(path) >= max_depth or not cumtime:
+            return
+        for callee, edge_cumtime in callees.get(func, ()):
+            callee_cumtime = stats[callee][3]
+            child_share = share * edge_cumtime / callee_cumtime if callee_cumtime else 0
+            if child_share >= min_share and _frame_label(callee[0], callee[2]) not in path:
+                walk(callee, path, min(child_share, 1.0))
+
+    for func, (_, _, _, _, callers) in stats.items():
+        if not callers:
+            walk(func, (), 1.0)
+    return stacks
+
+
+class StackSampler:
+    """Samples every thread's stack at PROFILE_SAMPLE_INTERVAL_MS from a background thread.
+
+    Nothing is hooked into the interpreter, so the sampled code runs at full
+    speed; the cost is one sys._current_frames() walk per tick.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.stacks = Counter()
+        self.samples = 0
+
+    def run(self):
+        interval = Config.PROFILE_SAMPLE_INTERVAL_MS / 1000
+        own_id = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code.co_filename, frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(interval)
+        return self.stacks
+
+
+class Profiler:
+    """Profiling jobs requested through /api/admin/profiles, run by one worker each.
+
+    Jobs are files under PROFILE_ROOT, so any worker can accept a request
+    and the chosen worker (by pid, or whichever looks first) picks it up.
+    Workers look for work at most every PROFILE_POLL_SECONDS, from the
+    request path; with nothing queued a request pays one clock comparison.
+    Routes served outside Flask (see asgi.py) poll too, so sample jobs run
+    there, but their requests can't be cProfiled and are refused up front.
+    """
+
+    def __init__(self):
+        self.native_routes = set()  # rules/endpoints answered without Flask's request hooks
+        self.next_poll = 0.0
+        self.next_heartbeat = 0.0
+        self.active = None  # the running job, in this process
+        self.stats = None  # cProfile data merged across the job's requests
+        self.lock = threading.Lock()
+
+    @property
+    def pid(self):
+        return os.getpid()  # read late: the app may be imported before gunicorn forks
+
+    # Job records
+
+    def _job_path(self, job_id):
+        return os.path.join(_dir('jobs'), f"{job_id}.json")
+
+    def load_job(self, job_id):
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self._job_path(job_id), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_job(self, job):
+        _write_atomic(self._job_path(job['id']), json.dumps(job))
+
+    def submit(self, mode, seconds=None, requests=None, route=None, worker=None):
+        """Queue a job for one worker; returns the job record"""
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of: {', '.join(MODES)}")
+        if worker is not None:
+            worker = int(worker)
+            if worker not in self.workers():
+                raise ValueError(f'Unknown worker {worker}')
+        seconds = int(seconds or Config.PROFILE_DEFAULT_SECONDS)
+        if not 1 <= seconds <= Config.PROFILE_MAX_SECONDS:
+            raise ValueError(f'seconds must be between 1 and {Config.PROFILE_MAX_SECONDS}')
+        if mode == 'cprofile':
+            if route in self.native_routes:
+                raise ValueError(f"{route} is served by the ASGI app, outside Flask's request hooks, "
+                                 "so it can't be cProfiled; use mode 'sample'")
+            requests = int(requests or 1)
+            if not 1 <= requests <= Config.PROFILE_MAX_REQUESTS:
+                raise ValueError(f'requests must be between 1 and {Config.PROFILE_MAX_REQUESTS}')
+        job = {
+            'id': uuid.uuid4().hex[:16],
+            'mode': mode,
+            'seconds': seconds,
+            'requests': requests if mode == 'cprofile' else None,
+            'route': route if mode == 'cprofile' else None,
+            'worker': worker,
+            'status': 'pending',
+            'created_at': datetime.utcnow().isoformat()
+        }
+        self.prune()
+        self._save_job(job)
+        _write_atomic(os.path.join(_dir('pending'), f"{job['id']}.{worker or 'any'}"), '')
+        return job
+
+    def jobs(self, limit=20):
+        """Most recent jobs first"""
+        directory = _dir('jobs')
+        entries = [e for e in os.scandir(directory) if e.name.endswith('.json')]
+        entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+        return [job for job in (self.load_job(e.name[:-len('.json')]) for e in entries[:limit]) if job]
+
+    def prune(self):
+        """Forget jobs and results older than PROFILE_TTL_DAYS"""
+        cutoff = time.time() - Config.PROFILE_TTL_DAYS * 86400
+        for name in ('jobs', 'results', 'claimed'):
+            for entry in os.scandir(_dir(name)):
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+
+    def workers(self):
+        """Pids of workers that checked in within the last minute"""
+        directory = _dir('workers')
+        cutoff = time.time() - 60
+        live = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.isdigit() and os.path.getmtime(path) >= cutoff:
+                live.append(int(name))
+        return sorted(live)
+
+    def result(self, job_id, kind='folded'):
+        """Collapsed stacks ('folded') or, for cprofile jobs, the pstats summary ('txt')"""
+        if not job_id.isalnum() or kind not in ('folded', 'txt'):
+            return None
+        try:
+            with open(os.path.join(_dir('results'), f"{job_id}.{kind}"), encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    # Worker side
+
+    def poll(self):
+        """Called per request; claims queued work for this worker at most every PROFILE_POLL_SECONDS"""
+        now = time.monotonic()
+        if now < self.next_poll:
+            return
+        self.next_poll = now + Config.PROFILE_POLL_SECONDS
+        try:
+            if now >= self.next_heartbeat:
+                self.next_heartbeat = now + 30
+                _write_atomic(os.path.join(_dir('workers'), str(self.pid)), '')
+            if self.active is None:
+                self._claim()
+            elif self.active['mode'] == 'cprofile' and time.time() >= self.active['deadline']:
+                self._finish_cprofile()
+        except OSError as e:
+            log.warning('poll_failed', error=str(e))
+
+    def _claim(self):
+        pending = _dir('pending')
+        for name in sorted(os.listdir(pending)):
+            job_id, _, target = name.partition('.')
+            if target not in ('any', str(self.pid)):
+                continue
+            try:
+                # Rename is atomic: exactly one worker gets the job
+                os.rename(os.path.join(pending, name), os.path.join(_dir('claimed'), name))
+            except OSError:
+                continue
+            job = self.load_job(job_id)
+            if job is None:
+                continue
+            job.update(status='running', pid=self.pid, started_at=datetime.utcnow().isoformat())
+            self._save_job(job)
+            log.info('job_started', job_id=job_id, mode=job['mode'])
+            if job['mode'] == 'sample':
+                self.active = job
+                threading.Thread(target=self._run_sampler, args=(job,), daemon=True, name='profiler').start()
+            else:
+                job.update(deadline=time.time() + job['seconds'], profiled=0)
+                self.active = job
+            return
+
+    def _run_sampler(self, job):
+        try:
+            sampler = StackSampler(job['seconds'])
+            self._complete(job, collapse(sampler.run()), samples=sampler.samples)
+        except Exception as e:
+            self._complete(job, None, error=str(e))
+
+    def _complete(self, job, folded, **fields):
+        if folded is not None:
+            _write_atomic(os.path.join(_dir('results'), f"{job['id']}.folded"), folded)
+        job.pop('deadline', None)
+        job.update(status='failed' if fields.get('error') else 'done',
+                   finished_at=datetime.utcnow().isoformat(), **fields)
+        self._save_job(job)
+        log.info('job_finished', job_id=job['id'], status=job['status'])
+        with self.lock:
+            self.active = None
+            self.stats = None
+
+    def matches(self, job):
+        route = job.get('route')
+        if not route:
+            return True
+        rule = request.url_rule.rule if request.url_rule else None
+        return route in (rule, request.endpoint, request.path)
+
+    def start_request(self):
+        job = self.active
+        if job is None or job['mode'] != 'cprofile' or not self.matches(job):
+            return
+        # One Profile per request: cProfile hooks a single thread
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            g.profile = profile
+        except ValueError:  # another profiler is active on this thread
+            pass
+
+    def finish_request(self):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        with self.lock:
+            job = self.active
+            if job is None or job['profiled'] >= job['requests']:
+                return
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            job['profiled'] += 1
+            done = job['profiled'] >= job['requests']
+        if done:
+            self._finish_cprofile()
+
+    def _finish_cprofile(self):
+        job, stats = self.active, self.stats
+        if job is None:
+            return
+        try:
+            if stats is None:
+                self._complete(job, None, error='No matching requests before the deadline')
+                return
+            summary = StringIO()
+            stats.stream = summary
+            stats.sort_stats('cumulative').print_stats(40)
+            _write_atomic(os.path.join(_dir('results'), f"{job['id']}.txt"), summary.getvalue())
+            self._complete(job, collapse(collapse_cprofile(stats)))
+        except Exception as e:
+            self._complete(job, None, error=str(e))
+
+
+profiler = Profiler()
+
+
+def init_profiler(app):
+    """Let admins profile this worker on demand; idle cost is a clock check per request"""
+
+    @app.before_request
+    def start_request_profile():
+        profiler.poll()
+        if profiler.active is not None:
+            profiler.start_request()
+
+    @app.teardown_request
+    def finish_request_profile(exc):
+        if g.get('profile') is not None:
+            profiler.finish_request()
@@ -0,0 +1,157 @@
+import re
+import time
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import Config
+from utils.log import get_logger
+
+log = get_logger('query_budget')
+# A context variable rather than a thread local: asgi.run_db copies the request's
+# context onto its DB threads, so their statements count toward the request too
+_collectors = contextvars.ContextVar('query_collectors', default=())
+
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\bIN\s*\((?:\s*\?\s*,?)+\)", re.IGNORECASE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def statement_shape(statement):
+    """Reduce a SQL statement to its shape so repeated lookups compare equal"""
+    shape = _LITERAL_RE.sub('?', statement)
+    shape = _IN_LIST_RE.sub('IN (?)', shape)
+    return _SPACE_RE.sub(' ', shape).strip()
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold=None):
+        """Statement shapes issued at least `threshold` times (likely N+1)"""
+        threshold = threshold or Config.N_PLUS_ONE_THRESHOLD
+        return [(shape, n) for shape, n in self.shapes.most_common() if n >= threshold]
+
+
+def collect(stats):
+    """Start recording this context's statements into stats; returns the token for stop_collecting"""
+    _listen()
+    return _collectors.set(_collectors.get() + (stats,))
+
+
+def stop_collecting(token):
+    _collectors.reset(token)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _collectors.get():
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    collectors = _collectors.get()
+    if not collectors:
+        return
+    starts = conn.info.get('query_start_time')
+    duration = time.perf_counter() - starts.pop() if starts else 0.0
+    for stats in collectors:
+        stats.record(statement, duration)
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute; drop its start time so the
+    # pooled connection's next statement isn't timed from it
+    starts = exception_context.connection.info.get('query_start_time') if exception_context.connection else None
+    if starts:
+        starts.pop()
+
+
+def _listen():
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+def budget_for(endpoint):
+    return Config.QUERY_BUDGETS.get(endpoint, Config.QUERY_BUDGET_DEFAULT)
+
+
+def init_query_budget(app):
+    """Count and time SQL per request, flag N+1 shapes and budget overruns"""
+    _listen()
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+        g.query_stats_token = collect(g.query_stats)
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.get('query_stats')
+        if stats is None:
+            return response
+
+        if app.debug or Config.QUERY_STATS_HEADERS:
+            response.headers['X-Query-Count'] = str(stats.count)
+            response.headers['X-Query-Time-Ms'] = f"{stats.duration * 1000:.1f}"
+            response.headers['X-Query-Repeated'] = str(sum(n for _, n in stats.repeated()))
+        report(request.endpoint or request.path, stats)
+        return response
+
+    @app.teardown_request
+    def stop_query_stats(exc):
+        token = g.pop('query_stats_token', None)
+        g.pop('query_stats', None)
+        if token is not None:
+            stop_collecting(token)
+
+
+def report(endpoint, stats):
+    """Log a request's budget overrun and N+1 shapes"""
+    budget = budget_for(endpoint)
+    if stats.count > budget:
+        log.warning('budget_exceeded', endpoint=endpoint, queries=stats.count, budget=budget,
+                    duration_ms=round(stats.duration * 1000, 1))
+    for shape, n in stats.repeated():
+        log.warning('n_plus_one', endpoint=endpoint, repeated=n, statement=shape)
+
+
+@contextmanager
+def assert_query_budget(max_queries=None, endpoint=None, allow_repeated=False):
+    """Fail if the wrapped block issues more queries than allowed.
+
+    Pass either an explicit `max_queries` or the Flask `endpoint` name to use
+    its configured budget, e.g.
+
+        with assert_query_budget(endpoint='get_favorites'):
+            client.get('/api/favorites', headers=auth)
+    """
+    if max_queries is None:
+        max_queries = budget_for(endpoint)
+
+    stats = QueryStats()
+    token = collect(stats)
+    try:
+        yield stats
+    finally:
+        stop_collecting(token)
+
+    if stats.count > max_queries:
+        raise AssertionError(
+            f"{endpoint or 'block'} issued {stats.count} queries, budget is {max_queries}"
+        )
+    repeated = stats.repeated()
+    if repeated and not allow_repeated:
+        shape, n = repeated[0]
+        raise AssertionError(f"{endpoint or 'block'} repeated a query {n}x (N+1?): {shape}")
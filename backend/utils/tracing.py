@@ -0,0 +1,341 @@
+import os
+import json
+import time
+import queue
+import random
+import inspect
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+import requests
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import Config
+from utils.log import get_logger
+
+log = get_logger('tracing')
+
+SERVICE_NAME = 'ai-image-generator'
+
+# OTLP span kinds and status codes
+KINDS = {'internal': 1, 'server': 2, 'client': 3}
+STATUS_OK, STATUS_ERROR = 1, 2
+
+_current = contextvars.ContextVar('current_span', default=None)
+
+
+def _new_id(nbytes):
+    return os.urandom(nbytes).hex()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class Trace:
+    """All spans of one request, kept in memory until the retention decision"""
+
+    def __init__(self, trace_id=None, request_id=None):
+        self.trace_id = trace_id or _new_id(16)
+        self.request_id = request_id or self.trace_id
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, span):
+        if len(self.spans) < Config.TRACE_MAX_SPANS:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+    def to_otlp(self):
+        """ExportTraceServiceRequest in OTLP/JSON, as accepted by collectors on /v1/traces"""
+        return {'resourceSpans': [{
+            'resource': {'attributes': [
+                {'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}},
+            ]},
+            'scopeSpans': [{
+                'scope': {'name': SERVICE_NAME},
+                'spans': [span.to_otlp() for span in self.spans]
+            }]
+        }]}
+
+
+class Span:
+    def __init__(self, trace, name, kind='internal', parent_id=None, attributes=None):
+        self.trace = trace
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.status = STATUS_OK
+        self.status_message = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        self.status = STATUS_ERROR
+        self.status_message = str(error)[:500]
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.trace.add(self)
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': KINDS[self.kind],
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [
+                {'key': key, 'value': _otlp_value(value)}
+                for key, value in self.attributes.items() if value is not None
+            ],
+            'status': {'code': self.status}
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.status_message:
+            span['status']['message'] = self.status_message
+        return span
+
+
+class _NoopSpan:
+    """Stands in when no trace is active, so call sites never branch"""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, error):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class TraceExporter:
+    """Writes retained traces off the request thread.
+
+    TRACE_EXPORT is either a file path (one OTLP/JSON document per line,
+    the OpenTelemetry file exporter format) or an http(s) URL of an OTLP
+    collector's /v1/traces endpoint.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.queue = queue.Queue(maxsize=1000)
+        self.thread = None
+
+    def submit(self, trace):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True, name='trace-exporter')
+            self.thread.start()
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            pass  # never block a request on telemetry
+
+    def _run(self):
+        while True:
+            trace = self.queue.get()
+            try:
+                self.export(trace)
+            except Exception as e:
+                log.warning('export_failed', error=str(e))
+
+    def export(self, trace):
+        payload = trace.to_otlp()
+        if self.target.startswith(('http://', 'https://')):
+            requests.post(self.target, json=payload, timeout=5)
+        else:
+            with open(self.target, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(payload) + '\n')
+
+
+exporter = TraceExporter(Config.TRACE_EXPORT) if Config.TRACE_EXPORT else None
+
+
+def enabled():
+    return exporter is not None
+
+
+def current_span():
+    return _current.get()
+
+
+@contextmanager
+def span(name, kind='internal', **attributes):
+    """Child span of the active one; free when no request is being traced"""
+    parent = _current.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+    child = Span(parent.trace, name, kind, parent.span_id, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.set_error(e)
+        raise
+    finally:
+        child.end()
+        _current.reset(token)
+
+
+def traced(name=None, kind='internal'):
+    """Decorator form of span(), named after the function by default"""
+    def decorator(fn):
+        span_name = name or fn.__qualname__
+
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                if _current.get() is None:
+                    return await fn(*args, **kwargs)
+                with span(span_name, kind):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return fn(*args, **kwargs)
+            with span(span_name, kind):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def parse_traceparent(header):
+    """(trace_id, parent_span_id) from a W3C traceparent header, or (None, None)"""
+    parts = (header or '').split('-')
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16 and parts[1] != '0' * 32:
+        return parts[1], parts[2]
+    return None, None
+
+
+def start_trace(name, traceparent=None, request_id=None, **attributes):
+    """Open the root span of a request; returns (span, token) or (None, None) when disabled"""
+    if not enabled():
+        return None, None
+    trace_id, parent_id = parse_traceparent(traceparent)
+    root = Span(Trace(trace_id, request_id), name, 'server', parent_id=parent_id, attributes=attributes)
+    return root, _current.set(root)
+
+
+def finish_trace(root, token, status_code):
+    """Close the root span and keep the trace only if it was slow, failed or sampled"""
+    if root is None:
+        return
+    root.set_attribute('http.status_code', status_code)
+    if status_code >= 500:
+        root.status = STATUS_ERROR
+    root.end()
+    try:
+        _current.reset(token)
+    except ValueError:  # torn down from a different context than it started in
+        _current.set(None)
+
+    slow = root.duration_ms >= Config.TRACE_SLOW_MS
+    if slow or root.status == STATUS_ERROR or random.random() < Config.TRACE_SAMPLE_RATE:
+        if root.trace.dropped:
+            root.set_attribute('trace.dropped_spans', root.trace.dropped)
+        exporter.submit(root.trace)
+    if slow:
+        log.warning('slow_request', route=root.name, duration_ms=round(root.duration_ms),
+                    spans=len(root.trace.spans), request_id=root.trace.request_id, trace_id=root.trace.trace_id)
+
+
+def propagation_headers():
+    """Headers that carry the active trace to an upstream service"""
+    active = _current.get()
+    if active is None:
+        return {}
+    return {
+        'traceparent': f"00-{active.trace.trace_id}-{active.span_id}-01",
+        'X-Request-ID': active.trace.request_id
+    }
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    parent = _current.get()
+    if parent is None:
+        return
+    sql_span = Span(parent.trace, 'db.query', 'client', parent.span_id, {
+        'db.system': conn.engine.dialect.name,
+        'db.statement': statement[:1000],
+    })
+    conn.info.setdefault('trace_spans', []).append(sql_span)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    spans = conn.info.get('trace_spans')
+    if spans:
+        spans.pop().end()
+
+
+def _handle_error(exception_context):
+    spans = exception_context.connection.info.get('trace_spans') if exception_context.connection else None
+    if spans:
+        sql_span = spans.pop()
+        sql_span.set_error(exception_context.original_exception)
+        sql_span.end()
+
+
+def _listen():
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+def init_tracing(app):
+    """Trace every request; export the full trace only for slow or failed ones"""
+    if not enabled():
+        return
+    _listen()
+
+    @app.before_request
+    def start_request_trace():
+        root, token = start_trace(
+            f"{request.method} {request.url_rule.rule if request.url_rule else request.path}",
+            traceparent=request.headers.get('traceparent'),
+            request_id=request.headers.get('X-Request-ID'),
+            **{'http.method': request.method, 'http.target': request.path}
+        )
+        g.trace_root, g.trace_token = root, token
+
+    @app.after_request
+    def add_trace_headers(response):
+        root = g.get('trace_root')
+        if root is not None:
+            response.headers['X-Request-ID'] = root.trace.request_id
+            response.headers['traceparent'] = f"00-{root.trace.trace_id}-{root.span_id}-01"
+            g.trace_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_trace(exc):
+        root = g.pop('trace_root', None)
+        if root is not None:
+            if exc is not None:
+                root.set_error(exc)
+            finish_trace(root, g.pop('trace_token'), g.pop('trace_status', 500))